@@ -0,0 +1,160 @@
+"""
+Synthetic end-to-end benchmarks for the recorder and detection pipelines.
+
+Runs each scenario in its own process on generated video with a stub detector, so no camera, GPU or
+model weights are needed, and prints the results as JSON. Save a run with --output and pass it to
+--compare on a later commit to see what changed.
+
+The inference scenario times the real model with each inference backend instead, and only runs when named.
+
+Usage: python bench/bench.py [scenario ...] [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+
+from scenarios import OPT_IN, SCENARIOS
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the recorder and detection pipelines on synthetic video.")
+    parser.add_argument("scenarios", nargs="*", metavar="scenario",
+                        help=f"Scenarios to run: {', '.join(SCENARIOS)}. All but {', '.join(sorted(OPT_IN))} "
+                             "by default")
+    parser.add_argument("--output", help="Write the results to this file as well as printing them")
+    parser.add_argument("--compare", help="Results of an earlier run to compare against")
+
+    video = parser.add_argument_group("synthetic video")
+    video.add_argument("--width", type=int, default=1280)
+    video.add_argument("--height", type=int, default=720)
+    video.add_argument("--fps", type=int, default=20)
+    video.add_argument("--seconds", type=float, default=30, help="Length of each file or of the live stream")
+    video.add_argument("--objects", type=int, default=3, help="Moving objects per frame")
+    video.add_argument("--motion-density", type=float, default=0.5, help="Fraction of the time objects move")
+
+    pipeline = parser.add_argument_group("pipeline")
+    pipeline.add_argument("--cost-ms", type=float, default=20, help="Stub detector cost per frame")
+    pipeline.add_argument("--busy", action="store_true", help="Spin the CPU for the detector cost instead of sleeping")
+    pipeline.add_argument("--movement-threshold", type=int, default=15)
+    pipeline.add_argument("--delay-time", type=float, default=3)
+    pipeline.add_argument("--pre-roll", type=float, default=2)
+    pipeline.add_argument("--encoder-queue", type=int, default=30)
+    pipeline.add_argument("--no-motion-gate", dest="motion_gate", action="store_false")
+    pipeline.add_argument("--files", type=int, default=4, help="Segments processed by the recorder scenario")
+    pipeline.add_argument("--stride", type=int, default=1, help="Recorder detection stride")
+    pipeline.add_argument("--pool-size", type=int, default=1, help="Stub models in the live detection pool")
+    pipeline.add_argument("--batch-size", type=int, default=4)
+    pipeline.add_argument("--batch-wait-ms", type=float, default=50)
+    pipeline.add_argument("--latest-frames", type=int, default=0,
+                          help="Newest frames the live detector keeps, 0 detects on every frame")
+    pipeline.add_argument("--max-frame-age-ms", type=float, default=1000)
+
+    scan = parser.add_argument_group("file manager scan")
+    scan.add_argument("--cams", type=int, default=2)
+    scan.add_argument("--days", type=int, default=14)
+    scan.add_argument("--files-per-day", type=int, default=1440)
+    scan.add_argument("--rescans", type=int, default=20)
+    model = parser.add_argument_group("inference, needs ultralytics, onnxruntime and the weights")
+    model.add_argument("--model", default="yolo11n.pt")
+    model.add_argument("--inference-frames", type=int, default=100, help="Frames timed per backend")
+    model.add_argument("--inference-batch", type=int, default=4,
+                       help="Frames per batched call, also timed per batch. 1 only times single frames")
+    model.add_argument("--threads", type=int, default=0, help="ONNX Runtime threads, 0 uses every core")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario: {', '.join(sorted(unknown))}")
+    return args
+
+
+def run_scenario(name, params):
+    """
+    Run a scenario in a fresh process.
+
+    Returns:
+        dict: The scenario's results, or its error output if it failed.
+    """
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+        output = f.name
+    try:
+        process = subprocess.run([sys.executable, os.path.join(HERE, "scenarios.py"), name, json.dumps(params), output],
+                                 capture_output=True, text=True)
+        if process.returncode != 0:
+            return {"error": process.stderr.strip().splitlines()[-1:]}
+        with open(output) as f:
+            return json.load(f)
+    finally:
+        os.remove(output)
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain"], cwd=HERE, capture_output=True, text=True).stdout
+        return commit + ("-dirty" if dirty.strip() else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(result, prefix=""):
+    for key, value in result.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f"{prefix}{key}", value
+
+
+def compare(baseline, report):
+    """
+    Print the change of every numeric result between two runs.
+    """
+    print(f"Compared with {baseline.get('commit')}:", file=sys.stderr)
+    for name, result in report["results"].items():
+        previous = dict(flatten(baseline["results"].get(name, {})))
+        for metric, value in flatten(result):
+            old = previous.get(metric)
+            if old is None:
+                continue
+            change = f"{(value - old) / old * 100:+.1f}%" if old else "n/a"
+            print(f"  {name:<18} {metric:<24} {old:>12} -> {value:<12} {change}", file=sys.stderr)
+
+
+def main():
+    args = parse_args()
+    params = vars(args).copy()
+    for key in ("scenarios", "output", "compare"):
+        params.pop(key)
+
+    report = {
+        "commit": git_commit(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "params": params,
+        "results": {},
+    }
+    for name in args.scenarios or [name for name in SCENARIOS if name not in OPT_IN]:
+        print(f"Running {name}", file=sys.stderr)
+        report["results"][name] = run_scenario(name, params)
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+    failed = [name for name, result in report["results"].items() if "error" in result]
+    if failed:
+        sys.exit(f"Failed scenarios: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+"""
+Benchmark scenarios. Each one runs in its own process, started by bench.py, so the recorder's and the
+detection pipeline's modules, which share names, never meet and peak RSS is measured per scenario.
+
+Usage: python scenarios.py <scenario> <params json> <output json>
+"""
+import json
+import os
+import queue
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from synthetic import SyntheticCapture, SyntheticScene, generate_video, read_stamp
+from stub_detector import StubDetector, StubModelPool
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def scene_args(params):
+    return {key: params[key] for key in ("width", "height", "fps", "objects", "motion_density")}
+
+
+def percentiles(values):
+    """
+    Returns the p50 and p99 of a list of milliseconds.
+    """
+    if not values:
+        return {"p50": None, "p99": None}
+    p50, p99 = np.percentile(values, [50, 99])
+    return {"p50": round(float(p50), 3), "p99": round(float(p99), 3)}
+
+
+def peak_rss_mb():
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def count_clips(directory):
+    return sum(1 for _, _, files in os.walk(directory) for file in files if file.endswith(".mp4"))
+
+
+def recorder(params, workdir):
+    """
+    Process synthetic segments the way recorder/runner.py does with one worker, with a stub detector.
+
+    Latency is the time between consecutive frames reaching the video writer, which is the time each
+    frame took to decode, gate, detect and track.
+    """
+    sys.path.insert(0, os.path.join(ROOT, "recorder"))
+    from filemanager import FileManager, CheckpointWriter
+    from motiondetector import MotionDetector
+    from motion_gate import MotionGate
+    from video_writer import VideoWriter
+
+    source = os.path.join(workdir, "source")
+    clips = os.path.join(workdir, "clips")
+    frames = 0
+    for i in range(params["files"]):
+        path = os.path.join(source, "bench", "2026-01-01", f"bench_{i:04d}.mp4")
+        frames += generate_video(path, params["seconds"], seed=i, **scene_args(params))
+
+    latencies = []
+    last = [None]
+
+    class TimedWriter(VideoWriter):
+        def _tick(self):
+            now = time.perf_counter()
+            if last[0] is not None:
+                latencies.append((now - last[0]) * 1000)
+            last[0] = now
+
+        def write_frame(self, frame):
+            self._tick()
+            super().write_frame(frame)
+
+        def buffer_frame(self, frame):
+            self._tick()
+            super().buffer_frame(frame)
+
+    video_writer = TimedWriter(clips, params["width"], params["height"], params["fps"], params["pre_roll"],
+                               256 * 1024 * 1024, params["encoder_queue"])
+    motion_gate = MotionGate(None, 0.002, 5, params["fps"]) if params["motion_gate"] else None
+    detector = StubDetector(params["cost_ms"], params["busy"])
+    motion_detector = MotionDetector(None, params["movement_threshold"], params["delay_time"], video_writer,
+                                     detection_stride=params["stride"], motion_gate=motion_gate, model=detector)
+
+    file_manager = FileManager(source, os.path.join(workdir, "processed_files.db"))
+    file_manager.detect_new_files()
+    checkpoint_writer = CheckpointWriter(file_manager.db_file)
+    file_queue = file_manager.get_file_queue()
+    start = time.perf_counter()
+    while True:
+        try:
+            video_file = file_queue.get_nowait()
+        except queue.Empty:
+            break
+        last[0] = None
+        start_frame = file_manager.start_file(video_file)
+        motion_detector.run(video_file, start_frame, checkpoint_writer)
+        file_manager.mark_file_as_processed(video_file)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "frames": frames,
+        "seconds": round(elapsed, 3),
+        "fps": round(frames / elapsed, 2),
+        "latency_ms": percentiles(latencies),
+        "inferred_frames": detector.frames,
+        "clips": count_clips(clips),
+    }
+
+
+def detection_live(params, workdir):
+    """
+    Run detection/motion_detector_threaded.py on a synthetic live stream with stub detectors.
+
+    Latency is the time from a frame being captured to it reaching the video writer, and frame age the time
+    from a frame being captured to it reaching the detector.
+    """
+    sys.path.insert(0, os.path.join(ROOT, "detection"))
+    from motion_detector_threaded import MotionDetector
+    from motion_gate import MotionGate
+    from video_writer import VideoWriter
+
+    cap = SyntheticCapture(params["seconds"], **scene_args(params))
+    clips = os.path.join(workdir, "clips")
+    latencies = []
+    delivered_at = []
+    stopped = threading.Event()
+
+    class TimedWriter(VideoWriter):
+        def _tick(self, frame):
+            # Frames that only come out when the pipeline is stopped are counted as dropped
+            if stopped.is_set():
+                return
+            now = time.monotonic()
+            latencies.append((now - cap.captured_at[read_stamp(frame)]) * 1000)
+            delivered_at.append(now)
+
+        def write_frame(self, frame):
+            self._tick(frame)
+            super().write_frame(frame)
+
+        def buffer_frame(self, frame):
+            self._tick(frame)
+            super().buffer_frame(frame)
+
+        def _write(self, frame, block=False):
+            # Counts the frames record_frame writes to a clip. The tracker's frames are counted in write_frame,
+            # and flushed pre-roll frames when they were buffered.
+            if threading.current_thread() is not tracker:
+                self._tick(frame)
+            return super()._write(frame, block)
+
+    video_writer = TimedWriter(clips, params["width"], params["height"], params["fps"], params["pre_roll"],
+                               256 * 1024 * 1024, params["encoder_queue"])
+    motion_gate = MotionGate(None, 0.002, 5, params["fps"]) if params["motion_gate"] else None
+    model_pool = StubModelPool(params["pool_size"], params["cost_ms"], params["busy"])
+    motion_detector = MotionDetector(cap, params["movement_threshold"], params["delay_time"], video_writer,
+                                     model_pool, params["batch_size"], params["batch_wait_ms"], motion_gate,
+                                     handle_signals=False, latest_frames=params["latest_frames"],
+                                     max_frame_age=params["max_frame_age_ms"] / 1000)
+    tracker = motion_detector.frame_tracker
+
+    # A pipeline thread that dies would otherwise only show up as dropped frames
+    errors = []
+    excepthook = threading.excepthook
+
+    def record_error(args):
+        errors.append(args)
+        excepthook(args)
+
+    threading.excepthook = record_error
+    thread = threading.Thread(target=motion_detector.run)
+    thread.start()
+    while cap.isOpened() and not errors:
+        time.sleep(0.1)
+    # Let the pipeline drain what is still queued, until nothing has come out for a second
+    delivered = -1
+    while delivered != len(latencies) and len(latencies) < len(cap.captured_at) and not errors:
+        delivered = len(latencies)
+        time.sleep(1)
+    stopped.set()
+    motion_detector.stop()
+    thread.join()
+    motion_detector.cleanup()
+    threading.excepthook = excepthook
+    if errors:
+        error = errors[0]
+        raise RuntimeError(f"Pipeline thread {error.thread.name if error.thread else '?'} died: "
+                           f"{error.exc_type.__name__}: {error.exc_value}")
+
+    frames = len(latencies)
+    elapsed = cap.captured_at[-1] - cap.captured_at[0]
+    ages = [(seen - cap.captured_at[index]) * 1000 for detector in model_pool.detectors
+            for seen, index in detector.seen]
+    return {
+        "frames": frames,
+        "dropped": len(cap.captured_at) - frames,
+        "seconds": round(elapsed, 3),
+        "fps": round(frames / elapsed, 2) if elapsed else 0,
+        "latency_ms": percentiles(latencies),
+        "frame_age_ms": percentiles(ages),
+        "inferred_frames": sum(detector.frames for detector in model_pool.detectors),
+        "clips": count_clips(clips),
+    }
+
+
+def filemanager_scan(params, workdir):
+    """
+    Scan a large synthetic archive with the recorder's FileManager: the first full scan, rescans of an
+    unchanged tree and a rescan after new segments arrive in one directory.
+    """
+    sys.path.insert(0, os.path.join(ROOT, "recorder"))
+    from filemanager import FileManager
+
+    source = os.path.join(workdir, "source")
+    files = 0
+    for cam in range(params["cams"]):
+        for day in range(params["days"]):
+            directory = os.path.join(source, f"cam{cam}", f"2026-01-{day + 1:02d}")
+            os.makedirs(directory)
+            for minute in range(params["files_per_day"]):
+                open(os.path.join(directory, f"cam{cam}_{minute // 60:02d}_{minute % 60:02d}_00.mp4"), "w").close()
+                files += 1
+
+    start = time.perf_counter()
+    file_manager = FileManager(source, os.path.join(workdir, "processed_files.db"))
+    file_manager.detect_new_files()
+    initial = time.perf_counter() - start
+
+    file_queue = file_manager.get_file_queue()
+    start = time.perf_counter()
+    while not file_queue.empty():
+        file_manager.mark_file_as_processed(file_queue.get_nowait())
+    marking = time.perf_counter() - start
+
+    rescans = []
+    for _ in range(params["rescans"]):
+        start = time.perf_counter()
+        file_manager.list_new_files()
+        rescans.append((time.perf_counter() - start) * 1000)
+
+    directory = os.path.join(source, "cam0", "2026-01-01")
+    for i in range(10):
+        open(os.path.join(directory, f"new_{i}.mp4"), "w").close()
+    start = time.perf_counter()
+    new_files = file_manager.list_new_files()
+    incremental = (time.perf_counter() - start) * 1000
+
+    return {
+        "files": files,
+        "initial_scan_s": round(initial, 3),
+        "files_per_s": round(files / initial, 1),
+        "marked_per_s": round(files / marking, 1),
+        "rescan_ms": percentiles(rescans),
+        "incremental_scan_ms": round(incremental, 3),
+        "new_files_found": len(new_files),
+    }
+
+
+def inference(params, workdir):
+    """
+    Time the real model on synthetic frames with each inference backend: PyTorch, ONNX Runtime and ONNX
+    Runtime with int8 weights. Needs ultralytics, onnxruntime and the model weights, so it only runs when
+    asked for by name.
+
+    Load time includes exporting the ONNX models, which are cached in the scenario's temporary directory.
+    Each result names the backend that was actually loaded, which differs from the requested one when the
+    export fell back. With inference_batch above 1 the frames are also timed in batches of that many per call,
+    the way the detection pipeline runs them, and a backend that cannot run a batch reports the error.
+    """
+    sys.path.insert(0, os.path.join(ROOT, "detection"))
+    from model_backend import load_model
+
+    scene = SyntheticScene(**scene_args(params))
+    frames = [scene.next_frame() for _ in range(params["inference_frames"])]
+    cache_dir = os.path.join(workdir, "models")
+
+    results = {}
+    for name, backend, int8 in (("torch", "torch", False), ("onnx", "onnx", False), ("onnx-int8", "onnx", True)):
+        start = time.perf_counter()
+        model = load_model(params["model"], backend=backend, int8=int8, cache_dir=cache_dir,
+                           threads=params["threads"])
+        loaded = time.perf_counter() - start
+        model.predict(frames[0], verbose=False)
+
+        latencies = []
+        for frame in frames:
+            start = time.perf_counter()
+            model.predict(frame, verbose=False)
+            latencies.append((time.perf_counter() - start) * 1000)
+        results[name] = {
+            # load_model falls back to the next best model when an export fails or does not match
+            "backend": model.loaded_backend,
+            "load_s": round(loaded, 3),
+            "fps": round(1000 * len(latencies) / sum(latencies), 2),
+            "latency_ms": percentiles(latencies),
+        }
+        if params["inference_batch"] > 1:
+            results[name].update(time_batches(model, frames, params["inference_batch"]))
+    return results
+
+
+def time_batches(model, frames, batch):
+    """
+    Time a model on frames in batches of up to batch frames per call.
+
+    Returns:
+        dict: The frames per second and per-batch latency, or the error of the first batched call.
+    """
+    batches = [frames[i:i + batch] for i in range(0, len(frames), batch)]
+    try:
+        model.predict(batches[0], verbose=False)
+    except Exception as e:
+        return {"batch_error": f"{type(e).__name__}: {e}"}
+
+    latencies = []
+    for frames_batch in batches:
+        start = time.perf_counter()
+        model.predict(frames_batch, verbose=False)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return {
+        "batch_fps": round(1000 * len(frames) / sum(latencies), 2),
+        "batch_latency_ms": percentiles(latencies),
+    }
+
+
+SCENARIOS = {
+    "recorder": recorder,
+    "detection-live": detection_live,
+    "filemanager-scan": filemanager_scan,
+    "inference": inference,
+}
+
+# Scenarios that need the real model, run only when named on the command line
+OPT_IN = {"inference"}
+
+
+if __name__ == "__main__":
+    name, params, output = sys.argv[1], json.loads(sys.argv[2]), sys.argv[3]
+    with tempfile.TemporaryDirectory(prefix=f"bench-{name}-") as workdir:
+        result = SCENARIOS[name](params, workdir)
+    result["peak_rss_mb"] = peak_rss_mb()
+    with open(output, "w") as f:
+        json.dump(result, f)
@@ -0,0 +1,152 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+from synthetic import read_stamp
+
+
+class _Values:
+    """
+    Just enough of a torch tensor's interface for the pipelines' result handling.
+    """
+
+    def __init__(self, values):
+        self.values = values
+
+    def __len__(self):
+        return len(self.values)
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self.values
+
+    def int(self):
+        return _Values(self.values.astype(np.int64))
+
+    def tolist(self):
+        return self.values.tolist()
+
+
+class _Boxes:
+    def __init__(self, xyxy, ids):
+        xywh = xyxy.copy()
+        xywh[:, :2] = (xyxy[:, :2] + xyxy[:, 2:]) / 2
+        xywh[:, 2:] = xyxy[:, 2:] - xyxy[:, :2]
+        self.xyxy = _Values(xyxy)
+        self.xywh = _Values(xywh)
+        self.cls = _Values(np.zeros(len(ids), dtype=np.float32))
+        self.conf = _Values(np.ones(len(ids), dtype=np.float32))
+        self.id = _Values(ids.astype(np.float32)) if len(ids) else None
+
+
+class _Result:
+    def __init__(self, boxes, names, orig_shape):
+        self.boxes = boxes
+        self.names = names
+        self.orig_shape = orig_shape
+
+
+class StubDetector:
+    """
+    A stand-in for a YOLO model that finds the objects drawn by SyntheticScene, at a configurable cost.
+
+    Initializes the StubDetector with the time each frame should cost. Objects are found as bright
+    connected regions, and their track id comes from their colour, so ids stay stable across frames like
+    a tracker's would. The cost is spent after the detection, either sleeping, like a model running on a
+    GPU that releases the GIL, or spinning on the CPU. The stamp of every frame it sees is logged with the
+    time it saw it.
+
+    Args:
+        cost_ms: Milliseconds each frame costs.
+        busy: Spin instead of sleeping.
+    """
+
+    names = {0: "object"}
+
+    def __init__(self, cost_ms=20, busy=False):
+        self.cost = cost_ms / 1000
+        self.busy = busy
+        self.predictor = None
+        self.frames = 0
+        self.seen = []
+
+    def track(self, source, persist=True, verbose=False, device=None):
+        frames = source if isinstance(source, list) else [source]
+        start = time.perf_counter()
+        now = time.monotonic()
+        self.seen.extend((now, read_stamp(frame)) for frame in frames)
+        results = [self._detect(frame) for frame in frames]
+        deadline = start + self.cost * len(frames)
+        if self.busy:
+            while time.perf_counter() < deadline:
+                pass
+        else:
+            time.sleep(max(0.0, deadline - time.perf_counter()))
+        self.frames += len(frames)
+        return results
+
+    def _detect(self, frame):
+        # Downscale first, the shapes are large and this keeps the stub's own cost small next to cost_ms
+        scale = 4
+        small = cv2.resize(frame, (frame.shape[1] // scale, frame.shape[0] // scale), interpolation=cv2.INTER_NEAREST)
+        lit = small > 200
+        count, labels, stats, centroids = cv2.connectedComponentsWithStats(lit.any(axis=2).astype(np.uint8))
+        boxes, ids = [], []
+        for label in range(1, count):
+            x, y, w, h, area = stats[label]
+            if area < 4:
+                continue
+            cx, cy = centroids[label].astype(int)
+            channels = lit[cy, cx]
+            ids.append(1 + int(channels[0]) + 2 * int(channels[1]) + 4 * int(channels[2]))
+            boxes.append((x * scale, y * scale, (x + w) * scale, (y + h) * scale))
+        xyxy = np.array(boxes, dtype=np.float32).reshape(-1, 4)
+        return _Result(_Boxes(xyxy, np.array(ids)), self.names, frame.shape[:2])
+
+
+class StubModelPool:
+    """
+    A stand-in for detection's ModelPool that hands out StubDetectors.
+
+    Args:
+        size: The number of detectors.
+        cost_ms: Milliseconds each frame costs.
+        busy: Spin instead of sleeping.
+    """
+
+    def __init__(self, size=1, cost_ms=20, busy=False):
+        self.size = size
+        self.device = "cpu"
+        self.names = StubDetector.names
+        self.detectors = [StubDetector(cost_ms, busy) for _ in range(size)]
+        self.free = list(self.detectors)
+        self.condition = threading.Condition()
+
+    def ticket(self, stream_id):
+        return None
+
+    def checkout(self, stream_id=None, ticket=None):
+        with self.condition:
+            self.condition.wait_for(lambda: self.free)
+            return self.free.pop()
+
+    def checkin(self, model, stream_id=None):
+        with self.condition:
+            self.free.append(model)
+            self.condition.notify()
+
+    @contextmanager
+    def model(self, stream_id=None, ticket=None):
+        model = self.checkout(stream_id, ticket)
+        try:
+            yield model
+        finally:
+            self.checkin(model, stream_id)
+
+    def reset_stream(self, stream_id):
+        pass
@@ -0,0 +1,167 @@
+import os
+import time
+
+import cv2
+import numpy as np
+
+# Saturated colours, so the stub detector can tell objects apart by which channels are lit
+COLORS = [(0, 0, 255), (0, 255, 0), (255, 0, 0), (0, 255, 255), (255, 0, 255), (255, 255, 0), (255, 255, 255)]
+
+
+class SyntheticScene:
+    """
+    A generator of synthetic camera frames with moving objects on a noisy static background.
+
+    Initializes the SyntheticScene with the frame size and the objects. Objects are solid rectangles that
+    bounce around the frame. Time is split into cycles of cycle seconds, and objects only move during the
+    first motion_density of each cycle, so the share of frames with movement can be set independently of
+    the number of objects. The same seed always gives the same frames.
+
+    Args:
+        width: The width of the frames.
+        height: The height of the frames.
+        fps: Frames per second, used to convert the cycle to frames.
+        objects: The number of moving objects, at most len(COLORS) of them can be told apart.
+        motion_density: Fraction of each cycle during which the objects move.
+        speed: Distance an object moves per frame, as a fraction of the frame width.
+        noise: Standard deviation of the background noise.
+        cycle: Seconds per move/rest cycle.
+        seed: Seed for the background and the object paths.
+    """
+
+    def __init__(self, width=1280, height=720, fps=20, objects=3, motion_density=0.5, speed=0.02, noise=8,
+                 cycle=10, seed=0):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.motion_density = motion_density
+        self.cycle_frames = max(1, int(cycle * fps))
+        rng = np.random.default_rng(seed)
+
+        gradient = np.linspace(40, 110, width, dtype=np.float32)
+        background = np.repeat(gradient[None, :, None], height, axis=0).repeat(3, axis=2)
+        # A few noise frames are made up front and cycled, drawing new noise per frame would dominate the cost
+        self.backgrounds = [np.clip(background + rng.normal(0, noise, background.shape), 0, 255).astype(np.uint8)
+                            for _ in range(4)]
+
+        size = max(8, height // 10)
+        self.sizes = rng.integers(size, 2 * size, size=(objects, 2))
+        self.positions = rng.uniform([0, 0], [width - 2 * size, height - 2 * size], size=(objects, 2))
+        angles = rng.uniform(0, 2 * np.pi, size=objects)
+        self.velocities = np.stack([np.cos(angles), np.sin(angles)], axis=1) * speed * width
+        self.index = 0
+
+    def moving(self, index):
+        """
+        Returns True if the objects move in the frame with the given index.
+        """
+        return index % self.cycle_frames < self.motion_density * self.cycle_frames
+
+    def next_frame(self):
+        """
+        Returns the next frame.
+        """
+        if self.moving(self.index):
+            self.positions += self.velocities
+            limits = np.array([self.width, self.height]) - self.sizes
+            bounced = (self.positions < 0) | (self.positions > limits)
+            self.velocities[bounced] *= -1
+            self.positions = np.clip(self.positions, 0, limits)
+
+        frame = self.backgrounds[self.index % len(self.backgrounds)].copy()
+        for i, ((x, y), (w, h)) in enumerate(zip(self.positions.astype(int), self.sizes)):
+            cv2.rectangle(frame, (x, y), (x + w, y + h), COLORS[i % len(COLORS)], -1)
+        self.index += 1
+        return frame
+
+
+def generate_video(path, seconds=30, **scene_args):
+    """
+    Write a synthetic video file.
+
+    Args:
+        path (str): The path of the video to write.
+        seconds (float): The length of the video.
+        **scene_args: Passed on to SyntheticScene.
+
+    Returns:
+        int: The number of frames written.
+    """
+    scene = SyntheticScene(**scene_args)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), scene.fps, (scene.width, scene.height))
+    frames = int(seconds * scene.fps)
+    for _ in range(frames):
+        writer.write(scene.next_frame())
+    writer.release()
+    return frames
+
+
+class SyntheticCapture:
+    """
+    A stand-in for detection's VideoCapture that serves synthetic frames at the stream's frame rate.
+
+    Each frame has its capture index stamped into its first pixels, so the time it takes to reach the end
+    of the pipeline can be measured. The capture closes after the given number of seconds.
+
+    Args:
+        seconds: How long the stream runs.
+        **scene_args: Passed on to SyntheticScene.
+    """
+
+    def __init__(self, seconds=30, **scene_args):
+        self.scene = SyntheticScene(**scene_args)
+        self.rtsp_url = "synthetic://bench"
+        self.frames = int(seconds * self.scene.fps)
+        self.captured_at = []
+        self.opened = True
+        self.start = None
+
+    def get_h(self):
+        return self.scene.height
+
+    def get_w(self):
+        return self.scene.width
+
+    def get_fps(self):
+        return self.scene.fps
+
+    def isOpened(self):
+        return self.opened
+
+    def read(self):
+        if self.start is None:
+            self.start = time.monotonic()
+        index = len(self.captured_at)
+        if index >= self.frames:
+            self.opened = False
+            return False, None
+        # Pace the stream like a camera would
+        delay = self.start + index / self.scene.fps - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        frame = self.scene.next_frame()
+        stamp(frame, index)
+        self.captured_at.append(time.monotonic())
+        return True, frame
+
+    def read_pair(self):
+        success, frame = self.read()
+        return success, frame, frame
+
+    def release(self):
+        self.opened = False
+
+
+def stamp(frame, index):
+    """
+    Write a frame index into the first four pixels of a frame.
+    """
+    frame[0, :4, 0] = np.frombuffer(np.uint32(index).tobytes(), dtype=np.uint8)
+
+
+def read_stamp(frame):
+    """
+    Returns the frame index written by stamp.
+    """
+    return int(np.frombuffer(frame[0, :4, 0].tobytes(), dtype=np.uint32)[0])
@@ -7,41 +7,85 @@ import multiprocessing
 import signal
 import threading
 import time
-import queue
 import zoneinfo
 import heapq
 from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import numpy as np
-from ultralytics import YOLO
 from ultralytics.utils.plotting import Annotator, colors
-from collections import defaultdict
 import file_manager
 import config
-
-
-def track_history_default():
-    return []
+from model_pool import ModelPool
+from frame_ring import FrameRingBuffer
+from track_store import TrackStore
+from video_capture import Stream, downscale
+from metrics import camera_name
+
+
+def capture_frames(rtsp_url, frame_ring, stop_event):
+    """
+    Capture frames from an RTSP stream straight into the slots of a shared memory ring buffer.
+
+    Runs in its own process. Frames that arrive while every slot is still being processed are dropped. The
+    stream reconnects with backoff when it fails or stalls, see video_capture.Stream.
+
+    Args:
+        rtsp_url (str): The RTSP URL of the IP camera stream.
+        frame_ring (FrameRingBuffer): The ring buffer to write frames into.
+        stop_event: Event that stops the capture when set.
+
+    Returns:
+        None
+    """
+    stream = Stream(rtsp_url, stop_event, config.CAPTURE_STALL_TIMEOUT, config.RECONNECT_BACKOFF,
+                    config.RECONNECT_MAX_BACKOFF, camera_name(rtsp_url))
+    if not stream.open():
+        return
+
+    dropped = 0
+    while not stop_event.is_set():
+        slot = frame_ring.reserve(timeout=0.1)
+        if slot is None:
+            # Keep the stream moving so the next frame we read is a fresh one
+            stream.cap.grab()
+            dropped += 1
+            if dropped % 100 == 0:
+                print(f"Frame ring is full, dropped {dropped} frames")
+            continue
+        # Only fails once stop_event is set, failed reads are retried and reconnected by the stream
+        success, frame = stream.read(frame_ring.frames[slot])
+        if not success:
+            frame_ring.release(slot)
+            break
+        if not np.shares_memory(frame, frame_ring.frames[slot]):
+            # A reconnected stream can come back at a different resolution than the slots were sized for
+            h, w = frame_ring.frames[slot].shape[:2]
+            np.copyto(frame_ring.frames[slot], downscale(frame, (w, h)))
+        frame_ring.commit(slot)
+    stream.release()
 
 
 class MotionDetector:
 
     def __init__(self, rtsp_url, movement_threshold, delay_time, video_dir, model_name="yolov8n.pt",
-                 file_manager=None):
+                 file_manager=None, model_pool=None):
         """
         Args:
             rtsp_url (str): The RTSP URL of the IP camera stream.
             movement_threshold (int): The threshold for detecting movement in consecutive frames.
             delay_time (int): The delay time in seconds before ending recording.
+            model_pool (ModelPool): The pool of preloaded models. One is created if not given.
 
         Returns:
             None
         """
         self.cap = None
-        self.track_history = defaultdict(track_history_default)
-        self.model = YOLO(model_name)
-        self.names = self.model.names
+        self.track_history = TrackStore()
+        self.model_pool = model_pool or ModelPool(model_name, config.MODEL_POOL_SIZE, backend=config.MODEL_BACKEND,
+                                                  int8=config.MODEL_INT8, cache_dir=config.MODEL_CACHE_DIR,
+                                                  threads=config.INFERENCE_THREADS)
+        self.names = self.model_pool.names
         self.model_name = model_name
 
         self.rtsp_url = rtsp_url
@@ -49,7 +93,8 @@ class MotionDetector:
                                               multiprocessing.Value('i', 0),
                                               multiprocessing.Value('i', 0))
 
-        self.frame_queue = queue.Queue(maxsize=120)
+        self.frame_ring = None
+        self.stop_event = multiprocessing.Event()
 
         self.video_dir = video_dir
         self.recording = False
@@ -70,184 +115,157 @@ class MotionDetector:
         """
         Runs the camera object detection process.
 
-        Initializes processes for getting frames, processing frames, and cleaning up files.
-        Starts threads for processing frames, getting frames, and cleaning up files.
-        Terminates processes on KeyboardInterrupt and closes OpenCV windows.
+        Starts a separate process that captures frames into a shared memory ring buffer, and the file
+        manager's background cleanup, then processes frames from the ring buffer in this process.
+        Terminates the capture process on exit and closes OpenCV windows.
         """
 
         print("Initializing processes...")
-        # get_frame_process = multiprocessing.Process(target=self.get_frame, daemon=True)
-        # process_frame_process = multiprocessing.Process(target=self.process_frame, daemon=True)
-        # file_manager_process = threading.Thread(target=self.file_manager.cleanup_files, daemon=True)
+        if not self.probe_stream():
+            return
+        self.frame_ring = FrameRingBuffer((self.h_high.value, self.w_high.value, 3), config.FRAME_RING_SLOTS)
+        get_frame_process = multiprocessing.Process(target=capture_frames,
+                                                    args=(self.rtsp_url, self.frame_ring, self.stop_event),
+                                                    daemon=True)
+        get_frame_process.start()
 
-        # process_frame_process.start()
-        # get_frame_process.start()
-        # file_manager_process.start()
-        self.get_frame()
-        file_manager_thread = threading.Thread(target=self.file_manager.cleanup_files)
-
-        file_manager_thread.start()
-        self.process_frame()
+        self.file_manager.start()
 
         try:
-            file_manager_thread.join()
+            self.process_frame()
         except KeyboardInterrupt:
-            file_manager_thread.join()
-        # try:
-        #     get_frame_process.join()
-        #     process_frame_process.join()
-        #     file_manager_process.join()
-        # except KeyboardInterrupt:
-        #     get_frame_process.terminate()
-        #     process_frame_process.terminate()
-        #     get_frame_process.join()
-        #     process_frame_process.join()
+            pass
+        finally:
+            self.file_manager.stop()
+            self.stop_event.set()
+            get_frame_process.join(timeout=5)
+            self.frame_ring.close()
 
         cv2.destroyAllWindows()
 
-    def get_frame(self):
+    def probe_stream(self):
         """
-        Capture frames from an RTSP stream and put them into a frame queue.
+        Read the resolution and frame rate of the RTSP stream, retrying with backoff until it opens.
 
         Returns:
-            None
+            bool: True once the stream was probed, False if stop_event was set first.
         """
-        cap = cv2.VideoCapture(self.rtsp_url)
-        assert cap.isOpened(), f"Failed to open {self.rtsp_url}"
-
-        if self.h_high.value == 0:
-            w_high, h_high, fps = (int(cap.get(x)) for x in
-                                   (cv2.CAP_PROP_FRAME_WIDTH,
-                                    cv2.CAP_PROP_FRAME_HEIGHT,
-                                    cv2.CAP_PROP_FPS))
-            with self.h_high.get_lock():
-                self.h_high.value = h_high
-            with self.w_high.get_lock():
-                self.w_high.value = w_high
-            with self.fps.get_lock():
-                self.fps.value = fps
-
-        while cap.isOpened():
-            success, frame_high_quality = cap.read()
-            if success:
-                self.frame_queue.put(frame_high_quality)
+        stream = Stream(self.rtsp_url, self.stop_event, config.CAPTURE_STALL_TIMEOUT, config.RECONNECT_BACKOFF,
+                        config.RECONNECT_MAX_BACKOFF, camera_name(self.rtsp_url), "probe")
+        if not stream.open():
+            return False
+
+        w_high, h_high, fps = (int(stream.cap.get(x)) for x in
+                               (cv2.CAP_PROP_FRAME_WIDTH,
+                                cv2.CAP_PROP_FRAME_HEIGHT,
+                                cv2.CAP_PROP_FPS))
+        stream.release()
+        with self.h_high.get_lock():
+            self.h_high.value = h_high
+        with self.w_high.get_lock():
+            self.w_high.value = w_high
+        with self.fps.get_lock():
+            self.fps.value = fps
+        return True
 
     def process_frame(self):
         """
-        Process a frame by tracking objects, handling tracking results, and writing frames if recording.
+        Process frames from the ring buffer by tracking objects, handling tracking results, and writing frames if
+        recording.
 
         Returns:
             None
         """
         self.lock = threading.Lock()
         print("Processing frames...")
-        # New
-        with ThreadPoolExecutor(max_workers=4) as executor:  # Adjust max_workers as needed
-            while True:
-                try:
-                    frame_high_quality = self.frame_queue.get()  # Added timeout for safety
-                    executor.submit(self.process_single_frame, frame_high_quality)
-                except queue.Empty:
-                    print("Queue empty")
+        with ThreadPoolExecutor(max_workers=self.model_pool.size) as executor:
+            while not self.stop_event.is_set():
+                item = self.frame_ring.read(timeout=1)
+                if item is None:
                     continue
+                slot, _, frame_high_quality = item
+                # Tickets are taken in frame order, so frames are tracked and written in capture order
+                executor.submit(self.process_single_frame, slot, frame_high_quality,
+                                self.model_pool.ticket(self.rtsp_url))
 
-        # Old
-        # while True:
-        #     try:
-        #         start_time = time.time()
-        #         frame_high_quality = self.frame_queue.get()
-        #         results = self.model.track(frame_high_quality, persist=True, verbose=False)
-        #         self.handle_tracking(frame_high_quality, results)
-        #         if self.recording:
-        #             self.write_frame(frame_high_quality)
-        #         print(f"Frame Processing Time: {time.time() - start_time} seconds")
-        #     except queue.Empty:
-        #         print("Queue empty")
-        #         continue
-
-    def process_single_frame(self, frame_high_quality):
+    def process_single_frame(self, slot, frame_high_quality, ticket=None):
         """
         Process a single frame by tracking objects, handling tracking results, and writing frames if recording.
 
+        Tracking and writing happen while the model is checked out with the frame's ticket. Checkouts of a
+        stream are served in ticket order, so the track history, the stop timer and the clip see the frames in
+        capture order, one at a time, whichever executor thread runs them.
+
         Args:
-            frame_high_quality: The high-quality frame to process.
+            slot: The ring buffer slot holding the frame, released once the frame is processed.
+            frame_high_quality: The high-quality frame to process, a view into the ring buffer.
+            ticket: The stream's model pool ticket, taken when the frame was submitted.
 
         Returns:
             None
         """
-        model = YOLO(self.model_name)
-        results = model.track(frame_high_quality, persist=True, verbose=False)
-        self.handle_tracking(frame_high_quality, results)
-        if self.recording:
-            self.write_frame(frame_high_quality)
+        try:
+            # The ticket is used before anything can fail, so later frames never wait for it
+            with self.model_pool.model(self.rtsp_url, ticket) as model:
+                # Detect on a downscaled copy, the high-quality frame is what gets recorded
+                frame_detect = frame_high_quality
+                if 0 < config.DETECT_WIDTH < self.w_high.value:
+                    frame_detect = downscale(frame_high_quality, (config.DETECT_WIDTH,
+                                                                  round(self.h_high.value * config.DETECT_WIDTH
+                                                                        / self.w_high.value)))
+                results = model.track(frame_detect, persist=True, verbose=False)
+                self.handle_tracking(frame_high_quality, results)
+                if self.recording:
+                    self.write_frame(frame_high_quality)
+        finally:
+            self.frame_ring.release(slot)
 
     def handle_tracking(self, frame, results):
         """
         Handle tracking results by annotating the frame with object labels and colors,
-        storing tracking history, and plotting tracks if sufficient history is available.
+        storing tracking history, and plotting tracks once per frame.
 
         Args:
             frame: The frame to annotate.
-            results: The tracking results to process.
+            results: The tracking results to process, scaled up to the frame if they come from a smaller copy.
 
         Returns:
             None
         """
-        boxes = results[0].boxes.xyxy.cpu()
+        track_ids, centers = [], None
         if results[0].boxes.id is not None:
             # Extract prediction results
+            boxes = results[0].boxes.xyxy.cpu().numpy()
+            detect_h, detect_w = results[0].orig_shape[:2]
+            if (detect_h, detect_w) != frame.shape[:2]:
+                boxes = boxes * np.tile((frame.shape[1] / detect_w, frame.shape[0] / detect_h), 2)
             clss = results[0].boxes.cls.cpu().tolist()
             track_ids = results[0].boxes.id.int().cpu().tolist()
 
             # Annotator Init
             annotator = Annotator(frame, line_width=2)
 
-            for box, cls, track_id in zip(boxes, clss, track_ids):
+            for box, cls in zip(boxes, clss):
                 annotator.box_label(box, color=colors(int(cls), True), label=self.names[int(cls)])
+            centers = (boxes[:, :2] + boxes[:, 2:4]) / 2
 
-                # Store tracking history
-                self.track_movement_history(track_id, box)
-
-                if len(self.track_history[track_id]) >= 2:
-                    self.plot_tracks(track_id)
+        # Store tracking history, frames without tracks still update it so tracks that disappeared age out
+        displacements = self.track_history.update(track_ids, centers)
+        # Frames without moving tracks count as still, so a clip stops once the scene empties
+        self.plot_tracks(displacements)
 
-    def track_movement_history(self, track_id, box):
+    def plot_tracks(self, displacements):
         """
-        Tracks the movement history of an object identified by track_id.
+        Start or stop recording based on how far the tracks in a frame moved since their previous points.
 
         Args:
-            track_id (int): The unique identifier of the tracked object.
-            box (tuple): The bounding box coordinates of the object.
-
-        Returns:
-            list: The updated movement history of the tracked object.
-        """
-        # Store tracking history
-        track = self.track_history[track_id]
-        current_position = (int((box[0] + box[2]) / 2), int((box[1] + box[3]) / 2))
-        track.append(current_position)
-        if len(track) > 30:
-            track.pop(0)
-        return track
-
-    def plot_tracks(self, track_id):
-        """
-        Calculate displacement between previous and current track centers,
-        start or stop recording based on movement threshold and recording status.
-
-        Args:
-            track_id: The identifier of the track to process.
+            displacements: The displacement of each track that has a previous point, empty if none has.
 
         Returns:
             None
         """
-        prev_center = self.track_history[track_id][-2]
-        current_center = self.track_history[track_id][-1]
-        displacement = np.sqrt(
-            (prev_center[0] - current_center[0]) ** 2 + (prev_center[1] - current_center[1]) ** 2)
-
         # Plot tracks if sufficient movement
-        if displacement > self.movement_threshold and not self.recording:
+        if (displacements > self.movement_threshold).any() and not self.recording:
             self.start_recording()
 
         if self.recording:
@@ -338,7 +356,8 @@ if __name__ == "__main__":
 
     # Clean up video files older than 7 days
     days_threshold = 7
-    file_manager = file_manager.FileManager(video_dir, days_threshold)
+    file_manager = file_manager.FileManager(video_dir, days_threshold, config.VIDEO_QUOTA_MB * 1024 * 1024,
+                                            config.CLEANUP_INTERVAL)
 
     print("Creating Motion Detector")
     motion_detector = MotionDetector(url, movement_threshold, delay_time, video_dir, model_name,
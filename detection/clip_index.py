@@ -0,0 +1,196 @@
+import os
+import sqlite3
+import threading
+
+import cv2
+
+
+class ClipRecord:
+    """
+    What the detector saw during one clip, collected while it is recorded.
+
+    Args:
+        path: The path of the clip.
+        camera: The camera the clip is from.
+        source: The stream or source file the clip was recorded from.
+        start_time: Unix time the clip starts at, None if unknown.
+        source_offset: Seconds into the source file the clip starts at, for clips cut from recorded segments.
+    """
+
+    def __init__(self, path=None, camera="", source="", start_time=None, source_offset=None):
+        self.path = path
+        self.camera = camera
+        self.source = source
+        self.start_time = start_time
+        # Set when recording stops
+        self.end_time = None
+        self.source_offset = source_offset
+        self.classes = set()
+        self.track_ids = set()
+        self.peak_displacement = 0.0
+
+    def observe(self, classes, track_ids, displacements):
+        """
+        Add the detections of a frame.
+
+        Args:
+            classes: The class names detected in the frame.
+            track_ids: The ids of the tracks in the frame.
+            displacements: How far each track moved since its previous point, in pixels.
+        """
+        self.classes.update(classes)
+        self.track_ids.update(track_ids)
+        if len(displacements):
+            self.peak_displacement = max(self.peak_displacement, float(max(displacements)))
+
+
+class ClipIndex:
+    """
+    A SQLite index of finished clips and what was detected in them.
+
+    Initializes the ClipIndex by opening, or creating, the database. Each clip gets a row with its file
+    path, size, duration, resolution, start and end time, source and camera, along with the classes that
+    appeared, the number of tracks and the largest displacement of a track between two frames. Classes are
+    also kept one row per clip and class, so clips can be looked up by class and time with an index instead
+    of walking directories and opening video files. The database is in WAL mode, so several pipelines or
+    worker processes can add clips while it is being read.
+
+    Args:
+        db_file: The path of the database file.
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        directory = os.path.dirname(db_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(db_file, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS clips (
+                path TEXT PRIMARY KEY,
+                camera TEXT,
+                source TEXT,
+                start_time REAL,
+                end_time REAL,
+                source_offset REAL,
+                duration REAL,
+                width INTEGER,
+                height INTEGER,
+                size INTEGER,
+                classes TEXT,
+                track_count INTEGER,
+                peak_displacement REAL
+            );
+            CREATE INDEX IF NOT EXISTS clips_start_time ON clips (start_time);
+            CREATE INDEX IF NOT EXISTS clips_camera ON clips (camera, start_time);
+            CREATE TABLE IF NOT EXISTS clip_classes (
+                class TEXT,
+                path TEXT,
+                PRIMARY KEY (class, path)
+            ) WITHOUT ROWID;
+        ''')
+        self.conn.commit()
+
+    def add(self, record):
+        """
+        Add a finished clip, reading its size, duration and resolution from the file.
+
+        Args:
+            record (ClipRecord): The clip's metadata.
+        """
+        path = os.path.abspath(record.path)
+        duration, width, height = probe(path)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = None
+        end_time = record.end_time
+        start_time = record.start_time
+        if duration is not None:
+            # Clips closed at the end of their source only know when they start, and vice versa
+            if start_time is None and end_time is not None:
+                start_time = end_time - duration
+            elif end_time is None and start_time is not None:
+                end_time = start_time + duration
+        classes = sorted(record.classes)
+
+        with self.lock:
+            self.conn.execute('DELETE FROM clip_classes WHERE path = ?', (path,))
+            self.conn.execute('INSERT OR REPLACE INTO clips (path, camera, source, start_time, end_time, '
+                              'source_offset, duration, width, height, size, classes, track_count, '
+                              'peak_displacement) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                              (path, record.camera, record.source, start_time, end_time, record.source_offset,
+                               duration, width, height, size, ",".join(classes), len(record.track_ids),
+                               record.peak_displacement))
+            self.conn.executemany('INSERT INTO clip_classes (class, path) VALUES (?, ?)',
+                                  [(name, path) for name in classes])
+            self.conn.commit()
+
+    def remove(self, path):
+        """
+        Remove a clip, e.g. once retention has deleted it.
+
+        Args:
+            path: The path of the clip.
+        """
+        path = os.path.abspath(path)
+        with self.lock:
+            self.conn.execute('DELETE FROM clip_classes WHERE path = ?', (path,))
+            self.conn.execute('DELETE FROM clips WHERE path = ?', (path,))
+            self.conn.commit()
+
+    def find(self, class_name=None, start=None, end=None, camera=None):
+        """
+        Look up clips, oldest first.
+
+        Args:
+            class_name: Only clips in which this class appeared.
+            start: Only clips that start at or after this Unix time.
+            end: Only clips that start before this Unix time.
+            camera: Only clips from this camera.
+
+        Returns:
+            list: A dict of the indexed metadata of each clip.
+        """
+        query = 'SELECT clips.* FROM clips'
+        conditions, params = [], []
+        if class_name is not None:
+            query += ' JOIN clip_classes ON clip_classes.path = clips.path AND clip_classes.class = ?'
+            params.append(class_name)
+        for condition, value in (('clips.start_time >= ?', start), ('clips.start_time < ?', end),
+                                 ('clips.camera = ?', camera)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY clips.start_time'
+        with self.lock:
+            return [dict(row) for row in self.conn.execute(query, params).fetchall()]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def probe(path):
+    """
+    Read the duration and resolution of a video file from its header.
+
+    Returns:
+        tuple: The duration in seconds, width and height, None for values that cannot be read.
+    """
+    cap = cv2.VideoCapture(path)
+    try:
+        if not cap.isOpened():
+            return None, None, None
+        frames = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        duration = round(frames / fps, 3) if frames > 0 and fps > 0 else None
+        return duration, int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    finally:
+        cap.release()
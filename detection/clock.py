@@ -0,0 +1,70 @@
+import time
+
+import cv2
+
+
+class WallClock:
+    """
+    Wall-clock time, for live streams where frames arrive as they happen.
+    """
+
+    def now(self):
+        """
+        Returns the current time in seconds.
+        """
+        return time.monotonic()
+
+    def advance(self, position):
+        """
+        Ignored, wall-clock time moves on by itself.
+        """
+
+    def reset(self):
+        pass
+
+
+class MediaClock:
+    """
+    Time inside the video being processed, for files that can be processed faster or slower than real time.
+
+    The pipeline advances the clock to each frame's timestamp, so delays measured with it depend on the
+    video and not on how fast the machine gets through it.
+    """
+
+    def __init__(self):
+        self.position = 0.0
+
+    def now(self):
+        """
+        Returns the timestamp of the current frame in seconds.
+        """
+        return self.position
+
+    def advance(self, position):
+        """
+        Move the clock to a frame's timestamp.
+
+        Args:
+            position (float): Seconds into the video.
+        """
+        self.position = position
+
+    def reset(self):
+        self.position = 0.0
+
+
+def frame_time(cap, frame_index, fps):
+    """
+    Returns the timestamp of the frame that was last grabbed from a capture, in seconds.
+
+    Uses the container's timestamp when the backend reports one and falls back to the frame index.
+
+    Args:
+        cap: The cv2.VideoCapture the frame was grabbed from.
+        frame_index (int): The index of the frame.
+        fps (float): Frames per second of the video.
+    """
+    msec = cap.get(cv2.CAP_PROP_POS_MSEC)
+    if msec > 0:
+        return msec / 1000
+    return frame_index / fps
@@ -1,12 +1,72 @@
 from os import getenv, makedirs
-from config_utils import get_env_list
+from config_utils import get_env_list, get_env_bool, get_env_coords
 
 RTSP_URL = getenv("RTSP_URL")
 RTSP_CAM_NAME = get_env_list(getenv("RTSP_CAM_NAME"))
+CAMERA_RESTART_DELAY = int(getenv("CAMERA_RESTART_DELAY", 5))
+# Seconds without a frame before a stream is reopened, and the first and longest wait between reconnect attempts
+CAPTURE_STALL_TIMEOUT = float(getenv("CAPTURE_STALL_TIMEOUT", 10))
+RECONNECT_BACKOFF = float(getenv("RECONNECT_BACKOFF", 1))
+RECONNECT_MAX_BACKOFF = float(getenv("RECONNECT_MAX_BACKOFF", 60))
+# Detection runs on a low-resolution copy of each frame while clips are recorded from the full resolution stream.
+# DETECT_STREAM_SUFFIX is appended to a camera's URL to get its substream, e.g. "-sub" for wyze-bridge. Without a
+# substream, frames are downscaled to DETECT_WIDTH, 0 detects on the full resolution frames.
+DETECT_STREAM_SUFFIX = getenv("DETECT_STREAM_SUFFIX", "")
+DETECT_WIDTH = int(getenv("DETECT_WIDTH", 0))
+# Milliseconds a substream frame may be apart from the main stream frame it is paired with
+DETECT_MAX_SKEW_MS = int(getenv("DETECT_MAX_SKEW_MS", 200))
+# Number of newest frames the detector keeps, so it never works through a backlog of old frames. Every frame is
+# still recorded. 0 detects on every frame in order. Frames older than MAX_FRAME_AGE_MS are skipped, keep it
+# below PRE_ROLL_SECONDS so clips still start before the detection.
+LATEST_FRAMES = int(getenv("LATEST_FRAMES", 0))
+MAX_FRAME_AGE_MS = int(getenv("MAX_FRAME_AGE_MS", 1000))
+# Frames the threaded pipeline queues for the detector when LATEST_FRAMES is 0, about 6 MB each at 1080p. Frames
+# that arrive while it is full are dropped, keep it above INFERENCE_BATCH_SIZE so a batch can fill.
+FRAME_QUEUE_SIZE = int(getenv("FRAME_QUEUE_SIZE", 8))
 MODEL_NAME = getenv("MODEL_NAME", "yolov8n.pt")
+MODEL_POOL_SIZE = int(getenv("MODEL_POOL_SIZE", 1))
+# Inference backend: "torch" runs the PyTorch weights, "onnx" exports them once to MODEL_CACHE_DIR and runs
+# them with ONNX Runtime. MODEL_INT8 quantizes the ONNX model's weights to int8.
+MODEL_BACKEND = getenv("MODEL_BACKEND", "torch")
+MODEL_INT8 = get_env_bool(getenv("MODEL_INT8"), False)
+MODEL_CACHE_DIR = getenv("MODEL_CACHE_DIR", "models")
+# ONNX Runtime threads per model instance, 0 splits the available cores between the instances
+INFERENCE_THREADS = int(getenv("INFERENCE_THREADS", 0))
+INFERENCE_BATCH_SIZE = int(getenv("INFERENCE_BATCH_SIZE", 4))
+INFERENCE_BATCH_WAIT_MS = int(getenv("INFERENCE_BATCH_WAIT_MS", 50))
+FRAME_RING_SLOTS = int(getenv("FRAME_RING_SLOTS", 16))
 MOVEMENT_THRESHOLD = int(getenv("MOVEMENT_THRESHOLD", 15))
 DELAY_TIME = int(getenv("DELAY_TIME", 10))
+# Seconds of video before the detection to include in each clip, capped at PRE_ROLL_MAX_MB of frames
+PRE_ROLL_SECONDS = float(getenv("PRE_ROLL_SECONDS", 2))
+PRE_ROLL_MAX_MB = int(getenv("PRE_ROLL_MAX_MB", 256))
+# Frames that can wait for the background encoder, 0 encodes on the calling thread.
+# ENCODER_OVERFLOW is one of block, drop-oldest or drop-newest.
+ENCODER_QUEUE_SIZE = int(getenv("ENCODER_QUEUE_SIZE", 30))
+ENCODER_OVERFLOW = getenv("ENCODER_OVERFLOW", "block")
+
+# Skip inference on frames without pixel motion outside the mask. Off by default, objects changing less than
+# MOTION_MIN_AREA of the frame, e.g. slow or distant movers, never reach the tracker while it is on.
+MOTION_GATE = get_env_bool(getenv("MOTION_GATE"), False)
+MOTION_MIN_AREA = float(getenv("MOTION_MIN_AREA", 0.002))
+MOTION_COOLDOWN = float(getenv("MOTION_COOLDOWN", 5))
 
 DAY_THRESHOLD = int(getenv("DAY_THRESHOLD", 7))
+# Size quota of VIDEO_DIR in MB, the oldest clips are deleted beyond it. 0 only deletes clips by age.
+VIDEO_QUOTA_MB = int(getenv("VIDEO_QUOTA_MB", 0))
+# Seconds between retention cycles
+CLEANUP_INTERVAL = int(getenv("CLEANUP_INTERVAL", 300))
+
+# Port of the Prometheus metrics endpoint at /metrics, 0 disables it
+METRICS_PORT = int(getenv("METRICS_PORT", 9108))
+METRICS_HOST = getenv("METRICS_HOST", "0.0.0.0")
+
+VIDEO_DIR = getenv("VIDEO_DIR", "videos")
+# SQLite index of the recorded clips and what was detected in them, empty disables it. Kept outside VIDEO_DIR,
+# which is often a network share: SQLite's WAL mode needs a local disk
+CLIP_INDEX_DB = getenv("CLIP_INDEX_DB", "/app/data/clips.db")
 
-VIDEO_DIR = getenv("VIDEO_DIR", "videos")
\ No newline at end of file
+# Resolution MASK_COORDS are drawn at, the mask is scaled to each stream's resolution
+MASK_RESOLUTION = tuple(int(v) for v in getenv("MASK_RESOLUTION", "1920x1080").split("x"))
+# Polygon, in MASK_RESOLUTION coordinates, of the region to ignore. Use recorder/mask_coords.py to pick the points.
+MASK_COORDS = get_env_coords(getenv("MASK_COORDS"))
@@ -1,38 +1,232 @@
+import heapq
 import os
+import threading
 import time
 
+from metrics import ARCHIVE_BYTES, CLIPS_DELETED
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov')
+
 
 class FileManager:
-    def __init__(self, video_directory, days_threshold):
+    """
+    A retention engine that keeps the clip archive within an age limit and a size quota.
+
+    Initializes the FileManager with the retention limits. Clips are kept in an index of their size and
+    modification time, built by one full scan of video_directory and then kept up to date incrementally:
+    each cycle only lists the directories whose mtime changed, and reaches the others through their known
+    subdirectories, so new clips in the current YYYY/MM/DD directory cost one listing. Clips that were
+    still growing when they were listed are stat'ed again until their size settles.
+
+    Every cycle deletes the clips older than days_threshold, then the oldest clips until the archive fits
+    in max_bytes, and removes the date directories that are left empty. Directories that were already
+    empty are removed once they are a day old, so a directory the writer just created is left alone.
+
+    Args:
+        video_directory: Directory where the clips are stored, in YYYY/MM/DD subdirectories at any depth.
+        days_threshold: Days a clip is kept. 0 keeps clips regardless of age.
+        max_bytes: The size quota of the archive in bytes. 0 disables the quota.
+        interval: Seconds between cleanup cycles when running in the background.
+        clip_index (ClipIndex): The clip index deleted or vanished clips are removed from, if clips are indexed.
+    """
+
+    def __init__(self, video_directory, days_threshold, max_bytes=0, interval=300, clip_index=None):
         # Directory where the video files are stored
-        self.video_dir = video_directory
+        self.video_dir = os.path.abspath(video_directory)
         self.days_threshold = days_threshold
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.clip_index = clip_index
+
+        # directory -> (mtime, subdirectories, clips) as of its last listing
+        self.dirs = {}
+        # clip -> (mtime, size)
+        self.clips = {}
+        # (mtime, clip) of every indexed clip, oldest first. Entries whose clip was deleted or changed are
+        # skipped when they reach the top.
+        self.heap = []
+        self.growing = set()
+        self.total_size = 0
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """
+        Run cleanup cycles on a background thread, the first one straight away.
+        """
+        self.thread = threading.Thread(target=self.run, name="file-manager", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread after its current cycle.
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        """
+        Run cleanup cycles every interval seconds until stopped.
+        """
+        while not self.stop_event.is_set():
+            try:
+                self.cleanup_files()
+            except Exception as e:
+                print(f"Cleanup failed: {e}")
+            self.stop_event.wait(self.interval)
 
     def cleanup_files(self):
-        total_size = 0
-        files_to_delete = []
-
-        # Calculate total size and identify files to delete based on days threshold
-        for file in os.listdir(self.video_dir):
-            file_path = os.path.join(self.video_dir, file)
-            file_creation_time = os.path.getctime(file_path)
-            if time.time() - file_creation_time > self.days_threshold * 24 * 3600:
-                if (os.path.isfile(file_path) and os.path.splitext(file_path)[1] in ['.mp4', '.avi', '.mov']) or \
-                        (os.path.isdir(file_path) and os.path.commonpath(
-                            [self.video_dir, file_path]) != self.video_dir):
-                    files_to_delete.append(file)
-                total_size += os.path.getsize(file_path)
-
-        # Delete files based on space threshold if total size exceeds the threshold
-        while files_to_delete:
-            file = files_to_delete.pop(0)
-            file_path = os.path.join(self.video_dir, file)
-            total_size -= os.path.getsize(file_path)
-            if os.path.isfile(file_path):
-                os.remove(file_path)
-                print(f"Deleted: {file}")
-            elif os.path.isdir(file_path):
-                os.rmdir(file_path)
-                print(f"Deleted: {file}")
-
-        print("Cleanup completed.")
+        """
+        Bring the index up to date and delete clips until the archive is within its limits.
+        """
+        self.scan()
+        deleted = self.enforce()
+        ARCHIVE_BYTES.labels().set(self.total_size)
+        if deleted:
+            print(f"Cleanup deleted {deleted} clip(s), {len(self.clips)} clip(s) of "
+                  f"{self.total_size / 1024 ** 2:.1f} MB left")
+
+    def scan(self):
+        """
+        Update the index from the directories that changed since the last scan.
+        """
+        visited = set()
+        stack = [self.video_dir]
+        while stack:
+            directory = stack.pop()
+            try:
+                mtime = os.stat(directory).st_mtime
+            except OSError:
+                continue
+            visited.add(directory)
+
+            known = self.dirs.get(directory)
+            if known is not None and known[0] == mtime:
+                stack.extend(known[1])
+                continue
+
+            subdirs, files = [], set()
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        elif entry.name.endswith(VIDEO_EXTENSIONS):
+                            files.add(entry.path)
+            except OSError:
+                continue
+            if not subdirs and not files and directory != self.video_dir and time.time() - mtime > 24 * 3600:
+                self._prune(directory)
+                continue
+            stack.extend(subdirs)
+
+            for clip in (known[2] if known else set()) - files:
+                self._forget(clip)
+            for clip in files - (known[2] if known else set()):
+                self._index(clip)
+            self.dirs[directory] = (mtime, subdirs, files)
+
+        # Every directory that still exists is reached, through its parent's listing or its known subdirectories
+        for directory in [path for path in self.dirs if path not in visited]:
+            for clip in self.dirs.pop(directory)[2]:
+                self._forget(clip)
+
+        for clip in list(self.growing):
+            self._index(clip)
+
+    def _index(self, clip):
+        """
+        Add a clip to the index, or update its size and mtime.
+        """
+        try:
+            stat = os.stat(clip)
+        except OSError:
+            self._forget(clip)
+            return
+        previous = self.clips.get(clip)
+        if previous is not None:
+            self.total_size -= previous[1]
+            if previous == (stat.st_mtime, stat.st_size):
+                self.growing.discard(clip)
+        elif time.time() - stat.st_mtime < 2 * max(self.interval, 60):
+            # A recent clip may still be being written, it is checked again next cycle
+            self.growing.add(clip)
+        self.clips[clip] = (stat.st_mtime, stat.st_size)
+        self.total_size += stat.st_size
+        if previous is None or previous[0] != stat.st_mtime:
+            heapq.heappush(self.heap, (stat.st_mtime, clip))
+
+    def _forget(self, clip):
+        """
+        Remove a clip that was deleted or disappeared from the index, and from the clip index.
+        """
+        entry = self.clips.pop(clip, None)
+        if entry is not None:
+            self.total_size -= entry[1]
+        self.growing.discard(clip)
+        if self.clip_index is not None:
+            self.clip_index.remove(clip)
+
+    def enforce(self):
+        """
+        Delete clips, oldest first, while they are older than days_threshold or the archive is over max_bytes.
+
+        Returns:
+            int: The number of clips deleted.
+        """
+        cutoff = time.time() - self.days_threshold * 24 * 3600 if self.days_threshold else None
+        deleted = 0
+        skipped = []
+        while self.heap:
+            mtime, clip = self.heap[0]
+            if self.clips.get(clip, (None,))[0] != mtime:
+                heapq.heappop(self.heap)
+                continue
+            if cutoff is not None and mtime < cutoff:
+                reason = "age"
+            elif self.max_bytes and self.total_size > self.max_bytes:
+                reason = "quota"
+            else:
+                break
+            heapq.heappop(self.heap)
+            if clip in self.growing and reason == "quota":
+                # Never delete a clip that may still be recording to make room
+                skipped.append((mtime, clip))
+                continue
+            self._delete(clip)
+            CLIPS_DELETED.labels(reason).inc()
+            deleted += 1
+        for entry in skipped:
+            heapq.heappush(self.heap, entry)
+        return deleted
+
+    def _delete(self, clip):
+        """
+        Delete a clip, and its parent directories up to video_directory once they are empty.
+        """
+        try:
+            os.remove(clip)
+            print(f"Deleted: {clip}")
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Failed to delete {clip}: {e}")
+            return
+        self._forget(clip)
+        self._prune(os.path.dirname(clip))
+
+    def _prune(self, directory):
+        """
+        Remove a directory and its parents up to video_directory, as long as they are empty.
+        """
+        while directory != self.video_dir and directory.startswith(self.video_dir + os.sep):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                # Not empty, or already gone
+                break
+            self.dirs.pop(directory, None)
+            print(f"Deleted: {directory}")
+            directory = os.path.dirname(directory)
@@ -1,34 +1,64 @@
+import logging
+import queue
 import threading
 from concurrent.futures import ThreadPoolExecutor
-from ultralytics import YOLO
-import torch
 import time
 
+from metrics import STAGE_SECONDS, QUEUE_DEPTH, INFERENCE_FRAMES, INFERENCE_FPS, FRAME_AGE, RateMeter
+
 
 class FrameProcessor(threading.Thread):
     """
        A class for processing frames in a video stream.
 
-       Initializes the FrameProcessor object with necessary attributes.
+       Initializes the FrameProcessor object with necessary attributes. Frames are collected into
+       micro-batches of up to batch_size frames, waiting at most batch_wait_ms for a batch to fill,
+       and each batch is run through the model in a single forward pass. The model sees each frame's
+       detection frame, a smaller copy when the capture provides one, and the full resolution frame is
+       passed on with the results for recording. Batches can finish out of order when the pool has
+       several models, the results buffer hands them on in capture order.
 
        Args:
            cap: The video capture object.
-           frame_queue: The queue for storing frames.
-           results_queue: The queue for storing processing results.
-           queue_event: Event for queue synchronization.
+           frame_queue: The queue of (capture time, frame, detection frame) tuples to process.
+           results_buffer: The ReorderBuffer completed batches are put in.
+           model_pool: The pool of preloaded models used for inference.
+           stream_id: The identifier of the stream, used to keep its tracker state.
+           batch_size: The maximum number of frames per inference batch.
+           batch_wait_ms: The maximum time in milliseconds to wait for a batch to fill.
+           motion_gate: Optional pixel-motion pre-filter. Frames it gates skip inference and are passed on
+               with None results.
+           video_writer: The video writer, used to keep inference running while recording.
+           shutdown_flag: Event that stops the processing loop when set.
+           camera: The camera label of the processor's metrics.
     """
 
-    def __init__(self, cap, frame_queue, results_queue, queue_event, model_name):
+    def __init__(self, cap, frame_queue, results_buffer, model_pool, stream_id=None,
+                 batch_size=1, batch_wait_ms=0, motion_gate=None, video_writer=None, shutdown_flag=None, camera=""):
         super().__init__()
         self.cap = cap
         self.frame_queue = frame_queue
-        self.results_queue = results_queue
-        self.executor = ThreadPoolExecutor(max_workers=4)
-        self.queue_event = queue_event
-        self.frame_buffer = {}
+        self.results_buffer = results_buffer
+        self.executor = ThreadPoolExecutor(max_workers=model_pool.size)
+        # Batches are only collected while a model is free, so waiting frames stay in the frame queue, where
+        # they are dropped or superseded, instead of piling up in the executor
+        self.free_models = threading.Semaphore(model_pool.size)
         self.sequence_number = 0
-        self.model_name = model_name
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.model_pool = model_pool
+        self.stream_id = stream_id
+        self.batch_size = max(1, batch_size)
+        self.batch_wait = batch_wait_ms / 1000
+        self.motion_gate = motion_gate
+        self.video_writer = video_writer
+        self.shutdown_flag = shutdown_flag or threading.Event()
+
+        self.queue_wait_seconds = STAGE_SECONDS.labels(camera, "queue_wait")
+        self.inference_seconds = STAGE_SECONDS.labels(camera, "inference")
+        self.frame_queue_depth = QUEUE_DEPTH.labels(camera, "frames")
+        self.results_queue_depth = QUEUE_DEPTH.labels(camera, "results")
+        self.inference_frames = INFERENCE_FRAMES.labels(camera)
+        self.inference_fps = RateMeter(INFERENCE_FPS.labels(camera))
+        self.frame_age = FRAME_AGE.labels(camera)
 
     def run(self):
         """
@@ -40,46 +70,118 @@ class FrameProcessor(threading.Thread):
         Returns:
             None
         """
-        while self.cap.isOpened():
-            if not self.frame_queue.empty():
-                frame_high_quality = self.frame_queue.get()
-                self.sequence_number += 1
-                seq = self.sequence_number
-                future = self.executor.submit(self.process_single_frame, frame_high_quality)
-                future.add_done_callback(lambda fut: self.processing_done(fut, seq))
-            self.check_and_update_queue()
-            time.sleep(0.001)
-
-    def processing_done(self, future, sequence):
+        while self.cap.isOpened() and not self.shutdown_flag.is_set():
+            # Wait for room in the reorder window and for a free model before taking frames off the queue
+            seq = self.sequence_number + 1
+            if not self.results_buffer.reserve(seq, timeout=0.5):
+                continue
+            if not self.free_models.acquire(timeout=0.1):
+                continue
+            frames = self.collect_batch()
+            if not frames:
+                self.free_models.release()
+                continue
+            self.sequence_number = seq
+            wake = self.gate_batch(frames)
+            # The ticket is taken here, in capture order, so batches of this stream reach the tracker state in order
+            # whichever executor thread gets to the pool first
+            ticket = self.model_pool.ticket(self.stream_id) if any(wake) and self.stream_id is not None else None
+            future = self.executor.submit(self.process_batch, frames, wake, ticket)
+            future.add_done_callback(lambda fut, seq=seq, frames=frames: self.processing_done(fut, seq, frames))
+        self.executor.shutdown(wait=True)
+
+    def collect_batch(self):
+        """
+        Collects up to batch_size frames from the frame queue, waiting at most batch_wait for the batch to fill.
+
+        Returns:
+            list: The collected (capture time, frame, detection frame) tuples in capture order. Empty if no
+                frame arrived.
+        """
+        try:
+            items = [self.frame_queue.get(timeout=max(self.batch_wait, 0.01))]
+        except queue.Empty:
+            return []
+
+        deadline = time.monotonic() + self.batch_wait
+        while len(items) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    items.append(self.frame_queue.get(timeout=remaining))
+                else:
+                    items.append(self.frame_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        now = time.perf_counter()
+        for captured, _, _ in items:
+            self.queue_wait_seconds.observe(now - captured)
+        self.frame_queue_depth.set(self.frame_queue.qsize())
+        return items
+
+    def gate_batch(self, frames):
         """
-        Handles the completion of frame processing.
+        Runs the motion gate over a batch of frames, in order.
 
         Args:
-            future: The result of the processing task.
-            sequence: The sequence number of the frame.
+            frames: The (capture time, frame, detection frame) tuples of the batch.
 
         Returns:
-            None
+            list: A flag for each frame, True if it should be sent to the model.
         """
-        result, frame = future.result()
-        self.frame_buffer[sequence] = (result, frame)
+        if self.motion_gate is None:
+            return [True] * len(frames)
+        recording = self.video_writer is not None and self.video_writer.recording
+        # The gate's mask is in full-frame coordinates, so it checks the full resolution frames
+        return [self.motion_gate.check(frame, force=recording) for _, frame, _ in frames]
 
-    def check_and_update_queue(self):
+    def processing_done(self, future, sequence, frames):
         """
-        Checks and updates the frame processing queue.
+        Hands a completed batch to the results buffer. The frames of a failed batch are passed on with None
+        results, like gated frames, so they are still recorded and the batches after it are not held back.
+
+        Args:
+            future: The result of the processing task.
+            sequence: The sequence number of the batch.
+            frames: The (capture time, frame, detection frame) tuples of the batch.
+
+        Returns:
+            None
         """
-        min_seq = min(self.frame_buffer.keys(), default=None)
-        if min_seq is not None:
-            self.results_queue.put(self.frame_buffer[min_seq])
-            self.queue_event.set()
-            del self.frame_buffer[min_seq]
+        try:
+            items = future.result()
+        except Exception:
+            logging.exception(f"Batch {sequence} failed")
+            items = [(None, frame) for _, frame, _ in frames]
+        self.free_models.release()
+        self.results_buffer.put(sequence, items)
+        self.results_queue_depth.set(len(self.results_buffer))
 
-    def process_single_frame(self, frame_high_quality):
+    def process_batch(self, frames, wake, ticket=None):
         """
-        Process a single frame by tracking objects, handling tracking results, and writing frames if recording.
+        Track objects across a batch of frames with one forward pass.
 
         Args:
-            frame_high_quality: The high-quality frame to process.
+            frames: The (capture time, high-quality frame, detection frame) tuples to process, in capture order.
+            wake: A flag for each frame, True if it should be sent to the model.
+            ticket: The stream's model pool ticket, taken when the batch was submitted. Used for the checkout
+                whenever a frame is awake.
+
+        Returns:
+            list: A (results, frame) pair for each frame, in the same order as the input, with the high-quality
+                frame. Results are in detection frame coordinates, and None for frames that skipped inference.
         """
-        model = YOLO(self.model_name).to(self.device)
-        return model.track(frame_high_quality, persist=True, verbose=False, device=self.device), frame_high_quality
+        awake = [item for item, flag in zip(frames, wake) if flag]
+        results = iter([])
+        if awake:
+            with self.model_pool.model(self.stream_id, ticket) as model:
+                start = time.perf_counter()
+                for captured, _, _ in awake:
+                    self.frame_age.observe(start - captured)
+                awake = [frame_detect for _, _, frame_detect in awake]
+                results = iter(model.track(awake, persist=True, verbose=False, device=self.model_pool.device))
+                self.inference_seconds.observe(time.perf_counter() - start)
+            self.inference_frames.inc(len(awake))
+            self.inference_fps.add(len(awake))
+        return [([next(results)] if flag else None, frame) for (_, frame, _), flag in zip(frames, wake)]
@@ -0,0 +1,157 @@
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+FREE, WRITING, FILLED, READING = 0, 1, 2, 3
+
+
+class FrameRingBuffer:
+    """
+    A fixed-size ring of frame slots in shared memory, for passing frames between processes.
+
+    Initializes the FrameRingBuffer by allocating every slot up front in one shared memory block.
+    A capture process reserves a slot, decodes or copies a frame into it and commits it. Inference
+    processes read committed slots in order as numpy views into the shared block, so frames are
+    never pickled or copied, and release each slot once they are done with it. The buffer can be
+    passed to a multiprocessing.Process as an argument; the child attaches to the same block.
+
+    Args:
+        shape: The shape of a frame, e.g. (height, width, 3).
+        slots: The number of frame slots.
+        dtype: The dtype of a frame.
+    """
+
+    def __init__(self, shape, slots=16, dtype=np.uint8):
+        self.shape = tuple(shape)
+        self.slots = slots
+        self.dtype = np.dtype(dtype)
+        self.condition = multiprocessing.Condition()
+        self.owner = True
+
+        size = self._frames_size() + 8 * (2 + 2 * slots)
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self._map()
+        self.meta[:] = 0
+
+    def _frames_size(self):
+        return self.slots * int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def _map(self):
+        """
+        Create the numpy views over the shared memory block.
+        """
+        frames_size = self._frames_size()
+        self.frames = np.ndarray((self.slots, *self.shape), dtype=self.dtype, buffer=self.shm.buf)
+        self.meta = np.ndarray((2 + 2 * self.slots,), dtype=np.int64, buffer=self.shm.buf, offset=frames_size)
+        # meta holds the write counter, the read counter, the state of each slot and the sequence number in it
+        self.counters = self.meta[:2]
+        self.state = self.meta[2:2 + self.slots]
+        self.sequence = self.meta[2 + self.slots:]
+
+    def __getstate__(self):
+        return {"shape": self.shape, "slots": self.slots, "dtype": self.dtype.str, "name": self.shm.name,
+                "condition": self.condition}
+
+    def __setstate__(self, state):
+        self.shape = state["shape"]
+        self.slots = state["slots"]
+        self.dtype = np.dtype(state["dtype"])
+        self.condition = state["condition"]
+        self.owner = False
+        try:
+            self.shm = shared_memory.SharedMemory(name=state["name"], track=False)
+        except TypeError:
+            # track was added in Python 3.13
+            self.shm = shared_memory.SharedMemory(name=state["name"])
+        self._map()
+
+    def reserve(self, timeout=None):
+        """
+        Reserve the next slot for writing, waiting until readers have released it.
+
+        Args:
+            timeout: Seconds to wait for the slot. Waits forever if None.
+
+        Returns:
+            int: The index of the reserved slot, or None if the slot was not released in time.
+        """
+        with self.condition:
+            slot = int(self.counters[0] % self.slots)
+            if not self.condition.wait_for(lambda: self.state[slot] == FREE, timeout):
+                return None
+            self.state[slot] = WRITING
+        return slot
+
+    def commit(self, slot):
+        """
+        Publish a reserved slot to readers.
+
+        Args:
+            slot (int): The index returned by reserve.
+        """
+        with self.condition:
+            self.sequence[slot] = self.counters[0]
+            self.state[slot] = FILLED
+            self.counters[0] += 1
+            self.condition.notify_all()
+
+    def write(self, frame, timeout=None):
+        """
+        Copy a frame into the next slot and publish it.
+
+        Args:
+            frame: The frame to write, with the shape of the buffer.
+            timeout: Seconds to wait for a free slot. Waits forever if None.
+
+        Returns:
+            bool: False if no slot was free in time and the frame was dropped.
+        """
+        slot = self.reserve(timeout)
+        if slot is None:
+            return False
+        np.copyto(self.frames[slot], frame)
+        self.commit(slot)
+        return True
+
+    def read(self, timeout=None):
+        """
+        Take the oldest published slot for reading.
+
+        Args:
+            timeout: Seconds to wait for a frame. Waits forever if None.
+
+        Returns:
+            tuple: (slot, sequence, frame) where frame is a view into shared memory that stays valid
+                until the slot is released, or None if no frame arrived in time.
+        """
+        with self.condition:
+            def ready():
+                return self.counters[1] < self.counters[0] and self.state[self.counters[1] % self.slots] == FILLED
+
+            if not self.condition.wait_for(ready, timeout):
+                return None
+            slot = int(self.counters[1] % self.slots)
+            self.state[slot] = READING
+            self.counters[1] += 1
+            return slot, int(self.sequence[slot]), self.frames[slot]
+
+    def release(self, slot):
+        """
+        Hand a slot that was read back to the writer.
+
+        Args:
+            slot (int): The slot returned by read.
+        """
+        with self.condition:
+            self.state[slot] = FREE
+            self.condition.notify_all()
+
+    def close(self):
+        """
+        Detach from the shared memory block, and free it if this process created it.
+        """
+        self.frames = self.meta = self.counters = self.state = self.sequence = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
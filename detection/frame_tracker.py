@@ -1,7 +1,8 @@
-import queue
 import threading
 import time
-import numpy as np
+
+from clock import WallClock
+from metrics import STAGE_SECONDS, QUEUE_DEPTH
 
 
 class FrameTracker(threading.Thread):
@@ -12,91 +13,98 @@ class FrameTracker(threading.Thread):
 
     Args:
         cap: The video capture object.
-        results_queue: The queue for storing detection results.
+        results_buffer: The ReorderBuffer that hands over detection results in capture order.
         video_writer: The video writer object.
-        track_movement_history: Function to track movement history.
-        plot_tracks: Function to plot object tracks.
         write_frame: Function to write frames.
-        track_history: Dictionary to store object tracking history.
-        queue_event: Event for queue synchronization.
+        track_history: The TrackStore holding the recent points of each track.
+        shutdown_flag: Event that stops the tracking loop when set.
+        clock: The clock delay_time is measured with, wall-clock time by default for live streams.
+        camera: The camera label of the tracker's metrics.
+        record: Write or buffer the tracked frames. False when the capture records frames itself.
     """
 
-    def __init__(self, results_queue, video_writer, track_movement_history, write_frame,
-                 track_history, queue_event, motion_stop_time, delay_time, movement_threshold):
+    def __init__(self, results_buffer, video_writer, write_frame, track_history, motion_stop_time,
+                 delay_time, movement_threshold, shutdown_flag=None, clock=None, camera="", record=True):
         super().__init__()
 
-        self.results_queue = results_queue
+        self.results_buffer = results_buffer
         self.video_writer = video_writer
-        self.track_movement_history = track_movement_history
         self.write_frame = write_frame
         self.track_history = track_history
-        self.queue_event = queue_event
         self.motion_stop_time = motion_stop_time
         self.delay_time = delay_time
         self.movement_threshold = movement_threshold
+        self.shutdown_flag = shutdown_flag or threading.Event()
+        self.clock = clock or WallClock()
+        self.record = record
+        self.tracking_seconds = STAGE_SECONDS.labels(camera, "tracking")
+        self.results_queue_depth = QUEUE_DEPTH.labels(camera, "results")
 
     def run(self):
         """
         Runs the frame tracking process continuously.
         """
 
-        while True:
-            self.queue_event.wait()
-            items = []
-            while not self.results_queue.empty():
-                try:
-                    items.append(self.results_queue.get_nowait())
-                    # results, frame = self.results_queue.get_nowait()
-                except queue.Empty:
-                    break
+        while not self.shutdown_flag.is_set():
+            items = self.results_buffer.get(timeout=0.5)
+            if items is None:
+                continue
+            self.results_queue_depth.set(len(self.results_buffer))
             for results, frame in items:
-                self.handle_tracking(results)
+                if results is not None:
+                    start = time.perf_counter()
+                    self.handle_tracking(results, frame)
+                    self.tracking_seconds.observe(time.perf_counter() - start)
+                if not self.record:
+                    continue
                 if self.video_writer.recording:
                     self.write_frame(frame)
-            time.sleep(0.1)
-            self.queue_event.clear()
+                else:
+                    self.video_writer.buffer_frame(frame)
 
-    def handle_tracking(self, results):
+    def handle_tracking(self, results, frame):
         """
         Handles the tracking of objects based on detection results.
 
         Args:
             results: The detection results to process.
+            frame: The full resolution frame. Results from a smaller detection frame are scaled up to it, so
+                movement_threshold is always in full resolution pixels.
         """
 
-        boxes = results[0].boxes.xyxy.cpu()
+        # Frames without tracks still update the store, so tracks that disappeared age out
+        track_ids, centers, classes = [], None, set()
         if results[0].boxes.id is not None:
-            boxes_cpu = results[0].boxes.cpu()
-            clss = boxes_cpu.cls.tolist()
-            track_ids = boxes_cpu.id.int().tolist()
-
-            for box, cls, track_id in zip(boxes, clss, track_ids):
-                self.track_movement_history(track_id, box)
-                if len(self.track_history[track_id]) >= 2:
-                    self.plot_tracks(track_id)
-
-    def plot_tracks(self, track_id):
+            boxes = results[0].boxes.xyxy.cpu().numpy()
+            track_ids = results[0].boxes.id.int().cpu().tolist()
+            classes = {results[0].names[int(cls)] for cls in results[0].boxes.cls.cpu().tolist()}
+            centers = (boxes[:, :2] + boxes[:, 2:4]) / 2
+            detect_h, detect_w = results[0].orig_shape[:2]
+            if (detect_h, detect_w) != frame.shape[:2]:
+                centers *= (frame.shape[1] / detect_w, frame.shape[0] / detect_h)
+        displacements = self.track_history.update(track_ids, centers)
+        # Frames without moving tracks count as still, so a clip stops once the scene empties
+        self.plot_tracks(displacements)
+        # What is seen while recording goes into the clip's index row
+        self.video_writer.annotate(classes, track_ids, displacements)
+
+    def plot_tracks(self, displacements):
         """
-        Calculate displacement between previous and current track centers,
-        start or stop recording based on movement threshold and recording status.
+        Start or stop recording based on how far the tracks in a frame moved since their previous points.
 
         Args:
-            track_id: The identifier of the track to process.
+            displacements: The displacement of each track that has a previous point, empty if none has.
         """
-        prev_center = np.array(self.track_history[track_id][-2])
-        current_center = np.array(self.track_history[track_id][-1])
-        displacement = np.linalg.norm(prev_center - current_center)
-
         # Plot tracks if sufficient movement
-        if displacement > self.movement_threshold:
+        if (displacements > self.movement_threshold).any():
             if not self.video_writer.recording:
                 self.video_writer.start_recording()
             self.motion_stop_time = None
 
-        if displacement < self.movement_threshold:
-            if not self.motion_stop_time:
-                self.motion_stop_time = time.time()
-            if self.video_writer.recording and (time.time() - self.motion_stop_time) > self.delay_time:
+        else:
+            if self.motion_stop_time is None:
+                self.motion_stop_time = self.clock.now()
+            if self.video_writer.recording and (self.clock.now() - self.motion_stop_time) > self.delay_time:
                 self.video_writer.stop_recording()
                 self.track_history.clear()
                 self.motion_stop_time = None
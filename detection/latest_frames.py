@@ -0,0 +1,88 @@
+import queue
+import threading
+import time
+from collections import deque
+
+from metrics import FRAMES_DROPPED
+
+
+class LatestFrameQueue:
+    """
+    A frame queue for the detector that only keeps the newest frames.
+
+    Initializes the LatestFrameQueue with the number of frames to keep. It takes the place of the
+    detector's queue.Queue: put never blocks and pushes out the oldest waiting frame once size frames are
+    waiting, so a detector that falls behind skips ahead to the newest frames instead of working through
+    a backlog. get skips frames older than max_age seconds, which bounds how late a detection can come.
+    Frames that are skipped here are only skipped by the detector, the capture records every frame.
+
+    Items are (capture time, frame, detection frame) tuples, with the capture time from time.perf_counter().
+
+    Args:
+        size: The number of newest frames to keep.
+        max_age: Seconds after capture a frame is still worth detecting on. 0 never skips frames for age.
+        camera: The camera label of the queue's metrics.
+    """
+
+    def __init__(self, size=1, max_age=0, camera=""):
+        self.frames = deque(maxlen=max(1, size))
+        self.max_age = max_age
+        self.condition = threading.Condition()
+        self.superseded = FRAMES_DROPPED.labels(camera, "superseded")
+        self.stale = FRAMES_DROPPED.labels(camera, "stale")
+
+    def put(self, item, timeout=None):
+        """
+        Add a frame, pushing out the oldest waiting one if the queue is full.
+
+        Args:
+            item: The (capture time, frame, detection frame) tuple.
+            timeout: Ignored, put never blocks.
+        """
+        with self.condition:
+            if len(self.frames) == self.frames.maxlen:
+                self.superseded.inc()
+            self.frames.append(item)
+            self.condition.notify()
+
+    def get(self, block=True, timeout=None):
+        """
+        Take the oldest waiting frame that is not older than max_age.
+
+        Args:
+            block: Wait for a frame if none is waiting.
+            timeout: Seconds to wait at most, forever if None.
+
+        Returns:
+            The (capture time, frame, detection frame) tuple.
+
+        Raises:
+            queue.Empty: If no frame arrived in time.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while True:
+                self._drop_stale()
+                if self.frames:
+                    return self.frames.popleft()
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if not block or (remaining is not None and remaining <= 0):
+                    raise queue.Empty
+                self.condition.wait(remaining)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def _drop_stale(self):
+        if not self.max_age:
+            return
+        now = time.perf_counter()
+        while self.frames and now - self.frames[0][0] > self.max_age:
+            self.frames.popleft()
+            self.stale.inc()
+
+    def qsize(self):
+        return len(self.frames)
+
+    def empty(self):
+        return not self.frames
@@ -0,0 +1,261 @@
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds, from a fast decode to a slow batch of inference
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# Seconds, from a frame detected right away to one that waited behind a backlog
+AGE_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric:
+    """
+    A metric with a fixed set of label names, and one child holding the value for each set of label values.
+
+    Children are looked up once with labels() and kept by the caller, so recording a value is a plain
+    attribute update under a lock. The base class holds a single value per child and is exposed as an
+    untyped metric; subclasses set kind and override _child and _samples for other values.
+
+    Args:
+        name: The metric name.
+        documentation: The help text.
+        labelnames: The names of the labels.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        """
+        Returns the child for a set of label values, creating it on first use.
+        """
+        values = tuple(str(value) for value in values)
+        with self.lock:
+            child = self.children.get(values)
+            if child is None:
+                child = self.children[values] = self._child()
+            return child
+
+    def _child(self):
+        return _Value()
+
+    def _label_text(self, values, extra=()):
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def exposition(self):
+        """
+        Returns the metric in the Prometheus text format.
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            children = list(self.children.items())
+        for values, child in children:
+            lines.extend(self._samples(values, child))
+        return "\n".join(lines)
+
+    def _samples(self, values, child):
+        return [f"{self.name}{self._label_text(values)} {child.value}"]
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(Metric):
+    kind = "counter"
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+
+class _Buckets:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class Histogram(Metric):
+    """
+    A Metric that counts observations into buckets, with their sum and count.
+
+    Args:
+        name: The metric name.
+        documentation: The help text.
+        labelnames: The names of the labels.
+        buckets: The upper bounds of the buckets, in increasing order.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _child(self):
+        return _Buckets(self.buckets)
+
+    def _samples(self, values, child):
+        with child.lock:
+            counts = list(child.counts)
+            total = child.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f"{self.name}_bucket{self._label_text(values, [('le', le)])} {cumulative}")
+        lines.append(f"{self.name}_sum{self._label_text(values)} {total}")
+        lines.append(f"{self.name}_count{self._label_text(values)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """
+    The set of metrics exposed by the HTTP endpoint.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def exposition(self):
+        """
+        Returns every metric in the Prometheus text format.
+        """
+        return "\n".join(metric.exposition() for metric in self.metrics) + "\n"
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "rtsp_stage_seconds", "Time spent per pipeline stage: decode, queue_wait, inference, tracking and encode.",
+    ("camera", "stage")))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "rtsp_queue_depth", "Items waiting in a pipeline queue.", ("camera", "queue")))
+FRAMES_DROPPED = REGISTRY.register(Counter(
+    "rtsp_frames_dropped_total", "Frames dropped, by where they were dropped.", ("camera", "reason")))
+RECORDING = REGISTRY.register(Gauge(
+    "rtsp_recording", "1 while a clip is being recorded.", ("camera",)))
+INFERENCE_FRAMES = REGISTRY.register(Counter(
+    "rtsp_inference_frames_total", "Frames run through the model.", ("camera",)))
+INFERENCE_FPS = REGISTRY.register(Gauge(
+    "rtsp_inference_fps", "Frames run through the model per second, over the last few seconds.", ("camera",)))
+CAPTURE_RECONNECTS = REGISTRY.register(Counter(
+    "rtsp_capture_reconnects_total", "Times a stream was reopened, by why it was: error, stall or closed.",
+    ("camera", "stream", "reason")))
+CAPTURE_UP = REGISTRY.register(Gauge(
+    "rtsp_capture_up", "1 while a stream is delivering frames, 0 while it is being reconnected.", ("camera", "stream")))
+ARCHIVE_BYTES = REGISTRY.register(Gauge(
+    "rtsp_archive_bytes", "Total size of the clips in the archive."))
+CLIPS_DELETED = REGISTRY.register(Counter(
+    "rtsp_clips_deleted_total", "Clips deleted by retention, by why they were: age or quota.", ("reason",)))
+FRAME_AGE = REGISTRY.register(Histogram(
+    "rtsp_frame_age_seconds", "Time from a frame being captured to it being run through the model.", ("camera",),
+    AGE_BUCKETS))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.exposition().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+
+
+def start_http_server(port, host="0.0.0.0"):
+    """
+    Serve the metrics at /metrics from a background thread. Only the first call starts a server.
+
+    Args:
+        port (int): The port to listen on.
+        host (str): The address to listen on.
+
+    Returns:
+        ThreadingHTTPServer: The running server.
+    """
+    global _server
+    if _server is None:
+        _server = ThreadingHTTPServer((host, port), _Handler)
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, daemon=True).start()
+        print(f"Serving metrics on http://{host}:{port}/metrics")
+    return _server
+
+
+class RateMeter:
+    """
+    Sets a gauge to the rate of events per second, measured over windows of a few seconds.
+
+    Args:
+        gauge: The gauge child to set.
+        window: Seconds per measurement.
+    """
+
+    def __init__(self, gauge, window=5):
+        self.gauge = gauge
+        self.window = window
+        self.count = 0
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+
+    def add(self, count=1):
+        with self.lock:
+            self.count += count
+            elapsed = time.monotonic() - self.start
+            if elapsed >= self.window:
+                self.gauge.set(round(self.count / elapsed, 2))
+                self.count = 0
+                self.start += elapsed
+
+
+def camera_name(rtsp_url):
+    """
+    Returns the camera label for a stream, the last part of its URL.
+    """
+    return rtsp_url.rstrip("/").rsplit("/", 1)[-1]
@@ -0,0 +1,148 @@
+import copy
+import queue
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+from config_utils import get_available_cores
+from model_backend import load_model
+
+
+class ModelPool:
+    """
+    A pool of preloaded YOLO models shared between inference workers.
+
+    Initializes the ModelPool by loading every model instance once at startup. Models are handed out
+    through checkout/checkin. Ultralytics keeps tracker state on the model's predictor, so the pool
+    stores that state per stream and attaches it to whichever model the stream checks out. A stream
+    can only hold one model at a time, and its checkouts are served in the order of their tickets, so
+    its tracker sees frames in capture order even when several of its batches wait for a model.
+    Different streams share the pool freely.
+
+    Args:
+        model_name: The name or path of the YOLO weights.
+        size: The number of model instances to load.
+        device: The torch device to run inference on. Chosen automatically if None.
+        backend: The inference backend, "torch" or "onnx". See model_backend.load_model.
+        int8: Use an int8-quantized ONNX model.
+        cache_dir: The directory exported ONNX models are cached in.
+        threads: ONNX Runtime threads per model instance. 0 splits the available cores between the instances.
+    """
+
+    def __init__(self, model_name, size=1, device=None, backend="torch", int8=False, cache_dir="models", threads=0):
+        self.model_name = model_name
+        self.size = max(1, size)
+        self.device = device or torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.backend = backend
+        threads = threads or max(1, get_available_cores() // self.size)
+
+        self.models = queue.Queue()
+        self.tracker_state = {}
+        self.tracker_template = None
+        # Per stream, the next ticket to hand out and the ticket whose checkout is served next
+        self.tickets = {}
+        self.serving = {}
+        self.stream_condition = threading.Condition()
+
+        for _ in range(self.size):
+            model = load_model(self.model_name, self.device, backend, int8, cache_dir, threads)
+            self._warmup(model)
+            self.models.put(model)
+        self.names = model.names
+        print(f"Loaded {self.size} instance(s) of {self.model_name} on {self.device} with the {backend} backend")
+
+    def _warmup(self, model):
+        """
+        Run a blank frame through the model so its predictor and trackers are created up front.
+
+        Args:
+            model: The model to warm up.
+        """
+        blank = np.zeros((64, 64, 3), dtype=np.uint8)
+        model.track(blank, persist=True, verbose=False, device=self.device)
+        if self.tracker_template is None:
+            self.tracker_template = copy.deepcopy(model.predictor.trackers)
+
+    def ticket(self, stream_id):
+        """
+        Take a place in a stream's checkout order. Take tickets in capture order, before handing the work to
+        another thread, and check out exactly once with each ticket, or the stream's later checkouts wait forever.
+
+        Args:
+            stream_id: The stream the ticket is for.
+
+        Returns:
+            int: The ticket to pass to checkout.
+        """
+        with self.stream_condition:
+            ticket = self.tickets.get(stream_id, 0)
+            self.tickets[stream_id] = ticket + 1
+            return ticket
+
+    def checkout(self, stream_id=None, ticket=None):
+        """
+        Take a model out of the pool, blocking until one is free and it is the stream's turn.
+
+        Args:
+            stream_id: The stream the model will track. Its tracker state is attached to the model.
+            ticket: The stream's ticket for this checkout, see ticket. One is taken now if None.
+
+        Returns:
+            The checked out model.
+        """
+        if stream_id is not None:
+            if ticket is None:
+                ticket = self.ticket(stream_id)
+            with self.stream_condition:
+                self.stream_condition.wait_for(lambda: self.serving.get(stream_id, 0) == ticket)
+
+        model = self.models.get()
+        if stream_id is not None:
+            trackers = self.tracker_state.get(stream_id)
+            if trackers is None:
+                trackers = copy.deepcopy(self.tracker_template)
+            model.predictor.trackers = trackers
+        return model
+
+    def checkin(self, model, stream_id=None):
+        """
+        Return a model to the pool.
+
+        Args:
+            model: The model returned by checkout.
+            stream_id: The stream the model was checked out for. Its tracker state is saved.
+        """
+        if stream_id is not None:
+            self.tracker_state[stream_id] = model.predictor.trackers
+        self.models.put(model)
+
+        if stream_id is not None:
+            with self.stream_condition:
+                self.serving[stream_id] = self.serving.get(stream_id, 0) + 1
+                self.stream_condition.notify_all()
+
+    @contextmanager
+    def model(self, stream_id=None, ticket=None):
+        """
+        Check out a model for the duration of a with block.
+
+        Args:
+            stream_id: The stream the model will track.
+            ticket: The stream's ticket for this checkout, see ticket.
+        """
+        model = self.checkout(stream_id, ticket)
+        try:
+            yield model
+        finally:
+            self.checkin(model, stream_id)
+
+    def reset_stream(self, stream_id):
+        """
+        Drop the tracker state of a stream so its next checkout starts with fresh trackers.
+
+        Args:
+            stream_id: The stream to reset.
+        """
+        self.tracker_state.pop(stream_id, None)
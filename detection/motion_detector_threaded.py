@@ -5,42 +5,63 @@ import threading
 import time
 import queue
 
-from collections import defaultdict, deque
-
 from frame_processor import FrameProcessor
 from frame_tracker import FrameTracker
-
-
-def track_history_default():
-    return deque(maxlen=30)
+from track_store import TrackStore
+from latest_frames import LatestFrameQueue
+from reorder_buffer import ReorderBuffer
+from metrics import STAGE_SECONDS, QUEUE_DEPTH, FRAMES_DROPPED, camera_name
 
 
 class MotionDetector:
-    def __init__(self, cap, movement_threshold, delay_time, video_writer, model_name):
+    def __init__(self, cap, movement_threshold, delay_time, video_writer, model_pool, batch_size=1,
+                 batch_wait_ms=0, motion_gate=None, handle_signals=True, clock=None, latest_frames=0,
+                 max_frame_age=0, frame_queue_size=8):
         self.cap = cap
-        self.track_history = defaultdict(track_history_default)
-        self.model_name = model_name
-        self.frame_queue = queue.Queue(maxsize=90)
-        self.results_queue = queue.Queue(maxsize=90)
+        self.track_history = TrackStore()
+        self.model_pool = model_pool
+        self.motion_gate = motion_gate
+        camera = camera_name(self.cap.rtsp_url)
+        # With latest_frames the detector only sees the newest frames, and every frame is recorded as it is
+        # captured. Otherwise every frame goes through the detector, and is recorded once it has been tracked.
+        self.latest = latest_frames > 0
+        if self.latest:
+            self.frame_queue = LatestFrameQueue(latest_frames, max_frame_age, camera)
+        else:
+            # A few frames, not a FrameRingBuffer: the frames are passed on by reference to the pre-roll buffer
+            # and the encoder queue, which can still hold them after the detector is done, so slots could not be
+            # reused. A short queue bounds the memory instead, about 6 MB per 1080p frame.
+            self.frame_queue = queue.Queue(maxsize=max(1, frame_queue_size))
+        # Batches can finish out of order, this hands them to the tracker in order. The window bounds how many
+        # are in flight or waiting for the tracker.
+        self.results_buffer = ReorderBuffer(max(2 * model_pool.size, 4))
         self.video_writer = video_writer
 
         self.movement_threshold = movement_threshold
         self.motion_stop_time = None
         self.delay_time = delay_time
 
-        self.queue_event = threading.Event()
+        self.shutdown_flag = threading.Event()
+
+        self.decode_seconds = STAGE_SECONDS.labels(camera, "decode")
+        self.frame_queue_depth = QUEUE_DEPTH.labels(camera, "frames")
+        self.frames_dropped = FRAMES_DROPPED.labels(camera, "frame_queue_full")
 
-        self.frame_processor = FrameProcessor(self.cap, self.frame_queue, self.results_queue,
-                                              self.queue_event, self.model_name)
+        self.frame_processor = FrameProcessor(self.cap, self.frame_queue, self.results_buffer,
+                                              self.model_pool, self.cap.rtsp_url,
+                                              batch_size, batch_wait_ms, self.motion_gate, self.video_writer,
+                                              self.shutdown_flag, camera)
 
-        self.frame_tracker = FrameTracker(self.results_queue, self.video_writer, self.track_movement_history,
-                                          self.write_frame, self.track_history, self.queue_event, self.motion_stop_time,
-                                          self.delay_time, self.movement_threshold)
+        self.frame_tracker = FrameTracker(self.results_buffer, self.video_writer, self.write_frame,
+                                          self.track_history, self.motion_stop_time,
+                                          self.delay_time, self.movement_threshold, self.shutdown_flag, clock,
+                                          camera, record=not self.latest)
         self.frame_getter = threading.Thread(target=self.get_frame)
 
-        self.shutdown_flag = threading.Event()
-        signal.signal(signal.SIGTERM, self.signal_handler)
-        signal.signal(signal.SIGINT, self.signal_handler)
+        # Signal handlers can only be installed from the main thread, a supervisor handles them itself
+        if handle_signals:
+            signal.signal(signal.SIGTERM, self.signal_handler)
+            signal.signal(signal.SIGINT, self.signal_handler)
 
         logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 
@@ -59,6 +80,22 @@ class MotionDetector:
         self.frame_getter.join()
         self.frame_tracker.join()
 
+    def is_alive(self):
+        """
+        Checks whether all pipeline threads are still running.
+
+        Returns:
+            bool: False if any of the threads has exited.
+        """
+        return all(thread.is_alive() for thread in (self.frame_getter, self.frame_processor, self.frame_tracker))
+
+    def stop(self):
+        """
+        Ask all pipeline threads to exit. run() returns once they have.
+        """
+        self.shutdown_flag.set()
+        self.results_buffer.close()
+
     def get_frame(self):
         """
         Capture frames from an RTSP stream and put them into a frame queue.
@@ -67,12 +104,21 @@ class MotionDetector:
             None
         """
         while self.cap.isOpened() and not self.shutdown_flag.is_set():
-            success, frame_high_quality = self.cap.read()
+            start = time.perf_counter()
+            # The high quality frame is recorded, detection runs on the smaller detection frame
+            success, frame_high_quality, frame_detect = self.cap.read_pair()
             if success:
+                # Frames are queued with the time they were captured, to measure how long they wait
+                captured = time.perf_counter()
+                self.decode_seconds.observe(captured - start)
+                if self.latest:
+                    self.video_writer.record_frame(frame_high_quality)
                 try:
-                    self.frame_queue.put(frame_high_quality, timeout=1)
+                    self.frame_queue.put((captured, frame_high_quality, frame_detect), timeout=1)
                 except queue.Full:
+                    self.frames_dropped.inc()
                     logging.warning("Frame queue is full. Skipping frame.")
+                self.frame_queue_depth.set(self.frame_queue.qsize())
 
     def write_frame(self, frame):
         """
@@ -83,28 +129,12 @@ class MotionDetector:
         """
         self.video_writer.write_frame(frame)
 
-    def track_movement_history(self, track_id, box):
-        """
-        Tracks the movement history of an object identified by track_id.
-
-        Args:
-            track_id (int): The unique identifier of the tracked object.
-            box (tuple): The bounding box coordinates of the object.
-
-        Returns:
-            list: The updated movement history of the tracked object.
-        """
-        # Store tracking history
-        track = self.track_history[track_id]
-        current_position = (int((box[0] + box[2]) / 2), int((box[1] + box[3]) / 2))
-        track.append(current_position)
-
     def signal_handler(self, signum, frame):
         """
         Signal handler for SIGTERM.
         """
         print("Shutting down")
-        self.shutdown_flag.set()
+        self.stop()
 
     def cleanup(self):
         """
@@ -0,0 +1,93 @@
+import heapq
+import threading
+import time
+
+
+class ReorderBuffer:
+    """
+    Hands batches that finish out of order to a consumer strictly in sequence order.
+
+    Initializes the ReorderBuffer with the size of its reorder window. Producers put each batch with its
+    sequence number, starting at 1, as it completes. Completed batches wait in a min-heap keyed by
+    sequence number, and get returns the next one in sequence as soon as it is there, blocking until it is.
+    A producer reserves a sequence number before starting a batch, which blocks while the number is
+    window or more past the next one the consumer is due. That bounds how many batches can be in flight or
+    waiting, and pushes back on the producer when the consumer falls behind.
+
+    Args:
+        window: The number of sequence numbers that can be in flight or waiting at once.
+    """
+
+    def __init__(self, window=8):
+        self.window = max(1, window)
+        self.heap = []
+        self.next_sequence = 1
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def reserve(self, sequence, timeout=None):
+        """
+        Wait until a batch with the given sequence number fits in the reorder window.
+
+        Args:
+            sequence: The sequence number of the batch about to be started.
+            timeout: Seconds to wait at most, forever if None.
+
+        Returns:
+            bool: True if the batch fits, False on timeout or once the buffer is closed.
+        """
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: self.closed or sequence < self.next_sequence + self.window, timeout) and not self.closed
+
+    def put(self, sequence, items):
+        """
+        Add a completed batch.
+
+        Args:
+            sequence: The sequence number of the batch.
+            items: The batch's items. An empty list skips the sequence number, e.g. for a failed batch.
+        """
+        with self.condition:
+            heapq.heappush(self.heap, (sequence, items))
+            if sequence == self.next_sequence:
+                self.condition.notify_all()
+
+    def get(self, timeout=None):
+        """
+        Take the next batch in sequence order, waiting for it to complete.
+
+        Args:
+            timeout: Seconds to wait at most, forever if None.
+
+        Returns:
+            The items of the batch, or None on timeout or once the buffer is closed.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while True:
+                if self.heap and self.heap[0][0] == self.next_sequence:
+                    _, items = heapq.heappop(self.heap)
+                    self.next_sequence += 1
+                    # Wakes producers waiting in reserve, and the consumer if the next batch is already here
+                    self.condition.notify_all()
+                    return items
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if self.closed or (remaining is not None and remaining <= 0):
+                    return None
+                self.condition.wait(remaining)
+
+    def close(self):
+        """
+        Wake every waiting producer and consumer, and make further waits return straight away.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __len__(self):
+        """
+        Returns the number of items waiting in completed batches.
+        """
+        with self.condition:
+            return sum(len(items) for _, items in self.heap)
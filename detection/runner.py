@@ -1,36 +1,70 @@
 from video_writer import VideoWriter
 from motion_detector_threaded import MotionDetector
 from file_manager import FileManager
+from clip_index import ClipIndex
 from video_capture import VideoCapture
+from model_pool import ModelPool
+from motion_gate import MotionGate
+import metrics
 import config
 import time
 
 
 if __name__ == "__main__":
     # Create Video Capture object
-    # url = config.RTSP_URL + config.RTSP_CAM_NAME[0]
-    url = "rtsp://localhost:8554/driveway"
+    # Runs a single camera, use supervisor.py to run every camera in RTSP_CAM_NAME
+    if config.RTSP_URL and config.RTSP_CAM_NAME:
+        url = config.RTSP_URL + config.RTSP_CAM_NAME[0]
+    else:
+        url = "rtsp://localhost:8554/driveway"
 
     print("Starting")
-    cap = VideoCapture(url)
+    if config.METRICS_PORT:
+        metrics.start_http_server(config.METRICS_PORT, config.METRICS_HOST)
+    cap = VideoCapture(url, url + config.DETECT_STREAM_SUFFIX if config.DETECT_STREAM_SUFFIX else None,
+                       config.DETECT_WIDTH, config.DETECT_MAX_SKEW_MS / 1000, config.CAPTURE_STALL_TIMEOUT,
+                       config.RECONNECT_BACKOFF, config.RECONNECT_MAX_BACKOFF)
     print("Started video capture")
 
+    # Clips are indexed with what was detected in them once they are closed
+    clip_index = ClipIndex(config.CLIP_INDEX_DB) if config.CLIP_INDEX_DB else None
+
     # Create Video Writer object
     video_dir = config.VIDEO_DIR
     h = cap.get_h()
     w = cap.get_w()
     fps = cap.get_fps()
-    video_writer = VideoWriter(video_dir, w, h, fps)
+    video_writer = VideoWriter(video_dir, w, h, fps, config.PRE_ROLL_SECONDS, config.PRE_ROLL_MAX_MB * 1024 * 1024,
+                               config.ENCODER_QUEUE_SIZE, config.ENCODER_OVERFLOW, metrics.camera_name(url),
+                               clip_index)
 
-    # Create File Manager object
+    # Create File Manager object, it deletes old clips in the background
     day_threshold = config.DAY_THRESHOLD
-    file_manager = FileManager(video_dir, day_threshold)
+    file_manager = FileManager(video_dir, day_threshold, config.VIDEO_QUOTA_MB * 1024 * 1024,
+                               config.CLEANUP_INTERVAL, clip_index)
+    file_manager.start()
+
+    # Load the models once, up front
+    model_pool = ModelPool(config.MODEL_NAME, config.MODEL_POOL_SIZE, backend=config.MODEL_BACKEND,
+                           int8=config.MODEL_INT8, cache_dir=config.MODEL_CACHE_DIR,
+                           threads=config.INFERENCE_THREADS)
+
+    # Only wake the model when pixels change outside the mask
+    motion_gate = None
+    if config.MOTION_GATE:
+        motion_gate = MotionGate(config.MASK_COORDS, config.MOTION_MIN_AREA, config.MOTION_COOLDOWN, fps,
+                                 mask_resolution=config.MASK_RESOLUTION)
 
     # Create Motion Detector object
-    model_name = config.MODEL_NAME
     movement_threshold = config.MOVEMENT_THRESHOLD
     delay_time = config.DELAY_TIME
-    motion_detector = MotionDetector(cap, movement_threshold, delay_time, video_writer, model_name)
+    motion_detector = MotionDetector(cap, movement_threshold, delay_time, video_writer, model_pool,
+                                     config.INFERENCE_BATCH_SIZE, config.INFERENCE_BATCH_WAIT_MS, motion_gate,
+                                     latest_frames=config.LATEST_FRAMES,
+                                     max_frame_age=config.MAX_FRAME_AGE_MS / 1000,
+                                     frame_queue_size=config.FRAME_QUEUE_SIZE)
 
     # Start
     motion_detector.run()
+    motion_detector.cleanup()
+    file_manager.stop()
@@ -0,0 +1,157 @@
+import logging
+import os
+import signal
+import sys
+import threading
+
+from video_writer import VideoWriter
+from motion_detector_threaded import MotionDetector
+from video_capture import VideoCapture
+from model_pool import ModelPool
+from motion_gate import MotionGate
+from file_manager import FileManager
+from clip_index import ClipIndex
+import metrics
+import config
+
+
+class CameraSupervisor:
+    """
+    A class for running one detection pipeline per camera on top of a shared model pool.
+
+    Initializes the CameraSupervisor with the cameras to run. Every camera gets its own capture,
+    VideoWriter output directory, motion gate and tracker state, while inference goes through the
+    shared ModelPool. Pipelines that crash are restarted after restart_delay seconds.
+
+    Args:
+        rtsp_url: The base RTSP URL that camera names are appended to.
+        cam_names: The names of the cameras to run.
+        video_dir: The directory to save clips to. Each camera writes to its own subdirectory.
+        model_pool: The pool of preloaded models shared by all cameras.
+        restart_delay: Seconds to wait before restarting a crashed pipeline.
+        clip_index (ClipIndex): The clip index shared by every camera's VideoWriter, None disables indexing.
+    """
+
+    def __init__(self, rtsp_url, cam_names, video_dir, model_pool, restart_delay=5, clip_index=None):
+        self.rtsp_url = rtsp_url
+        self.cam_names = cam_names
+        self.video_dir = video_dir
+        self.model_pool = model_pool
+        self.restart_delay = restart_delay
+        self.clip_index = clip_index
+
+        self.threads = {}
+        self.detectors = {}
+        self.restarts = {cam_name: 0 for cam_name in cam_names}
+        self.shutdown_flag = threading.Event()
+
+        logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+
+    def run(self):
+        """
+        Start every camera pipeline and restart the ones that crash until shut down.
+        """
+        signal.signal(signal.SIGTERM, self.signal_handler)
+        signal.signal(signal.SIGINT, self.signal_handler)
+
+        for cam_name in self.cam_names:
+            self.start_camera(cam_name)
+
+        while not self.shutdown_flag.wait(self.restart_delay):
+            for cam_name in self.cam_names:
+                detector = self.detectors.get(cam_name)
+                if detector is not None and not detector.is_alive():
+                    # One of its threads died, stop the rest so the pipeline can be rebuilt
+                    detector.stop()
+                if not self.threads[cam_name].is_alive():
+                    self.restarts[cam_name] += 1
+                    logging.warning(f"Camera {cam_name} stopped, restart #{self.restarts[cam_name]}")
+                    self.start_camera(cam_name)
+
+        for thread in self.threads.values():
+            thread.join(timeout=10)
+
+    def start_camera(self, cam_name):
+        """
+        Start the pipeline of a camera in its own thread.
+
+        Args:
+            cam_name: The name of the camera to start.
+        """
+        self.detectors.pop(cam_name, None)
+        self.model_pool.reset_stream(self.rtsp_url + cam_name)
+        thread = threading.Thread(target=self.run_camera, args=(cam_name,), name=cam_name, daemon=True)
+        self.threads[cam_name] = thread
+        thread.start()
+
+    def run_camera(self, cam_name):
+        """
+        Build and run the pipeline of a single camera until it stops or crashes.
+
+        Args:
+            cam_name: The name of the camera to run.
+        """
+        url = self.rtsp_url + cam_name
+        try:
+            cap = VideoCapture(url, url + config.DETECT_STREAM_SUFFIX if config.DETECT_STREAM_SUFFIX else None,
+                               config.DETECT_WIDTH, config.DETECT_MAX_SKEW_MS / 1000, config.CAPTURE_STALL_TIMEOUT,
+                               config.RECONNECT_BACKOFF, config.RECONNECT_MAX_BACKOFF, self.shutdown_flag)
+            if not cap.isOpened():
+                # Shut down while the camera was still connecting
+                return
+            fps = cap.get_fps()
+            video_writer = VideoWriter(os.path.join(self.video_dir, cam_name), cap.get_w(), cap.get_h(), fps,
+                                       config.PRE_ROLL_SECONDS, config.PRE_ROLL_MAX_MB * 1024 * 1024,
+                                       config.ENCODER_QUEUE_SIZE, config.ENCODER_OVERFLOW, cam_name,
+                                       self.clip_index)
+
+            motion_gate = None
+            if config.MOTION_GATE:
+                motion_gate = MotionGate(config.MASK_COORDS, config.MOTION_MIN_AREA, config.MOTION_COOLDOWN, fps,
+                                         mask_resolution=config.MASK_RESOLUTION)
+
+            detector = MotionDetector(cap, config.MOVEMENT_THRESHOLD, config.DELAY_TIME, video_writer,
+                                      self.model_pool, config.INFERENCE_BATCH_SIZE, config.INFERENCE_BATCH_WAIT_MS,
+                                      motion_gate, handle_signals=False, latest_frames=config.LATEST_FRAMES,
+                                      max_frame_age=config.MAX_FRAME_AGE_MS / 1000,
+                                      frame_queue_size=config.FRAME_QUEUE_SIZE)
+            self.detectors[cam_name] = detector
+            if self.shutdown_flag.is_set():
+                return
+            logging.info(f"Camera {cam_name} started")
+            detector.run()
+            detector.cleanup()
+        except Exception:
+            logging.exception(f"Camera {cam_name} crashed")
+
+    def stop(self):
+        """
+        Stop every camera pipeline.
+        """
+        self.shutdown_flag.set()
+        for detector in list(self.detectors.values()):
+            detector.stop()
+
+    def signal_handler(self, signum, frame):
+        """
+        Signal handler for SIGTERM and SIGINT.
+        """
+        print("Shutting down")
+        self.stop()
+
+
+if __name__ == "__main__":
+    if config.METRICS_PORT:
+        metrics.start_http_server(config.METRICS_PORT, config.METRICS_HOST)
+    model_pool = ModelPool(config.MODEL_NAME, config.MODEL_POOL_SIZE, backend=config.MODEL_BACKEND,
+                           int8=config.MODEL_INT8, cache_dir=config.MODEL_CACHE_DIR,
+                           threads=config.INFERENCE_THREADS)
+    clip_index = ClipIndex(config.CLIP_INDEX_DB) if config.CLIP_INDEX_DB else None
+    # One retention engine covers every camera's clips, so the quota is shared
+    file_manager = FileManager(config.VIDEO_DIR, config.DAY_THRESHOLD, config.VIDEO_QUOTA_MB * 1024 * 1024,
+                               config.CLEANUP_INTERVAL, clip_index)
+    file_manager.start()
+    supervisor = CameraSupervisor(config.RTSP_URL, config.RTSP_CAM_NAME, config.VIDEO_DIR, model_pool,
+                                  config.CAMERA_RESTART_DELAY, clip_index)
+    supervisor.run()
+    file_manager.stop()
@@ -1,28 +1,100 @@
+import random
+import threading
+import time
+from collections import deque
+
 import cv2
 
+from metrics import CAPTURE_RECONNECTS, CAPTURE_UP, camera_name
+
 
 class VideoCapture:
     """
     A class for capturing video from an RTSP stream.
 
-    Initializes the VideoCapture object with the RTSP URL and captures video frames.
+    Initializes the VideoCapture object with the RTSP URL and captures video frames. Besides the full
+    resolution frames, which are recorded, it can provide a smaller copy of each frame for detection.
+    With detect_url the copy comes from a second, low-resolution stream of the same camera, usually its
+    substream, read on a background thread. Each main frame is paired with the substream frame that
+    arrived closest to it, within max_skew seconds. With detect_width the copy is the main frame
+    downscaled locally. When the substream has no frame close enough the main frame is downscaled to
+    the substream's resolution, so detection always sees frames of one size.
+
+    Both streams reconnect on their own, see Stream. The capture stays open until it is released or stopped
+    is set, so a camera or bridge restart only pauses read() rather than ending the pipeline.
 
     Args:
         rtsp_url: The RTSP URL for the video stream.
+        detect_url: The URL of a low-resolution stream of the same camera to detect on.
+        detect_width: Width to downscale frames to for detection, if there is no detect_url. 0 detects on
+            the full resolution frames.
+        max_skew: Seconds a substream frame may be apart from the main frame it is paired with.
+        stall_timeout: Seconds without a frame after which a stream is reopened.
+        backoff: Seconds before the first reconnect attempt, doubled after every failed attempt.
+        max_backoff: The longest wait between reconnect attempts in seconds.
+        stopped: The caller's shutdown event. Setting it stops the capture, including while the streams are
+            first opened. Releasing the capture does not set it.
     """
 
-    def __init__(self, rtsp_url):
+    def __init__(self, rtsp_url, detect_url=None, detect_width=0, max_skew=0.2, stall_timeout=10, backoff=1,
+                 max_backoff=60, stopped=None):
         self.rtsp_url = rtsp_url
-        self.cap = None
+        self.stopped = LinkedEvent(stopped)
+        camera = camera_name(rtsp_url)
+        self.stream = Stream(rtsp_url, self.stopped, stall_timeout, backoff, max_backoff, camera, "main")
+        self.detect_stream = None
+        self.detect_reader = None
+        self.h = self.w = self.fps = 0
+        if not self.stream.open():
+            # Stopped before the stream opened, isOpened() is False
+            return
 
-        while self.cap is None or not self.cap.isOpened():
-            self.cap = cv2.VideoCapture(self.rtsp_url)
-            if not self.cap.isOpened():
-                print("Error opening video stream or file")
+        self.h = int(self.stream.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.w = int(self.stream.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.fps = int(self.stream.cap.get(cv2.CAP_PROP_FPS))
+
+        self.max_skew = max_skew
+        self.detect_size = None
+        if detect_width and detect_width < self.w:
+            self.detect_size = (detect_width, round(self.h * detect_width / self.w))
+
+        # Substream frames with the time they arrived, newest last
+        self.detect_frames = deque(maxlen=max(2, self.fps))
+        self.detect_lock = threading.Lock()
+        if detect_url:
+            self.open_detect_stream(Stream(detect_url, self.stopped, stall_timeout, backoff, max_backoff, camera,
+                                           "detect"))
+
+    def open_detect_stream(self, detect_stream):
+        """
+        Open the low-resolution stream and start reading it on a background thread. Detection falls back to
+        downscaled main frames if it cannot be opened. Once it is open it reconnects like the main stream,
+        and main frames are downscaled while it is down.
 
-        self.h = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        self.w = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        self.fps = int(self.cap.get(cv2.CAP_PROP_FPS))
+        Args:
+            detect_stream (Stream): The low-resolution stream.
+        """
+        if not detect_stream.connect():
+            print(f"Error opening detection stream {detect_stream.url}, detecting on the main stream")
+            return
+        self.detect_stream = detect_stream
+        self.detect_size = (int(detect_stream.cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                            int(detect_stream.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        self.detect_reader = threading.Thread(target=self.read_detect_stream, daemon=True)
+        self.detect_reader.start()
+        print(f"Detecting on {detect_stream.url} at {self.detect_size[0]}x{self.detect_size[1]}")
+
+    def read_detect_stream(self):
+        """
+        Read the low-resolution stream until the capture is released.
+        """
+        while not self.stopped.is_set():
+            success, frame = self.detect_stream.read()
+            if not success:
+                continue
+            with self.detect_lock:
+                self.detect_frames.append((time.monotonic(), frame))
+        self.detect_stream.release()
 
     def get_h(self):
         """
@@ -44,21 +116,230 @@ class VideoCapture:
 
     def isOpened(self):
         """
-        Checks if the video capture is open. Returns True if open, False otherwise.
+        Checks if the video capture is open. Returns True until the capture is released or stopped is set,
+        including while the stream is reconnecting.
         """
-        return self.cap.isOpened()
+        return not self.stopped.is_set()
 
     def read(self):
         """
-        Reads the next video frame.
+        Reads the next video frame, reconnecting the stream first if it failed or stalled.
+
+        Returns:
+            A tuple containing a boolean indicating success and the frame. Only fails once the capture has
+            been released.
+        """
+        return self.stream.read()
+
+    def read_pair(self):
+        """
+        Reads the next video frame along with the frame to run detection on.
 
         Returns:
-            A tuple containing a boolean indicating success and the frame.
+            A tuple of a boolean indicating success, the full resolution frame and the detection frame. The
+            detection frame is the full resolution frame itself when no detection resolution is set.
         """
-        return self.cap.read()
+        success, frame = self.stream.read()
+        if not success:
+            return False, None, None
+        return True, frame, self.detect_frame(frame, time.monotonic())
+
+    def detect_frame(self, frame, captured):
+        """
+        Returns the detection frame for a main stream frame.
+
+        Args:
+            frame: The full resolution frame.
+            captured: The time.monotonic() time the frame arrived.
+        """
+        if self.detect_size is None:
+            return frame
+        if self.detect_stream is not None:
+            with self.detect_lock:
+                match = None
+                for i, (arrived, detect_frame) in enumerate(self.detect_frames):
+                    if abs(arrived - captured) <= self.max_skew and (
+                            match is None or abs(arrived - captured) < abs(match[1] - captured)):
+                        match = (i, arrived, detect_frame)
+                if match is not None:
+                    # Each substream frame is used once, along with the older ones that were skipped
+                    for _ in range(match[0] + 1):
+                        self.detect_frames.popleft()
+                    # A reconnected substream can come back at a different resolution
+                    return downscale(match[2], self.detect_size)
+        return downscale(frame, self.detect_size)
 
     def release(self):
         """
         Releases the video capture resources.
         """
+        self.stopped.set()
+        self.stream.release()
+        if self.detect_reader is not None:
+            self.detect_reader.join(timeout=2)
+
+
+class Stream:
+    """
+    A cv2.VideoCapture that reopens itself when its stream fails or stalls.
+
+    Reads that fail are retried until no frame has arrived for stall_timeout seconds, then the stream is
+    reopened. The FFmpeg backend is given the same open and read timeouts, so a stream that stops sending
+    makes read() fail instead of blocking forever. Reconnect attempts are spaced with jittered exponential
+    backoff, so a bridge restart neither spins a core nor gets hit by every camera at once. Attempts stop
+    as soon as stopped is set.
+
+    Args:
+        url: The URL of the stream.
+        stopped: Event that ends reading and reconnecting when set.
+        stall_timeout: Seconds without a frame after which the stream is reopened.
+        backoff: Seconds before the first reconnect attempt, doubled after every failed attempt.
+        max_backoff: The longest wait between reconnect attempts in seconds.
+        camera: The camera label of the stream's metrics.
+        name: The stream label of the stream's metrics, e.g. main or detect.
+    """
+
+    def __init__(self, url, stopped, stall_timeout=10, backoff=1, max_backoff=60, camera="", name="main"):
+        self.url = url
+        self.stopped = stopped
+        self.stall_timeout = stall_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.cap = None
+        self.last_frame = time.monotonic()
+
+        self.up = CAPTURE_UP.labels(camera, name)
+        self.reconnects = {reason: CAPTURE_RECONNECTS.labels(camera, name, reason)
+                           for reason in ("error", "stall", "closed")}
+
+    def connect(self):
+        """
+        Try to open the stream once.
+
+        Returns:
+            bool: True if the stream is open.
+        """
+        timeout_ms = int(self.stall_timeout * 1000)
+        try:
+            cap = cv2.VideoCapture(self.url, cv2.CAP_ANY, [cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, timeout_ms,
+                                                          cv2.CAP_PROP_READ_TIMEOUT_MSEC, timeout_ms])
+        except cv2.error as e:
+            print(f"Error opening {self.url}: {e}")
+            return False
+        if not cap.isOpened():
+            cap.release()
+            return False
+        self.cap = cap
+        self.last_frame = time.monotonic()
+        self.up.set(1)
+        return True
+
+    def open(self):
+        """
+        Open the stream, retrying with jittered exponential backoff until it opens or stopped is set.
+
+        Returns:
+            bool: True if the stream is open, False if stopped was set first.
+        """
+        attempt = 0
+        while not self.stopped.is_set():
+            if self.connect():
+                if attempt:
+                    print(f"Reconnected to {self.url} after {attempt} failed attempt(s)")
+                return True
+            delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+            # Half of the delay is fixed and half random, so cameras that dropped together retry apart
+            delay = delay / 2 + random.uniform(0, delay / 2)
+            attempt += 1
+            print(f"Error opening video stream {self.url}, retrying in {delay:.1f}s")
+            self.stopped.wait(delay)
+        return False
+
+    def reconnect(self, reason):
+        """
+        Close the stream and open it again.
+
+        Args:
+            reason: Why the stream is reopened: error, stall or closed.
+        """
+        print(f"Reconnecting to {self.url} ({reason})")
+        self.up.set(0)
+        self.reconnects[reason].inc()
         self.cap.release()
+        return self.open()
+
+    def read(self, image=None):
+        """
+        Read the next frame, reconnecting as often as needed.
+
+        Args:
+            image: An array of the frame's shape to decode into, as with cv2.VideoCapture.read.
+
+        Returns:
+            A tuple of a boolean indicating success and the frame. Only fails once stopped is set.
+        """
+        while not self.stopped.is_set():
+            if not self.cap.isOpened():
+                self.reconnect("closed")
+                continue
+            try:
+                success, frame = self.cap.read(image)
+            except cv2.error as e:
+                print(f"Error reading {self.url}: {e}")
+                self.reconnect("error")
+                continue
+            if success:
+                self.last_frame = time.monotonic()
+                return True, frame
+            if time.monotonic() - self.last_frame > self.stall_timeout:
+                self.reconnect("stall")
+            else:
+                # Failed reads can return straight away, e.g. at the end of a file
+                self.stopped.wait(0.05)
+        return False, None
+
+    def release(self):
+        """
+        Release the stream.
+        """
+        self.up.set(0)
+        if self.cap is not None:
+            self.cap.release()
+
+
+class LinkedEvent(threading.Event):
+    """
+    An Event that also counts as set once its parent is set, so a component can be stopped on its own or
+    along with its caller without stopping the caller.
+
+    Args:
+        parent: The caller's event, None for a plain Event.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__()
+        self.parent = parent
+
+    def is_set(self):
+        return super().is_set() or (self.parent is not None and self.parent.is_set())
+
+    def wait(self, timeout=None):
+        if self.parent is None:
+            return super().wait(timeout)
+        # The parent cannot wake this wait, so it is checked in short steps
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.is_set():
+            step = 0.1 if deadline is None else min(0.1, deadline - time.monotonic())
+            if step <= 0:
+                return False
+            super().wait(step)
+        return True
+
+
+def downscale(frame, size):
+    """
+    Returns a frame resized to size, a (width, height) tuple, or the frame itself if it already has that size.
+    """
+    if (frame.shape[1], frame.shape[0]) == tuple(size):
+        return frame
+    return cv2.resize(frame, tuple(size), interpolation=cv2.INTER_AREA)
@@ -1,8 +1,16 @@
 import datetime
+import functools
 import os
+import threading
+import time
 import zoneinfo
+from collections import deque
+
 import cv2
 
+from clip_index import ClipRecord
+from metrics import STAGE_SECONDS, QUEUE_DEPTH, FRAMES_DROPPED, RECORDING
+
 
 class VideoWriter:
     """
@@ -15,34 +23,58 @@ class VideoWriter:
         w: The width of the video frames.
         h: The height of the video frames.
         fps: The frames per second of the video.
+        pre_roll: Seconds of frames from before the recording started to include in each clip.
+        pre_roll_bytes: The memory cap of the pre-roll buffer in bytes.
+        encoder_queue: The number of frames that can wait for a background encoder thread. 0 encodes
+            frames synchronously in write_frame.
+        encoder_overflow: What the encoder does when its queue is full, see EncoderThread.
+        camera: The camera label of the writer's metrics and clip index rows.
+        clip_index (ClipIndex): The index each clip is added to once its file is closed, with what was
+            detected while it was recorded. None disables indexing.
 
     Returns:
         None
     """
-    def __init__(self, video_dir, w, h, fps):
+    def __init__(self, video_dir, w, h, fps, pre_roll=0, pre_roll_bytes=256 * 1024 * 1024,
+                 encoder_queue=0, encoder_overflow="block", camera="", clip_index=None):
         self.video_dir = video_dir
         self.w = w
         self.h = h
         self.fps = fps
+        self.pre_roll = PreRollBuffer(pre_roll, fps, pre_roll_bytes) if pre_roll > 0 else None
+        self.encoder = EncoderThread(encoder_queue, encoder_overflow, camera) if encoder_queue > 0 else None
+        self.encode_seconds = STAGE_SECONDS.labels(camera, "encode")
+        self.recording_state = RECORDING.labels(camera)
+        self.camera = camera
+        self.clip_index = clip_index
+        self.clip = None
 
         self.video_writer = None
         self.recording = False
+        # Held while a clip is opened or closed, so record_frame can be called from another thread
+        self.lock = threading.Lock()
 
     def start_recording(self):
         """
         Initialize the video writer to start recording a video.
         """
-        if not self.video_writer:
-            self.recording = True
-            filename = self._generate_filename()
-            self._create_directory(filename)
-            self.video_writer = cv2.VideoWriter(
-                filename,
-                cv2.VideoWriter_fourcc(*'mp4v'),
-                self.fps,
-                (self.w, self.h),
-            )
-            print("Created video_writer")
+        with self.lock:
+            if not self.video_writer:
+                self.recording = True
+                self.recording_state.set(1)
+                filename = self._generate_filename()
+                self._create_directory(filename)
+                self.video_writer = cv2.VideoWriter(
+                    filename,
+                    cv2.VideoWriter_fourcc(*'mp4v'),
+                    self.fps,
+                    (self.w, self.h),
+                )
+                print("Created video_writer")
+                pre_roll_frames = len(self.pre_roll.frames) if self.pre_roll is not None else 0
+                self.clip = ClipRecord(filename, self.camera, self.camera,
+                                       time.time() - pre_roll_frames / max(self.fps, 1))
+                self._flush_pre_roll()
 
     def _generate_filename(self):
         """
@@ -60,6 +92,52 @@ class VideoWriter:
         directory = os.path.dirname(filename)
         os.makedirs(directory, exist_ok=True)
 
+    def _flush_pre_roll(self):
+        """
+        Write the buffered pre-roll frames to the start of the clip. They wait for room in the encoder queue
+        whatever its overflow policy, a burst of pre-roll frames would otherwise be dropped at every clip start.
+        """
+        if self.pre_roll is not None:
+            for frame in self.pre_roll.drain():
+                self._write(frame, block=True)
+
+    def buffer_frame(self, frame):
+        """
+        Keep a frame that was not recorded in the pre-roll buffer, if pre-roll is enabled.
+
+        Args:
+            frame (np.array): A frame that was not written to a clip.
+        """
+        if self.pre_roll is not None:
+            self.pre_roll.append(frame)
+
+    def record_frame(self, frame):
+        """
+        Write a frame to the clip while recording, or keep it in the pre-roll buffer otherwise. Safe to call
+        from a different thread than the one starting and stopping recordings.
+
+        Args:
+            frame (np.array): The frame.
+        """
+        with self.lock:
+            if self.recording:
+                self._write(frame)
+            else:
+                self.buffer_frame(frame)
+
+    def annotate(self, classes, track_ids, displacements):
+        """
+        Add the detections of a frame to the metadata of the clip being recorded.
+
+        Args:
+            classes: The class names detected in the frame.
+            track_ids: The ids of the tracks in the frame.
+            displacements: How far each track moved since its previous point, in pixels.
+        """
+        clip = self.clip
+        if clip is not None:
+            clip.observe(classes, track_ids, displacements)
+
     def write_frame(self, frame):
         """
         Write a frame to the video.
@@ -67,20 +145,257 @@ class VideoWriter:
         Args:
             frame (np.array): A frame to write to the video.
         """
-        self.video_writer.write(frame)
+        self._write(frame)
+
+    def _write(self, frame, block=False):
+        """
+        Write a frame to the current clip, through the encoder thread if there is one. With block, the frame waits
+        for room in the encoder queue instead of following its overflow policy.
+        """
+        if self.encoder is not None:
+            self.encoder.submit(self.video_writer, frame, block)
+        else:
+            start = time.perf_counter()
+            self.video_writer.write(frame)
+            self.encode_seconds.observe(time.perf_counter() - start)
+
+    def _release(self):
+        """
+        Close the current clip once all of its frames are written, then add it to the clip index.
+        """
+        clip, self.clip = self.clip, None
+        done = None
+        if clip is not None and self.clip_index is not None:
+            clip.end_time = time.time()
+            done = functools.partial(self._index, clip)
+        if self.encoder is not None:
+            self.encoder.release(self.video_writer, done)
+        else:
+            self.video_writer.release()
+            if done is not None:
+                done()
+        self.video_writer = None
+
+    def _index(self, clip):
+        """
+        Add a closed clip to the clip index. A failure is logged, it never stops the recording.
+        """
+        try:
+            self.clip_index.add(clip)
+        except Exception as e:
+            print(f"Failed to index {clip.path}: {e}")
 
     def stop_recording(self):
         """
         Stop recording a video.
         """
-        self.video_writer.release()
-        self.video_writer = None
-        self.recording = False
+        with self.lock:
+            self._release()
+            self.recording = False
+        self.recording_state.set(0)
         print("Stopped recording")
 
     def cleanup(self):
         """
-        Cleanup the video writer.
+        Cleanup the video writer, waiting for queued frames to be encoded.
         """
-        if self.video_writer is not None:
-            self.video_writer.release()
+        with self.lock:
+            if self.video_writer is not None:
+                self._release()
+            self.recording = False
+        self.recording_state.set(0)
+        if self.encoder is not None:
+            self.encoder.flush()
+
+
+class PreRollBuffer:
+    """
+    A bounded buffer of the most recent frames, flushed into a clip when recording starts.
+
+    Holds references to the frames rather than copies, and drops the oldest frames once either the
+    frame count or the byte size exceeds its limit.
+
+    Args:
+        seconds: The length of the pre-roll in seconds.
+        fps: The frames per second of the video.
+        max_bytes: The maximum total size of the buffered frames in bytes.
+    """
+
+    def __init__(self, seconds, fps, max_bytes):
+        self.max_frames = int(seconds * fps)
+        self.max_bytes = max_bytes
+        self.frames = deque()
+        self.nbytes = 0
+
+    def append(self, frame):
+        """
+        Add a frame, dropping the oldest frames if the buffer is over its limits.
+
+        Args:
+            frame (np.array): The frame to buffer.
+        """
+        self.frames.append(frame)
+        self.nbytes += frame.nbytes
+        while self.frames and (len(self.frames) > self.max_frames or self.nbytes > self.max_bytes):
+            self.nbytes -= self.frames.popleft().nbytes
+
+    def drain(self):
+        """
+        Remove and return the buffered frames, oldest first.
+        """
+        frames = list(self.frames)
+        self.clear()
+        return frames
+
+    def clear(self):
+        """
+        Drop all buffered frames.
+        """
+        self.frames.clear()
+        self.nbytes = 0
+
+
+class EncoderThread(threading.Thread):
+    """
+    A background thread that encodes frames so writing a clip does not block the caller.
+
+    Initializes and starts the EncoderThread with a bounded queue. Frames are queued together with the
+    cv2.VideoWriter they belong to, so a clip can keep draining after the next one has started. Releasing
+    a writer is queued behind its frames, followed by its callback if it has one.
+
+    Args:
+        max_frames: The maximum number of frames waiting to be encoded.
+        overflow: What to do when the queue is full. "block" waits for room, "drop-oldest" discards the
+            oldest waiting frame and "drop-newest" discards the new frame.
+        camera: The camera label of the encoder's metrics.
+    """
+
+    OVERFLOW_POLICIES = ("block", "drop-oldest", "drop-newest")
+
+    def __init__(self, max_frames=30, overflow="block", camera=""):
+        super().__init__(daemon=True)
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown encoder overflow policy {overflow}, expected one of {self.OVERFLOW_POLICIES}")
+        self.max_frames = max_frames
+        self.overflow = overflow
+
+        self.items = deque()
+        self.condition = threading.Condition()
+        self.busy = False
+
+        self.frames_waiting = 0
+        self.frames_encoded = 0
+        self.frames_dropped = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+        self.encode_seconds = STAGE_SECONDS.labels(camera, "encode")
+        self.queue_depth = QUEUE_DEPTH.labels(camera, "encoder")
+        self.dropped = FRAMES_DROPPED.labels(camera, "encoder_full")
+
+        self.start()
+
+    def submit(self, writer, frame, block=False):
+        """
+        Queue a frame to be written.
+
+        Args:
+            writer (cv2.VideoWriter): The writer of the clip the frame belongs to.
+            frame (np.array): The frame to write.
+            block: Wait for room when the queue is full, whatever the overflow policy. drop-oldest never drops
+                such a frame either, e.g. the pre-roll of a clip.
+
+        Returns:
+            bool: False if the frame was dropped.
+        """
+        with self.condition:
+            if self.frames_waiting >= self.max_frames:
+                if block or self.overflow == "block" or (self.overflow == "drop-oldest" and not self._drop_oldest()):
+                    self.condition.wait_for(lambda: self.frames_waiting < self.max_frames)
+                elif self.overflow == "drop-newest":
+                    self.frames_dropped += 1
+                    self.dropped.inc()
+                    return False
+            self.items.append((writer, frame, time.monotonic(), block, None))
+            self.frames_waiting += 1
+            self.queue_depth.set(self.frames_waiting)
+            self.condition.notify_all()
+        return True
+
+    def release(self, writer, done=None):
+        """
+        Queue the release of a writer after the frames already queued for it.
+
+        Args:
+            writer (cv2.VideoWriter): The writer to release.
+            done: Function called on the encoder thread once the writer is released.
+        """
+        with self.condition:
+            self.items.append((writer, None, time.monotonic(), True, done))
+            self.condition.notify_all()
+
+    def _drop_oldest(self):
+        """
+        Drop the oldest waiting frame that was not queued with block.
+
+        Returns:
+            bool: False if every waiting frame was queued with block.
+        """
+        for i, (_, frame, _, keep, _) in enumerate(self.items):
+            if frame is not None and not keep:
+                del self.items[i]
+                self.frames_waiting -= 1
+                self.frames_dropped += 1
+                self.dropped.inc()
+                return True
+        return False
+
+    def run(self):
+        """
+        Write queued frames and release queued writers, in order.
+        """
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.items)
+                writer, frame, queued, _, done = self.items.popleft()
+                self.busy = True
+
+            if frame is None:
+                writer.release()
+                if done is not None:
+                    done()
+            else:
+                start = time.perf_counter()
+                writer.write(frame)
+                self.encode_seconds.observe(time.perf_counter() - start)
+
+            with self.condition:
+                if frame is not None:
+                    self.frames_waiting -= 1
+                    self.queue_depth.set(self.frames_waiting)
+                    self.frames_encoded += 1
+                    self.last_lag = time.monotonic() - queued
+                    self.max_lag = max(self.max_lag, self.last_lag)
+                self.busy = False
+                self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Wait until every queued frame is written and every queued writer released.
+
+        Args:
+            timeout: Seconds to wait. Waits forever if None.
+
+        Returns:
+            bool: False if the queue did not drain in time.
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.items and not self.busy, timeout)
+
+    def stats(self):
+        """
+        Returns the queue depth, frame counters and the lag between queuing and writing a frame in seconds.
+        """
+        with self.condition:
+            return {"queued": self.frames_waiting, "encoded": self.frames_encoded, "dropped": self.frames_dropped,
+                    "lag": self.last_lag, "max_lag": self.max_lag}
@@ -0,0 +1,164 @@
+import os
+import queue
+import subprocess
+import threading
+
+from video_writer import VideoWriter
+
+
+class ClipExtractor(VideoWriter):
+    """
+    A VideoWriter that cuts clips out of the source file with ffmpeg stream copy instead of re-encoding frames.
+
+    Initializes the ClipExtractor with the clip directory. Instead of writing decoded frames, it records the
+    start and end of each event, in seconds into the source file, and copies that range of the source's
+    compressed stream into the clip when recording stops. Stream copy can only start on a keyframe, so the
+    start is moved back to the keyframe before it. With exact_start, a clip that does not start on a keyframe
+    is re-encoded as a whole instead. A re-encoded head only joins a stream-copied tail when the encoder
+    parameters of both match, which they rarely do for a camera's stream.
+
+    Clips are extracted on a background thread, so ffmpeg never stalls the analysis of the file. cleanup
+    waits for the clips of the file to be extracted.
+
+    Args:
+        video_dir: The directory to save the clips.
+        pre_roll: Seconds of video from before the event to include in each clip.
+        exact_start: Re-encode clips that do not start on a keyframe, so they start exactly at the event.
+        clip_index (ClipIndex): The index each extracted clip is added to. None disables indexing.
+    """
+
+    def __init__(self, video_dir, pre_roll=0, exact_start=False, clip_index=None):
+        super().__init__(video_dir, 0, 0, 0, clip_index=clip_index)
+        self.pre_roll_seconds = pre_roll
+        self.exact_start = exact_start
+
+        self.source = None
+        self.start = None
+
+        self.jobs = queue.Queue()
+        self.extractor = threading.Thread(target=self._run_jobs, daemon=True)
+        self.extractor.start()
+
+    def start_recording(self, filename, position=None):
+        """
+        Remember where the event starts.
+
+        Args:
+            filename (str): The path of the source video file.
+            position (float): Seconds into the source file where the event starts.
+        """
+        if not self.recording:
+            self.recording = True
+            self.source = filename
+            self.start = max(0.0, (position or 0) - self.pre_roll_seconds)
+            # The clip's path is only chosen once it is extracted
+            self.clip = self._clip_record(filename, None, self.start)
+
+    def stop_recording(self, position=None):
+        """
+        Queue the recorded range to be cut out of the source file.
+
+        Args:
+            position (float): Seconds into the source file where the event ends. None means the end of the file.
+        """
+        if not self.recording:
+            return
+        self.recording = False
+        filename_dest = self._destination(self.source)
+        # Reserve the path, so the next clip does not pick it while this one is still being extracted
+        open(filename_dest, "a").close()
+        clip = self._finish_clip(position)
+        if clip is not None:
+            clip.path = filename_dest
+        self.jobs.put((self.source, self.start, position, filename_dest, clip))
+        self.source = None
+        self.start = None
+
+    def _run_jobs(self):
+        """
+        Extract queued clips, in order, and add them to the clip index.
+        """
+        while True:
+            source, start, end, dest, clip = self.jobs.get()
+            try:
+                self.extract(source, start, end, dest)
+                print("Extracted clip", dest)
+                if clip is not None:
+                    self._index(clip)
+            except Exception as e:
+                print(f"Failed to extract clip from {source}: {e}")
+                try:
+                    os.remove(dest)
+                except OSError:
+                    pass
+            finally:
+                self.jobs.task_done()
+
+    def wants_frames(self):
+        """
+        Returns False, clips are cut from the source file so frames never need to be decoded for them.
+        """
+        return False
+
+    def write_frame(self, frame):
+        pass
+
+    def buffer_frame(self, frame):
+        pass
+
+    def cleanup(self):
+        """
+        Wait for the queued clips to be extracted, so a file is only marked as processed once its clips exist.
+        """
+        self.jobs.join()
+
+    def extract(self, source, start, end, dest):
+        """
+        Copy the range [start, end) of a video file into a new file without re-encoding it.
+
+        Args:
+            source (str): The path of the source video file.
+            start (float): The start of the range in seconds.
+            end (float): The end of the range in seconds, or None for the end of the file.
+            dest (str): The path of the clip to write.
+        """
+        keyframes = self.keyframes(source)
+        previous = max((k for k in keyframes if k <= start), default=0.0)
+
+        if self.exact_start and start - previous >= 0.01:
+            self._encode(source, start, end, dest)
+        else:
+            self._copy(source, previous, end, dest)
+
+    def keyframes(self, source):
+        """
+        List the keyframe timestamps of the first video stream of a file.
+
+        Args:
+            source (str): The path of the video file.
+
+        Returns:
+            list: The keyframe timestamps in seconds.
+        """
+        output = subprocess.run(
+            ["ffprobe", "-v", "error", "-select_streams", "v:0", "-skip_frame", "nokey",
+             "-show_entries", "frame=pts_time", "-of", "csv=p=0", source],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        return [float(line) for line in output.split() if line and line != "N/A"]
+
+    def _copy(self, source, start, end, dest):
+        self._ffmpeg(["-ss", f"{start:.3f}", "-i", source, *self._duration(start, end),
+                      "-map", "0", "-c", "copy", "-avoid_negative_ts", "make_zero", dest])
+
+    def _encode(self, source, start, end, dest):
+        self._ffmpeg(["-ss", f"{start:.3f}", "-i", source, *self._duration(start, end),
+                      "-map", "0", "-c:v", "libx264", "-preset", "veryfast", "-crf", "18", "-c:a", "aac", dest])
+
+    @staticmethod
+    def _duration(start, end):
+        return [] if end is None else ["-t", f"{max(end - start, 0):.3f}"]
+
+    @staticmethod
+    def _ffmpeg(args):
+        subprocess.run(["ffmpeg", "-y", "-v", "error", *args], check=True)
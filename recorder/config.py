@@ -1,16 +1,64 @@
 from os import getenv, makedirs
-from config_utils import get_env_list
+from config_utils import get_env_list, get_env_bool, get_available_cores, get_env_coords
 
 RTSP_URL = getenv("RTSP_URL")
 RTSP_CAM_NAME = get_env_list(getenv("RTSP_CAM_NAME"))
 MODEL_NAME = getenv("MODEL_NAME", "yolo11n.pt")
+# Inference backend: "torch" runs the PyTorch weights, "onnx" exports them once to MODEL_CACHE_DIR and runs
+# them with ONNX Runtime. MODEL_INT8 quantizes the ONNX model's weights to int8.
+MODEL_BACKEND = getenv("MODEL_BACKEND", "torch")
+MODEL_INT8 = get_env_bool(getenv("MODEL_INT8"), False)
+MODEL_CACHE_DIR = getenv("MODEL_CACHE_DIR", "models")
+# ONNX Runtime threads per worker, 0 splits the available cores between the workers
+INFERENCE_THREADS = int(getenv("INFERENCE_THREADS", 0))
+# Pixels a track has to move between frames to start a clip, measured on a frame MOVEMENT_THRESHOLD_WIDTH pixels
+# wide and scaled to each file's resolution. 854 keeps the meaning it had when frames were resized to 854x480.
 MOVEMENT_THRESHOLD = int(getenv("MOVEMENT_THRESHOLD", 15))
+MOVEMENT_THRESHOLD_WIDTH = int(getenv("MOVEMENT_THRESHOLD_WIDTH", 854))
 DELAY_TIME = int(getenv("DELAY_TIME", 10))
+# Seconds of video before the detection to include in each clip, capped at PRE_ROLL_MAX_MB of frames
+PRE_ROLL_SECONDS = float(getenv("PRE_ROLL_SECONDS", 2))
+PRE_ROLL_MAX_MB = int(getenv("PRE_ROLL_MAX_MB", 256))
+# Frames that can wait for the background encoder, 0 encodes on the calling thread.
+# ENCODER_OVERFLOW is one of block, drop-oldest or drop-newest.
+ENCODER_QUEUE_SIZE = int(getenv("ENCODER_QUEUE_SIZE", 30))
+ENCODER_OVERFLOW = getenv("ENCODER_OVERFLOW", "block")
+# Only every DETECTION_STRIDE-th frame is analyzed, the others are only decoded while a clip is open. With a stride,
+# the pre-roll is decoded from the source file when a clip starts, rather than decoding every frame to buffer it.
+DETECTION_STRIDE = int(getenv("DETECTION_STRIDE", 1))
+
+# Skip inference on frames without pixel motion outside the mask. Off by default, objects changing less than
+# MOTION_MIN_AREA of the frame, e.g. slow or distant movers, never reach the tracker while it is on.
+MOTION_GATE = get_env_bool(getenv("MOTION_GATE"), False)
+MOTION_MIN_AREA = float(getenv("MOTION_MIN_AREA", 0.002))
+MOTION_COOLDOWN = float(getenv("MOTION_COOLDOWN", 5))
 
 DAY_THRESHOLD = int(getenv("DAY_THRESHOLD", 7))
 
 VIDEO_SOURCE = getenv("VIDEO_SOURCE", "videos")
+# How new segments in VIDEO_SOURCE are found: auto (inotify if available), inotify or poll
+WATCH_MODE = getenv("WATCH_MODE", "auto")
+WATCH_POLL_INTERVAL = float(getenv("WATCH_POLL_INTERVAL", 5))
+# Seconds a segment's size has to stay the same before polling treats it as finished
+WATCH_SETTLE_TIME = float(getenv("WATCH_SETTLE_TIME", 2))
+# Number of video files processed in parallel, each worker loads its own model. 1 processes files serially.
+WORKERS = int(getenv("WORKERS", get_available_cores()))
+# Seconds of video between saved checkpoints, so a restart resumes a file instead of starting it over
+CHECKPOINT_INTERVAL = float(getenv("CHECKPOINT_INTERVAL", 10))
+# Times a file is started before it is marked as failed, for files that crash the recorder
+MAX_ATTEMPTS = int(getenv("MAX_ATTEMPTS", 3))
+PROCESSED_DB = getenv("PROCESSED_DB", "/app/data/processed_files.db")
 CLIP_DEST = getenv("CLIP_DEST", "clips")
+# SQLite index of the clips and what was detected in them, empty disables it
+CLIP_INDEX_DB = getenv("CLIP_INDEX_DB", "/app/data/clips.db")
+# "encode" re-encodes decoded frames into clips, "copy" cuts clips out of the source with ffmpeg stream copy
+CLIP_MODE = getenv("CLIP_MODE", "encode")
+# In copy mode, re-encode clips that do not start on a keyframe so they start exactly at the event
+CLIP_EXACT_START = get_env_bool(getenv("CLIP_EXACT_START"), False)
 
 
-MASK_COORDS = [(0, 0), (0, 733), (781, 695), (1110, 651), (1505, 597), (1630, 593), (1595, 0)]
\ No newline at end of file
+# Resolution MASK_COORDS are drawn at, the mask is scaled to each stream's resolution. Inference runs on the bounding
+# rectangle of the unmasked region, which only saves work when the mask covers whole edges of the frame.
+MASK_RESOLUTION = tuple(int(v) for v in getenv("MASK_RESOLUTION", "1920x1080").split("x"))
+MASK_COORDS = get_env_coords(getenv("MASK_COORDS"),
+                             [(0, 0), (0, 733), (781, 695), (1110, 651), (1505, 597), (1630, 593), (1595, 0)])
\ No newline at end of file
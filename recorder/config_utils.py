@@ -1,3 +1,7 @@
+import os
+import re
+
+
 def get_env_list(env_str):
     """
     Convert an environment variable string to a list of strings.
@@ -8,4 +12,51 @@ def get_env_list(env_str):
     Returns:
         list: The list of strings.
     """
-    return env_str.split(',') if env_str else []
\ No newline at end of file
+    return env_str.split(',') if env_str else []
+
+
+def get_env_bool(env_str, default=False):
+    """
+    Convert an environment variable string to a boolean.
+
+    Args:
+        env_str (str): The environment variable string to convert.
+        default (bool): The value to use when the variable is not set.
+
+    Returns:
+        bool: True for "1", "true", "yes" or "on", case-insensitive.
+    """
+    if env_str is None:
+        return default
+    return env_str.strip().lower() in ("1", "true", "yes", "on")
+
+
+def get_env_coords(env_str, default=None):
+    """
+    Convert an environment variable string to a list of (x, y) points.
+
+    Accepts the list mask_coords.py prints, e.g. "[(0, 0), (0, 733), (781, 695)]", or just the numbers, e.g.
+    "0,0 0,733 781,695".
+
+    Args:
+        env_str (str): The environment variable string to convert.
+        default (list): The points to use when the variable is not set.
+
+    Returns:
+        list: The (x, y) tuples.
+    """
+    if env_str is None:
+        return list(default or [])
+    return [(int(x), int(y)) for x, y in re.findall(r"(-?\d+)\s*,\s*(-?\d+)", env_str)]
+
+
+def get_available_cores():
+    """
+    Get the number of CPU cores this process may run on, respecting cpusets.
+
+    Returns:
+        int: The number of available cores.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
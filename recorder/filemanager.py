@@ -1,61 +1,311 @@
+import datetime
 import os
 import queue
 import sqlite3
+import threading
+import time
+
+QUEUED, IN_PROGRESS, DONE, FAILED = "queued", "in_progress", "done", "failed"
+
+
+def connect(db_file):
+    # WAL lets the worker processes write checkpoints while the main process reads and writes the ledger
+    conn = sqlite3.connect(db_file, timeout=30, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def begin_file(conn, file, date):
+    """
+    Mark a file as in progress and count an attempt at it.
+
+    Returns:
+        tuple: The frame to resume from and the number of attempts, this one included.
+    """
+    conn.execute('''
+        INSERT INTO processed_files (file_name, date, state, attempts) VALUES (?, ?, ?, 1)
+        ON CONFLICT (file_name) DO UPDATE SET state = excluded.state, attempts = attempts + 1
+    ''', (file, date, IN_PROGRESS))
+    checkpoint, attempts = conn.execute('SELECT checkpoint, attempts FROM processed_files WHERE file_name = ?',
+                                        (file,)).fetchone()
+    conn.commit()
+    return checkpoint, attempts
 
 
 class FileManager:
-    def __init__(self, path, db_file='/app/data/processed_files.db'):
+    def __init__(self, path, db_file='/app/data/processed_files.db', retention_days=None, max_attempts=3):
         self.path = path
         self.file_queue = queue.Queue()
+        # Files that are queued but not finished yet, everything else is looked up in the database
+        self.queued = set()
+        # Files started by this process that are not finished yet
+        self.started = set()
         self.db_file = db_file
+        self.retention_days = retention_days
+        self.max_attempts = max_attempts
+        self.last_prune = 0
+        self.lock = threading.Lock()
         self._initialize_db()
-        self.existing_files = set(self._get_all_files())
-        self.processed_files = self._load_processed_files()
-        for file in self.existing_files - self.processed_files:
-            self.file_queue.put(file)
+        self.prune()
+        # New files are left to the SegmentWatcher, which only hands them over once they are finished
+        self._requeue_unfinished()
 
     def _initialize_db(self):
-        self.conn = sqlite3.connect(self.db_file)
+        self.conn = connect(self.db_file)
         self.cursor = self.conn.cursor()
+        # Each file moves from queued to in_progress to done or failed. checkpoint is the frame to resume
+        # from when the recorder stopped in the middle of the file.
         self.cursor.execute('''
             CREATE TABLE IF NOT EXISTS processed_files (
                 id INTEGER PRIMARY KEY,
                 file_name TEXT UNIQUE,
-                date DATE DEFAULT CURRENT_DATE 
+                date DATE DEFAULT CURRENT_DATE,
+                state TEXT DEFAULT 'done',
+                checkpoint INTEGER DEFAULT 0,
+                attempts INTEGER DEFAULT 0
+            )
+        ''')
+        # Databases from before the ledger only held processed files, which keep the 'done' default
+        self.cursor.execute('PRAGMA table_info(processed_files)')
+        columns = set(row[1] for row in self.cursor.fetchall())
+        for column, definition in (("state", "TEXT DEFAULT 'done'"), ("checkpoint", "INTEGER DEFAULT 0"),
+                                   ("attempts", "INTEGER DEFAULT 0")):
+            if column not in columns:
+                self.cursor.execute(f'ALTER TABLE processed_files ADD COLUMN {column} {definition}')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS processed_files_date ON processed_files (date, file_name)')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS processed_files_state ON processed_files (state)')
+        # Scan state per directory: its mtime when last listed and how many of its files were not processed yet
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS scanned_dirs (
+                path TEXT PRIMARY KEY,
+                parent TEXT,
+                mtime REAL,
+                pending INTEGER
             )
         ''')
         self.conn.commit()
 
-    def _get_all_files(self):
-        all_files = set()
-        for root, dirs, files in os.walk(self.path):
-            for file in files:
-                all_files.add(os.path.join(root, file))
-        return all_files
+    @staticmethod
+    def _get_date(file):
+        if "\\" in file:
+            return file.split("\\")[-2]
+        return file.split("/")[-2]
 
-    def _load_processed_files(self):
-        self.cursor.execute('SELECT file_name FROM processed_files')
-        return set([row[0] for row in self.cursor.fetchall()])
+    def _scan(self, take):
+        # Only list directories whose mtime changed or that still had unprocessed files, and walk
+        # unchanged directories through their known subdirectories
+        with self.lock:
+            self.cursor.execute('SELECT path, parent, mtime, pending FROM scanned_dirs')
+            known = {row[0]: row[1:] for row in self.cursor.fetchall()}
+        children = {}
+        for path, (parent, _, _) in known.items():
+            children.setdefault(parent, []).append(path)
 
-    def _save_processed_file(self, file):
-        if "\\" in file:
-            date = file.split("\\")[-2]
-        else:
-            date = file.split("/")[-2]
-        self.cursor.execute('INSERT OR IGNORE INTO processed_files (file_name, date) VALUES (?, ?)', (file, date,))
-        self.conn.commit()
+        updates = []
+        visited = set()
+        stack = [self.path]
+        while stack:
+            directory = stack.pop()
+            try:
+                mtime = os.stat(directory).st_mtime
+            except OSError:
+                continue
+            visited.add(directory)
+
+            state = known.get(directory)
+            if state is not None and state[1] == mtime and state[2] == 0:
+                stack.extend(children.get(directory, []))
+                continue
+
+            subdirs, files = [], []
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    (subdirs if entry.is_dir() else files).append(entry.path)
+            stack.extend(subdirs)
+
+            pending = 0
+            if files:
+                processed = self._processed_in(self._get_date(files[0]))
+                for file in files:
+                    if file in processed:
+                        continue
+                    pending += 1
+                    if file not in self.queued:
+                        take(file)
+            parent = os.path.dirname(directory) if directory != self.path else None
+            updates.append((directory, parent, mtime, pending))
+
+        # Every directory that still exists is reached, through its parent's listing or its known subdirectories
+        removed = [path for path in known if path not in visited]
+        with self.lock:
+            self.cursor.executemany('INSERT OR REPLACE INTO scanned_dirs (path, parent, mtime, pending) VALUES (?, ?, ?, ?)',
+                                    updates)
+            self.cursor.executemany('DELETE FROM scanned_dirs WHERE path = ?', [(path,) for path in removed])
+            self.conn.commit()
+
+    def _processed_in(self, date):
+        with self.lock:
+            self.cursor.execute('SELECT file_name FROM processed_files WHERE date = ? AND state IN (?, ?)',
+                                (date, DONE, FAILED))
+            return set(row[0] for row in self.cursor.fetchall())
+
+    def _is_processed(self, file):
+        with self.lock:
+            self.cursor.execute('SELECT 1 FROM processed_files WHERE date = ? AND file_name = ? AND state IN (?, ?)',
+                                (self._get_date(file), file, DONE, FAILED))
+            return self.cursor.fetchone() is not None
+
+    def _set_state(self, file, state):
+        date = self._get_date(file)
+        with self.lock:
+            self.cursor.execute('''
+                INSERT INTO processed_files (file_name, date, state) VALUES (?, ?, ?)
+                ON CONFLICT (file_name) DO UPDATE SET state = excluded.state
+            ''', (file, date, state))
+            self.conn.commit()
+
+    def _requeue_unfinished(self):
+        # Files that were queued or in progress when the recorder stopped are picked up again first,
+        # in progress ones from their last checkpoint
+        with self.lock:
+            self.cursor.execute('SELECT file_name FROM processed_files WHERE state IN (?, ?) ORDER BY date, file_name',
+                                (IN_PROGRESS, QUEUED))
+            files = [row[0] for row in self.cursor.fetchall()]
+        self._enqueue([file for file in files if os.path.exists(file)])
+
+    def _enqueue(self, files):
+        # Every batch is committed straight away. A transaction left open would hold the database's write lock,
+        # and the workers' checkpoint writes would time out waiting for it.
+        with self.lock:
+            self.cursor.executemany('INSERT OR IGNORE INTO processed_files (file_name, date, state) VALUES (?, ?, ?)',
+                                    [(file, self._get_date(file), QUEUED) for file in files])
+            self.conn.commit()
+        for file in files:
+            self.queued.add(file)
+            self.file_queue.put(file)
 
     def detect_new_files(self):
-        current_files = set(self._get_all_files())
-        new_files = current_files - self.existing_files
-        for file in new_files:
-            if file not in self.processed_files:
-                self.file_queue.put(file)
-        self.existing_files = current_files
+        # Queues every unprocessed file at once, for sources that are complete, e.g. an archive
+        self._enqueue(self.list_new_files())
+
+    def list_new_files(self):
+        new_files = []
+        self._scan(new_files.append)
+        return new_files
+
+    def add_file(self, file):
+        # Called by the SegmentWatcher once a segment is finished, queues each file at most once
+        if file in self.queued or self._is_processed(file):
+            return
+        self._enqueue([file])
 
     def get_file_queue(self):
         return self.file_queue
 
+    def start_file(self, file):
+        """
+        Mark a file as in progress before processing it.
+
+        Returns the frame to start processing from, which is the last checkpoint if an earlier attempt was
+        interrupted, or None if the file already failed max_attempts times and should be skipped. The attempt is
+        counted up front, so a crash that takes the recorder down still counts, and is taken back by interrupt
+        if the recorder is stopped cleanly.
+        """
+        with self.lock:
+            checkpoint, attempts = begin_file(self.conn, file, self._get_date(file))
+        self.started.add(file)
+        if attempts > self.max_attempts:
+            # The file stopped the recorder every time it was processed
+            print(f"Giving up on {file} after {attempts - 1} attempts")
+            self.mark_file_as_failed(file)
+            return None
+        if checkpoint:
+            print(f"Resuming {file} from frame {checkpoint}")
+        return checkpoint
+
+    def hand_over(self, file):
+        """
+        Note a file handed to a worker process, which counts its attempt with begin_file once it starts the file.
+        Until then it is queued, so interrupt does not take back an attempt of an earlier run.
+        """
+        self._set_state(file, QUEUED)
+        self.started.add(file)
+
+    def requeue(self, files):
+        """
+        Queue files again whose worker died, to be resumed from their checkpoints. Their attempts stay counted.
+        """
+        self.started.difference_update(files)
+        for file in files:
+            self.file_queue.put(file)
+
     def mark_file_as_processed(self, file):
-        self.processed_files.add(file)
-        self._save_processed_file(file)
+        self._set_state(file, DONE)
+        self.queued.discard(file)
+        self.started.discard(file)
+        self.prune()
+
+    def mark_file_as_failed(self, file):
+        self._set_state(file, FAILED)
+        self.queued.discard(file)
+        self.started.discard(file)
+
+    def interrupt(self):
+        """
+        Take back the attempts of the files in progress when the recorder is stopped cleanly, so files that are
+        only interrupted by restarts are never given up on. They resume from their checkpoints.
+        """
+        with self.lock:
+            self.cursor.executemany('UPDATE processed_files SET attempts = attempts - 1 '
+                                    'WHERE file_name = ? AND state = ? AND attempts > 0',
+                                    [(file, IN_PROGRESS) for file in self.started])
+            self.conn.commit()
+        self.started.clear()
+
+    def prune(self):
+        # Forget finished files from before the retention period once their source has been deleted,
+        # at most once an hour
+        if self.retention_days is None or time.time() - self.last_prune < 3600:
+            return
+        self.last_prune = time.time()
+        cutoff = (datetime.date.today() - datetime.timedelta(days=self.retention_days)).isoformat()
+        with self.lock:
+            self.cursor.execute('SELECT file_name FROM processed_files WHERE date < ? AND state IN (?, ?)',
+                                (cutoff, DONE, FAILED))
+            gone = [(row[0],) for row in self.cursor.fetchall() if not os.path.exists(row[0])]
+            self.cursor.executemany('DELETE FROM processed_files WHERE file_name = ?', gone)
+            self.conn.commit()
+        if gone:
+            print(f"Pruned {len(gone)} processed files older than {cutoff}")
+
+
+class CheckpointWriter:
+    """
+    Saves how far into a file the recorder got, from any process, using its own connection to the ledger.
+
+    Args:
+        db_file: The path of the FileManager's database.
+    """
+
+    def __init__(self, db_file):
+        self.conn = connect(db_file)
+
+    def start_file(self, file):
+        """
+        Mark a file as in progress from a worker process, see FileManager.start_file.
+
+        Returns:
+            tuple: The frame to resume from and the number of attempts, this one included.
+        """
+        return begin_file(self.conn, file, FileManager._get_date(file))
+
+    def __call__(self, file, frame_index):
+        # A checkpoint is only a shortcut for a restart, failing to save one must not fail the file
+        try:
+            self.conn.execute('UPDATE processed_files SET checkpoint = ? WHERE file_name = ? AND state = ?',
+                              (frame_index, file, IN_PROGRESS))
+            self.conn.commit()
+        except sqlite3.Error as e:
+            print(f"Failed to save checkpoint of {file}: {e}")
+            self.conn.rollback()
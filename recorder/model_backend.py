@@ -0,0 +1,209 @@
+import os
+import shutil
+
+import numpy as np
+import torch
+from ultralytics import YOLO
+
+from config_utils import get_available_cores
+
+BACKENDS = ("torch", "onnx")
+
+# Mean IoU an exported model's boxes need with the PyTorch model's boxes on the check images
+EXPORT_TOLERANCE = {"fp32": 0.95, "int8": 0.8}
+# Images in the batch exported models are checked on, the size of a full INFERENCE_BATCH_SIZE batch by default
+CHECK_BATCH = 4
+
+
+def default_device():
+    """
+    Returns the torch device to run a PyTorch model on, the GPU when there is one.
+    """
+    return torch.device("cuda" if torch.cuda.is_available() else "mps" if torch.backends.mps.is_available() else "cpu")
+
+
+def load_model(model_name, device=None, backend="torch", int8=False, cache_dir="models", threads=0, imgsz=640):
+    """
+    Load a YOLO model with the given inference backend.
+
+    With the onnx backend the model is exported to ONNX once, with a dynamic batch size so batched tracking
+    runs as one call, checked against the PyTorch model and cached in cache_dir, and later loads reuse the
+    cached file. int8 quantizes the exported model's weights. If the export fails or its outputs do not
+    match the PyTorch model's, the next best model is used: the unquantized ONNX model for int8, otherwise
+    the PyTorch model.
+
+    Args:
+        model_name (str): The name or path of the YOLO weights.
+        device: The torch device to run on. Chosen automatically if None.
+        backend (str): "torch" for PyTorch eager execution or "onnx" for ONNX Runtime.
+        int8 (bool): Use an int8-quantized ONNX model.
+        cache_dir (str): The directory exported models are cached in.
+        threads (int): Threads per ONNX Runtime session. 0 uses every core in the container's cpuset.
+        imgsz (int): The input size the ONNX model is exported for.
+
+    Returns:
+        YOLO: The loaded model. Its loaded_backend attribute says which model was loaded after any fallback:
+            "torch", "onnx" or "onnx-int8".
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown model backend {backend}, expected one of {BACKENDS}")
+    device = device or default_device()
+    if backend == "torch":
+        model = YOLO(model_name).to(device)
+        model.loaded_backend = "torch"
+        return model
+
+    path = export_onnx(model_name, cache_dir, imgsz, int8)
+    quantized = path is not None and int8
+    if path is None and int8:
+        path = export_onnx(model_name, cache_dir, imgsz, False)
+    if path is None:
+        print(f"Falling back to PyTorch for {model_name}")
+        model = YOLO(model_name).to(device)
+        model.loaded_backend = "torch"
+        return model
+
+    model = YOLO(path, task="detect")
+    configure_session(model, path, device, threads or get_available_cores(), imgsz)
+    model.loaded_backend = "onnx-int8" if quantized else "onnx"
+    return model
+
+
+def export_onnx(model_name, cache_dir, imgsz=640, int8=False):
+    """
+    Export a model to ONNX, unless it is cached already.
+
+    Args:
+        model_name (str): The name or path of the YOLO weights.
+        cache_dir (str): The directory exported models are cached in.
+        imgsz (int): The input size to export for.
+        int8 (bool): Quantize the weights to int8.
+
+    Returns:
+        str: The path of the ONNX model, or None if it could not be exported or does not match the
+            PyTorch model.
+    """
+    stem = os.path.splitext(os.path.basename(model_name))[0]
+    # Named apart from the static batch 1 exports earlier versions cached
+    path = os.path.join(cache_dir, f"{stem}-{imgsz}-dynamic{'-int8' if int8 else ''}.onnx")
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # Ultralytics picks the backend by the suffix, so the temporary file keeps .onnx
+    temp_path = f"{os.path.splitext(path)[0]}.{os.getpid()}.tmp.onnx"
+    try:
+        if int8:
+            fp32_path = export_onnx(model_name, cache_dir, imgsz, False)
+            if fp32_path is None:
+                return None
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            print(f"Quantizing {fp32_path} to int8")
+            quantize_dynamic(fp32_path, temp_path, weight_type=QuantType.QUInt8)
+        else:
+            print(f"Exporting {model_name} to ONNX")
+            exported = YOLO(model_name).export(format="onnx", imgsz=imgsz, simplify=True, dynamic=True)
+            shutil.move(exported, temp_path)
+        score = match_score(YOLO(model_name), YOLO(temp_path, task="detect"), imgsz)
+    except Exception as e:
+        print(f"Failed to export {model_name} to ONNX: {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return None
+
+    tolerance = EXPORT_TOLERANCE["int8" if int8 else "fp32"]
+    print(f"ONNX{' int8' if int8 else ''} model matches PyTorch with mean IoU {score:.3f} on {CHECK_BATCH} images")
+    if score < tolerance:
+        print(f"Not using the exported model, its boxes do not match PyTorch's within {tolerance}")
+        os.remove(temp_path)
+        return None
+    # Only checked models are moved into place, so the cache never holds a partial or mismatched export
+    os.replace(temp_path, path)
+    return path
+
+
+def match_score(reference, candidate, imgsz=640, batch=CHECK_BATCH):
+    """
+    Compare the detections of two models on a batch of the Ultralytics sample images, predicted in one call
+    the way batched tracking runs.
+
+    Returns:
+        float: For each box of the reference model, the best IoU with a box of the same class from the
+            candidate in the same image, averaged. 1.0 if neither model finds anything.
+    """
+    from ultralytics.utils import ASSETS
+    samples = [str(ASSETS / "bus.jpg"), str(ASSETS / "zidane.jpg")]
+    images = [samples[i % len(samples)] for i in range(batch)]
+    expected_results = reference.predict(images, imgsz=imgsz, verbose=False)
+    actual_results = candidate.predict(images, imgsz=imgsz, verbose=False)
+    if len(actual_results) != len(images):
+        return 0.0
+
+    scores = []
+    for expected, actual in zip(expected_results, actual_results):
+        expected, actual = expected.boxes, actual.boxes
+        if len(expected) == 0:
+            scores.append(1.0 if len(actual) == 0 else 0.0)
+            continue
+        expected_boxes, expected_cls = expected.xyxy.cpu().numpy(), expected.cls.cpu().numpy()
+        actual_boxes, actual_cls = actual.xyxy.cpu().numpy(), actual.cls.cpu().numpy()
+        for box, cls in zip(expected_boxes, expected_cls):
+            same = actual_boxes[actual_cls == cls]
+            scores.append(iou(box, same).max() if len(same) else 0.0)
+    return float(np.mean(scores))
+
+
+def iou(box, boxes):
+    """
+    Returns the IoU of one xyxy box with each of an (n, 4) array of xyxy boxes.
+    """
+    top_left = np.maximum(box[:2], boxes[:, :2])
+    bottom_right = np.minimum(box[2:], boxes[:, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=1)
+    area = np.prod(box[2:] - box[:2])
+    areas = np.prod(boxes[:, 2:] - boxes[:, :2], axis=1)
+    return intersection / (area + areas - intersection)
+
+
+def configure_session(model, path, device, threads, imgsz=640):
+    """
+    Run a model's ONNX Runtime session with a fixed thread count on CPU.
+
+    Ultralytics creates the session when the model first runs, with a thread pool sized for every core of
+    the host rather than the container's cpuset. On CPU that session is replaced by one with threads
+    intra-op threads, so several sessions in one container do not oversubscribe its cores. A GPU session
+    is kept as Ultralytics set it up. Ultralytics has no option for the session's threads, so the session
+    attribute of its backend is replaced; if that attribute is missing, or the backend binds its inputs to
+    the session it created, the session is kept and a message is printed.
+
+    Args:
+        model (YOLO): A model loaded from an ONNX file.
+        path (str): The ONNX file.
+        device: The torch device the model runs on.
+        threads (int): The number of intra-op threads.
+        imgsz (int): The input size, for the warmup run that creates the session.
+    """
+    import onnxruntime
+
+    model.predict(np.zeros((imgsz, imgsz, 3), dtype=np.uint8), imgsz=imgsz, verbose=False)
+    backend = getattr(model.predictor, "model", None)
+    providers = onnxruntime.get_available_providers()
+    if str(device).startswith("cuda") and "CUDAExecutionProvider" in providers:
+        print(f"Running {path} with ONNX Runtime on CUDA")
+        return
+
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.inter_op_num_threads = 1
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    # Static models run through an IO binding of the original session, which a new session would not update
+    if not isinstance(getattr(backend, "session", None), onnxruntime.InferenceSession) or \
+            not getattr(backend, "dynamic", True):
+        print(f"Cannot set the threads of {path}, running it with Ultralytics' ONNX Runtime session")
+        return
+    try:
+        backend.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+    except Exception as e:
+        print(f"Cannot set the threads of {path}, running it with Ultralytics' ONNX Runtime session: {e}")
+        return
+    print(f"Running {path} with ONNX Runtime on CPU with {threads} threads")
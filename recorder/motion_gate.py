@@ -0,0 +1,126 @@
+import cv2
+import numpy as np
+
+
+class MotionGate:
+    """
+    A cheap pixel-motion pre-filter that decides whether a frame is worth running the detector on.
+
+    Initializes the MotionGate with the exclusion polygon and thresholds. Each frame is shrunk to a small
+    grayscale copy and compared against a running-average background. The detector is woken when the
+    changed area outside the exclusion polygon crosses min_area, and is kept awake for cooldown seconds
+    after the motion ends.
+
+    Args:
+        mask_coords: Polygon, in mask_resolution coordinates, of the region to ignore.
+        min_area: Fraction of the unmasked area that has to change to count as motion.
+        cooldown: Seconds to keep the detector running after motion ends.
+        fps: Frames per second of the source, used to convert cooldown to frames.
+        width: Width of the grayscale copy used for the comparison.
+        mask_resolution: The (width, height) the polygon is drawn at, scaled to each frame's resolution. None means
+            the polygon is in the frames' own coordinates.
+    """
+
+    def __init__(self, mask_coords=None, min_area=0.002, cooldown=5, fps=20, width=320, mask_resolution=None):
+        self.mask_coords = mask_coords
+        self.mask_resolution = mask_resolution
+        self.min_area = min_area
+        self.cooldown = cooldown
+        self.width = width
+        self.cooldown_frames = int(cooldown * fps)
+
+        self.mask = None
+        self.mask_shape = None
+        self.mask_area = 0
+        self.background = None
+        self.frames_left = 0
+
+        self.frames_gated = 0
+        self.frames_inferred = 0
+
+    def reset(self, fps=None):
+        """
+        Forget the background model, e.g. when switching to a new video file.
+
+        Args:
+            fps: Frames per second of the new source. Keeps the current value if None.
+        """
+        if fps:
+            self.cooldown_frames = int(self.cooldown * fps)
+        self.background = None
+        self.frames_left = 0
+
+    def check(self, frame, force=False):
+        """
+        Update the background model with a frame and decide whether to run the detector on it.
+
+        Args:
+            frame: The full-resolution BGR frame.
+            force: Run the detector regardless of motion, e.g. while a clip is being recorded.
+
+        Returns:
+            bool: True if the detector should run on this frame.
+        """
+        small = self._prepare(frame)
+        if self.background is None:
+            self.background = small.astype(np.float32)
+            motion = True
+        else:
+            diff = cv2.absdiff(small, cv2.convertScaleAbs(self.background))
+            cv2.accumulateWeighted(small, self.background, 0.05)
+            _, changed = cv2.threshold(diff, 25, 255, cv2.THRESH_BINARY)
+            if self.mask is not None:
+                changed = cv2.bitwise_and(changed, changed, mask=self.mask)
+            motion = cv2.countNonZero(changed) > self.min_area * self.mask_area
+
+        if motion:
+            self.frames_left = self.cooldown_frames
+        elif self.frames_left > 0:
+            self.frames_left -= 1
+            motion = True
+
+        if motion or force:
+            self.frames_inferred += 1
+            return True
+        self.frames_gated += 1
+        return False
+
+    def _prepare(self, frame):
+        """
+        Shrink a frame to a blurred grayscale copy and build the matching mask for its resolution.
+
+        Args:
+            frame: The full-resolution BGR frame.
+
+        Returns:
+            The small grayscale frame.
+        """
+        h, w = frame.shape[:2]
+        small_h = max(1, int(h * self.width / w))
+        if self.mask_shape != (h, w):
+            self._build_mask(h, w, small_h)
+        small = cv2.resize(frame, (self.width, small_h), interpolation=cv2.INTER_AREA)
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(small, (5, 5), 0)
+
+    def _build_mask(self, h, w, small_h):
+        """
+        Scale the exclusion polygon down to the comparison resolution.
+        """
+        self.mask_shape = (h, w)
+        self.mask_area = self.width * small_h
+        self.mask = None
+        if self.mask_coords:
+            mask_w, mask_h = self.mask_resolution or (w, h)
+            scale = np.array([self.width / mask_w, small_h / mask_h])
+            polygon = (np.array(self.mask_coords) * scale).astype(np.int32)
+            self.mask = np.full((small_h, self.width), 255, dtype=np.uint8)
+            cv2.fillPoly(self.mask, [polygon], 0)
+            self.mask_area = cv2.countNonZero(self.mask)
+        self.background = None
+
+    def stats(self):
+        """
+        Returns the number of frames gated and inferred so far.
+        """
+        return {"gated": self.frames_gated, "inferred": self.frames_inferred}
@@ -1,79 +1,184 @@
-from ultralytics import YOLO
 import cv2
-import torch
-from collections import defaultdict
 import numpy as np
-import time
 import signal
 
+from track_store import TrackStore
+from clock import MediaClock, frame_time
+
 
 class MotionDetector:
-    def __init__(self, model_name, movement_threshold, delay_time, video_writer, mask_coords=None):
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "mps" if torch.backends.mps.is_available() else "cpu")
-        print(f"Using device: {self.device}")
-        self.model = YOLO(model_name).to(self.device)
+    def __init__(self, model_name, movement_threshold, delay_time, video_writer, mask_coords=None, detection_stride=1,
+                 motion_gate=None, checkpoint_interval=10, mask_resolution=(1920, 1080), clock=None,
+                 model=None, threshold_width=854):
+        # A preloaded model can be passed in instead, e.g. the benchmark's stub detector
+        if model is None:
+            # Imported here, so a detector given a model runs without torch and ultralytics installed
+            from model_backend import default_device, load_model
+            device = default_device()
+            print(f"Using device: {device}")
+            model = load_model(model_name, device)
+        self.model = model
+        # movement_threshold is in pixels of a threshold_width wide frame, the frames inference used to run on,
+        # and is scaled to the width of each file's frames
         self.movement_threshold = movement_threshold
+        self.threshold_width = threshold_width
+        self.threshold_scale = 1.0
         self.delay_time = delay_time
         self.video_writer = video_writer
-        self.track_history = defaultdict(lambda: [])
+        self.detection_stride = max(1, detection_stride)
+        self.motion_gate = motion_gate
+        # Seconds of video between checkpoints of the file being processed
+        self.checkpoint_interval = checkpoint_interval
+        self.track_history = TrackStore()
         self.motion_stop_time = None
+        # Seconds into the file being processed
+        self.position = 0
+        # delay_time is measured in video time by default, so clips do not depend on how fast files are processed
+        self.clock = clock or MediaClock()
 
-        # Load mask coordinates
-        if mask_coords:
-            self.mask = np.zeros((1080, 1920), dtype=np.uint8)
-            cv2.fillPoly(self.mask, [np.array(mask_coords)], 255)
-            self.mask = cv2.bitwise_not(self.mask)
-        else:
-            self.mask = None
+        # The mask polygon is given in mask_resolution coordinates and scaled to each stream's resolution
+        self.mask_coords = mask_coords
+        self.mask_resolution = mask_resolution
+        self.rois = {}
+        self.roi_offset = np.zeros(4, dtype=np.float32)
 
         # Register signal handlers
         signal.signal(signal.SIGTERM, self.signal_handler)
         signal.signal(signal.SIGINT, self.signal_handler)
 
-    def run(self, video_path):
+    def run(self, video_path, start_frame=0, checkpoint=None):
+        # Only every detection_stride-th frame is decoded for detection, the rest are grabbed
+        # without decoding unless a clip is being written.
+        # checkpoint(video_path, frame) is called every checkpoint_interval seconds of video while no clip
+        # is open, with the frame a later run can resume from as start_frame.
+        self.reset()
         cap = cv2.VideoCapture(video_path)
+        # Clips are written at the file's own resolution and frame rate
+        self.video_writer.set_source(int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                                     cap.get(cv2.CAP_PROP_FPS))
+        if self.motion_gate is not None:
+            # The gate only sees every detection_stride-th frame
+            self.motion_gate.reset(cap.get(cv2.CAP_PROP_FPS) / self.detection_stride)
+        fps = cap.get(cv2.CAP_PROP_FPS) or 20
+        checkpoint_frames = max(1, int(self.checkpoint_interval * fps))
+        if start_frame:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+        frame_index = start_frame - 1
         while cap.isOpened():
-            ret, frame = cap.read()
+            if not cap.grab():
+                break
+            frame_index += 1
+            self.position = frame_time(cap, frame_index, fps)
+            self.clock.advance(self.position)
+            if checkpoint is not None and frame_index % checkpoint_frames == 0 and not self.video_writer.recording:
+                # Every clip before this frame is finished, so resuming here neither loses nor repeats one
+                checkpoint(video_path, frame_index)
+            analyze = frame_index % self.detection_stride == 0
+            # Frames are only decoded when they are analyzed, recorded or kept for pre-roll
+            if not analyze and not self.video_writer.wants_frames():
+                continue
+            ret, frame = cap.retrieve()
             if not ret:
                 break
-            if self.mask is not None:
-                frame_masked = cv2.bitwise_and(frame, frame, mask=self.mask)
-                frame_masked_resized = cv2.resize(frame_masked, (854, 480))
-                results = self.model.track(frame_masked_resized, persist=True, verbose=False)
-            else:
-                results = self.model.track(frame, persist=True, verbose=False)
-            self.handle_tracking(results, filename=video_path)
+            if analyze and self.motion_gate is not None:
+                # Keep detecting while recording so the stop decision still sees the tracks
+                analyze = self.motion_gate.check(frame, force=self.video_writer.recording)
+            if analyze:
+                results = self.detect(frame)
+                self.handle_tracking(results, filename=video_path)
             if self.video_writer.recording:
                 self.video_writer.write_frame(frame)
+            else:
+                self.video_writer.buffer_frame(frame)
         cap.release()
+        # Close the clip with the file so every file's output is independent of the files before it
+        if self.video_writer.recording:
+            self.video_writer.stop_recording()
         self.video_writer.cleanup()
+        if self.motion_gate is not None:
+            print("Motion gate:", self.motion_gate.stats())
+        if self.video_writer.encoder is not None:
+            print("Encoder:", self.video_writer.encoder.stats())
+
+    def reset(self):
+        # Start every file with fresh tracks, whichever worker or order it is processed in
+        self.track_history.clear()
+        self.motion_stop_time = None
+        self.position = 0
+        self.clock.reset()
+        if self.video_writer.pre_roll is not None:
+            self.video_writer.pre_roll.clear()
+        predictor = self.model.predictor
+        if predictor is not None and hasattr(predictor, "trackers"):
+            for tracker in predictor.trackers:
+                tracker.reset()
+
+    def detect(self, frame):
+        # Only the bounding rectangle of the unmasked region is inferred on, boxes are moved back
+        # to full-frame coordinates in handle_tracking
+        (x, y, w, h), crop_mask = self.get_roi(frame.shape[:2])
+        self.threshold_scale = frame.shape[1] / self.threshold_width
+        crop = frame[y:y + h, x:x + w]
+        if crop_mask is not None:
+            crop = cv2.bitwise_and(crop, crop, mask=crop_mask)
+        self.roi_offset[:2] = (x, y)
+        return self.model.track(crop, persist=True, verbose=False)
+
+    def get_roi(self, shape):
+        # Built once per resolution: the bounding rectangle of the unmasked region, and the mask cropped
+        # to it, or None if nothing inside the rectangle is masked
+        roi = self.rois.get(shape)
+        if roi is not None:
+            return roi
+        frame_h, frame_w = shape
+        rect, crop_mask = (0, 0, frame_w, frame_h), None
+        if self.mask_coords:
+            scale = np.array([frame_w / self.mask_resolution[0], frame_h / self.mask_resolution[1]])
+            polygon = np.round(np.array(self.mask_coords) * scale).astype(np.int32)
+            mask = np.full((frame_h, frame_w), 255, dtype=np.uint8)
+            cv2.fillPoly(mask, [polygon], 0)
+            allowed = cv2.findNonZero(mask)
+            if allowed is not None:
+                rect = cv2.boundingRect(allowed)
+                x, y, w, h = rect
+                crop_mask = mask[y:y + h, x:x + w]
+                if cv2.countNonZero(crop_mask) == w * h:
+                    crop_mask = None
+        roi = self.rois[shape] = (rect, crop_mask)
+        if self.mask_coords and rect[2:] == (frame_w, frame_h):
+            print(f"The unmasked region spans the whole {frame_w}x{frame_h} frame, cropping to it saves nothing")
+        else:
+            print(f"Inferring on {rect[2]}x{rect[3]} at ({rect[0]}, {rect[1]}) of {frame_w}x{frame_h} frames")
+        return roi
 
     def handle_tracking(self, results, filename=None):
-        boxes = results[0].boxes.xywh.cpu()
+        # Frames without tracks still update the store, so tracks that disappeared age out
+        track_ids, centers, classes = [], None, set()
         if results[0].boxes.id is not None:
-            boxes_cpu = results[0].boxes.cpu()
-            #clss = boxes_cpu.cls.tolist()  # can filter unwanted classes
-            #names = results[0].names # all class names in model
-            track_ids = boxes_cpu.id.int().tolist()
-            for box, track_id in zip(boxes, track_ids):
-                self.track_history[track_id].append((box[0], box[1]))
-                if len(self.track_history[track_id]) >= 2:
-                    self.plot_tracks(track_id, filename)
+            classes = {results[0].names[int(cls)] for cls in results[0].boxes.cls.cpu().tolist()}
+            boxes = results[0].boxes.xywh.cpu().numpy() + self.roi_offset
+            track_ids = results[0].boxes.id.int().cpu().tolist()
+            centers = boxes[:, :2]
+        displacements = self.track_history.update(track_ids, centers)
+        # Frames without moving tracks count as still, so a clip stops once the scene empties
+        self.plot_tracks(displacements, filename)
+        # What is seen while recording goes into the clip's index row
+        self.video_writer.annotate(classes, track_ids, displacements)
 
-    def plot_tracks(self, track_id, filename):
-        prev_center = np.array(self.track_history[track_id][-2])
-        curr_center = np.array(self.track_history[track_id][-1])
-        displacement = np.linalg.norm(curr_center - prev_center)
-        self.motion_stop_time = None
-        if displacement >= self.movement_threshold:
+    def plot_tracks(self, displacements, filename):
+        # Decided once per analyzed frame from the displacement of every track since its previous detection.
+        # With a stride the stop timer is only checked on analyzed frames, at most detection_stride frames late
+        # Consecutive detections are detection_stride frames apart, so scale the per-frame threshold
+        threshold = self.movement_threshold * self.threshold_scale * self.detection_stride
+        if (displacements >= threshold).any():
             if not self.video_writer.recording:
-                self.video_writer.start_recording(filename)
+                self.video_writer.start_recording(filename, self.position)
             self.motion_stop_time = None
         else:
             if self.motion_stop_time is None:
-                self.motion_stop_time = time.time()
-            if self.video_writer.recording and (time.time() - self.motion_stop_time) > self.delay_time:
-                self.video_writer.stop_recording()
+                self.motion_stop_time = self.clock.now()
+            if self.video_writer.recording and (self.clock.now() - self.motion_stop_time) > self.delay_time:
+                self.video_writer.stop_recording(self.position)
                 self.track_history.clear()
                 self.motion_stop_time = None
 
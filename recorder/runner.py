@@ -1,28 +1,50 @@
-from filemanager import FileManager
-from video_writer import VideoWriter
-from motiondetector import MotionDetector
+import signal
+import sys
+
+from filemanager import FileManager, CheckpointWriter
+from worker_pool import build_motion_detector, run_parallel
+from segment_watcher import SegmentWatcher
 import config
 
 
 if __name__ == "__main__":
     video_path = config.VIDEO_SOURCE
-    file_manager = FileManager(video_path)
+    file_manager = FileManager(video_path, config.PROCESSED_DB, config.DAY_THRESHOLD, config.MAX_ATTEMPTS)
+    segment_watcher = SegmentWatcher(video_path, file_manager, config.WATCH_MODE, config.WATCH_POLL_INTERVAL,
+                                     config.WATCH_SETTLE_TIME)
+    segment_watcher.start()
+    motion_detector = None
 
-    video_dir = config.CLIP_DEST
-    video_writer = VideoWriter(video_dir, 1920, 1080, 20)
+    def shutdown(signum, frame):
+        # A clean stop does not count as an attempt at the files in progress
+        print("Shutting down")
+        if motion_detector is not None:
+            motion_detector.signal_handler(signum, frame)
+        file_manager.interrupt()
+        sys.exit(0)
 
-    model_name = config.MODEL_NAME
-    movement_threshold = config.MOVEMENT_THRESHOLD
-    delay_time = config.DELAY_TIME
-    mask_coords = config.MASK_COORDS
-    motion_detector = MotionDetector(model_name, movement_threshold, delay_time, video_writer, mask_coords)
-    while True:
-        file_manager.detect_new_files()
+    if config.WORKERS > 1:
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+        run_parallel(file_manager, config.WORKERS)
+    else:
+        motion_detector = build_motion_detector()
+        # Installed after the detector, which installs its own handlers
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+        checkpoint_writer = CheckpointWriter(file_manager.db_file)
         file_queue = file_manager.get_file_queue()
-
-        while not file_queue.empty():
+        while True:
             video_file = file_queue.get()
+            start_frame = file_manager.start_file(video_file)
+            if start_frame is None:
+                continue
             print("Processing file:", video_file)
+            try:
+                motion_detector.run(video_file, start_frame, checkpoint_writer)
+            except Exception as e:
+                print(f"Failed to process file {video_file}: {e}")
+                file_manager.mark_file_as_failed(video_file)
+                continue
             file_manager.mark_file_as_processed(video_file)
-            motion_detector.run(video_file)
 
@@ -0,0 +1,125 @@
+import os
+import threading
+import time
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+
+class SegmentWatcher(threading.Thread):
+    """
+    A background thread that hands new video segments to the FileManager once the bridge has finished writing them.
+
+    Initializes the SegmentWatcher with the directory to watch. On Linux with inotify_simple installed it
+    watches the directory tree for close-write and move events, so no directories are rescanned. Otherwise it
+    falls back to polling, and a new file is only handed over once its size has stopped changing for
+    settle_time seconds. The files already there when it starts, the one the bridge is still writing
+    included, go through the same settle check in both modes. With inotify they are checked after the
+    watches are added, so a file closed in between is not missed.
+
+    Args:
+        path: The directory the bridge records segments into.
+        file_manager: The FileManager to hand finished segments to.
+        mode: "auto" to use inotify when available, "inotify" or "poll" to force one.
+        poll_interval: Seconds between scans when polling.
+        settle_time: Seconds a file's size has to stay the same before it counts as finished when polling.
+    """
+
+    def __init__(self, path, file_manager, mode="auto", poll_interval=5, settle_time=2):
+        super().__init__(daemon=True)
+        if mode == "inotify" and INotify is None:
+            raise RuntimeError("inotify mode needs the inotify_simple package")
+        self.path = path
+        self.file_manager = file_manager
+        self.use_inotify = mode == "inotify" or (mode == "auto" and INotify is not None)
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+
+        self.watches = {}
+        self.candidates = {}
+        self.shutdown_flag = threading.Event()
+
+    def run(self):
+        print(f"Watching {self.path} for new segments ({'inotify' if self.use_inotify else 'polling'})")
+        if self.use_inotify:
+            self._run_inotify()
+        else:
+            self._run_polling()
+
+    def stop(self):
+        self.shutdown_flag.set()
+
+    def _run_inotify(self):
+        inotify = INotify()
+        self._watch_tree(inotify, self.path)
+        # Files from before the watches existed are settled like polled ones, until each is handed over here or
+        # by its close-write event
+        startup = self._settle(self.file_manager.list_new_files())
+        next_check = time.monotonic() + self.poll_interval
+        while not self.shutdown_flag.is_set():
+            if startup and time.monotonic() >= next_check:
+                startup = self._settle([path for path in startup if path not in self.file_manager.queued])
+                next_check = time.monotonic() + self.poll_interval
+            for event in inotify.read(timeout=1000):
+                directory = self.watches.get(event.wd)
+                if directory is None or not event.name:
+                    continue
+                path = os.path.join(directory, event.name)
+                if event.mask & flags.ISDIR:
+                    if event.mask & (flags.CREATE | flags.MOVED_TO):
+                        self._watch_tree(inotify, path, pick_up=bool(event.mask & flags.MOVED_TO))
+                elif event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO):
+                    self.file_manager.add_file(path)
+        inotify.close()
+
+    def _watch_tree(self, inotify, root, pick_up=False):
+        """
+        Watch a directory and everything below it.
+
+        Args:
+            inotify: The inotify instance to add the watches to.
+            root: The directory to watch.
+            pick_up: Hand over the files already in the tree, for directories moved in whole.
+        """
+        mask = flags.CREATE | flags.CLOSE_WRITE | flags.MOVED_TO
+        for directory, _, files in os.walk(root):
+            self.watches[inotify.add_watch(directory, mask)] = directory
+            if pick_up:
+                for file in files:
+                    self.file_manager.add_file(os.path.join(directory, file))
+
+    def _run_polling(self):
+        self._settle(self.file_manager.list_new_files())
+        while not self.shutdown_flag.wait(self.poll_interval):
+            self._settle(self.file_manager.list_new_files())
+
+    def _settle(self, paths):
+        """
+        Hand over the files whose size has not changed for settle_time seconds.
+
+        Args:
+            paths: The unprocessed files to check.
+
+        Returns:
+            list: The files that are still settling.
+        """
+        now = time.monotonic()
+        settling = []
+        for path in paths:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                self.candidates.pop(path, None)
+                continue
+            previous = self.candidates.get(path)
+            if previous is None or previous[0] != size:
+                self.candidates[path] = (size, now)
+                settling.append(path)
+            elif now - previous[1] >= self.settle_time:
+                del self.candidates[path]
+                self.file_manager.add_file(path)
+            else:
+                settling.append(path)
+        return settling
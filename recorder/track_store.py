@@ -0,0 +1,105 @@
+import numpy as np
+
+
+class TrackStore:
+    """
+    The recent centre points of every live track, kept in preallocated numpy ring arrays.
+
+    Initializes the TrackStore with room for capacity tracks, which grows when more are live at once.
+    Each track id gets a row of a (tracks, length, 2) array, and its last length centre points are
+    written into that row round-robin. All tracks seen in a frame are updated together, and their
+    displacements since their previous point are computed in one vectorized call. Tracks that have not
+    been seen for max_age updates are evicted and their rows reused.
+
+    Args:
+        capacity: The number of tracks to allocate rows for up front.
+        length: The number of points kept per track.
+        max_age: Updates a track can go unseen before it is evicted.
+    """
+
+    def __init__(self, capacity=64, length=30, max_age=30):
+        self.length = length
+        self.max_age = max_age
+        self.points = np.zeros((capacity, length, 2), dtype=np.float32)
+        self.counts = np.zeros(capacity, dtype=np.int64)
+        self.last_seen = np.zeros(capacity, dtype=np.int64)
+        self.ids = np.full(capacity, -1, dtype=np.int64)
+        self.rows = {}
+        self.free = list(range(capacity - 1, -1, -1))
+        self.frame = 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def update(self, track_ids, centers):
+        """
+        Add the centre points of the tracks seen in one frame.
+
+        Args:
+            track_ids: The track ids, one per box.
+            centers: An (n, 2) array of the boxes' centre points.
+
+        Returns:
+            numpy.ndarray: The distance each track moved since its previous point, for the tracks that
+                have one.
+        """
+        self.frame += 1
+        self._evict()
+        if len(track_ids) == 0:
+            return np.zeros(0, dtype=np.float32)
+
+        rows = np.fromiter((self._row(track_id) for track_id in track_ids), dtype=np.int64, count=len(track_ids))
+        centers = np.asarray(centers, dtype=np.float32).reshape(-1, 2)
+        previous = self.points[rows, (self.counts[rows] - 1) % self.length]
+        has_previous = self.counts[rows] > 0
+
+        self.points[rows, self.counts[rows] % self.length] = centers
+        self.counts[rows] += 1
+        self.last_seen[rows] = self.frame
+        return np.linalg.norm(centers[has_previous] - previous[has_previous], axis=1)
+
+    def history(self, track_id):
+        """
+        Returns the points of a track, oldest first, as an (n, 2) array.
+        """
+        row = self.rows.get(track_id)
+        if row is None:
+            return np.zeros((0, 2), dtype=np.float32)
+        count = self.counts[row]
+        if count <= self.length:
+            return self.points[row, :count].copy()
+        return np.roll(self.points[row], -(count % self.length), axis=0)
+
+    def clear(self):
+        """
+        Forget every track.
+        """
+        self.counts[:] = 0
+        self.ids[:] = -1
+        self.rows.clear()
+        self.free = list(range(len(self.ids) - 1, -1, -1))
+
+    def _row(self, track_id):
+        row = self.rows.get(track_id)
+        if row is None:
+            if not self.free:
+                self._grow()
+            row = self.rows[track_id] = self.free.pop()
+            self.ids[row] = track_id
+            self.counts[row] = 0
+        return row
+
+    def _evict(self):
+        stale = np.flatnonzero((self.ids >= 0) & (self.frame - self.last_seen > self.max_age))
+        for row in stale:
+            del self.rows[int(self.ids[row])]
+            self.ids[row] = -1
+            self.free.append(int(row))
+
+    def _grow(self):
+        capacity = len(self.ids)
+        self.points = np.concatenate([self.points, np.zeros_like(self.points)])
+        self.counts = np.concatenate([self.counts, np.zeros(capacity, dtype=np.int64)])
+        self.last_seen = np.concatenate([self.last_seen, np.zeros(capacity, dtype=np.int64)])
+        self.ids = np.concatenate([self.ids, np.full(capacity, -1, dtype=np.int64)])
+        self.free = list(range(2 * capacity - 1, capacity - 1, -1))
@@ -1,49 +1,93 @@
 import datetime
+import functools
 import os
+import re
+import threading
+import time
 import zoneinfo
+from collections import deque
+
 import cv2
 
+from clip_index import ClipRecord
+
 
 class VideoWriter:
     """
     A class for writing video frames to a video file.
 
     Initializes the VideoWriter object with the video directory, width, height, and frames per second.
+    set_source updates them for each source file, so cameras of any resolution and frame rate are recorded.
 
     Args:
         video_dir: The directory to save the video file.
-        w: The width of the video frames.
-        h: The height of the video frames.
-        fps: The frames per second of the video.
+        w: The width of the video frames, until a source file sets it.
+        h: The height of the video frames, until a source file sets it.
+        fps: The frames per second of the video, until a source file sets it.
+        pre_roll: Seconds of frames from before the recording started to include in each clip.
+        pre_roll_bytes: The memory cap of the pre-roll buffer in bytes.
+        encoder_queue: The number of frames that can wait for a background encoder thread. 0 encodes
+            frames synchronously in write_frame.
+        encoder_overflow: What the encoder does when its queue is full, see EncoderThread.
+        clip_index (ClipIndex): The index each clip is added to once its file is closed, with what was
+            detected while it was recorded. None disables indexing.
+        pre_roll_source: Read the pre-roll back from the source file when a clip starts instead of buffering
+            frames, so frames that are not analyzed never have to be decoded for it. For a detection stride.
 
     Returns:
         None
     """
 
-    def __init__(self, video_dir, w, h, fps):
+    def __init__(self, video_dir, w, h, fps, pre_roll=0, pre_roll_bytes=256 * 1024 * 1024,
+                 encoder_queue=0, encoder_overflow="block", clip_index=None, pre_roll_source=False):
         self.video_dir = video_dir
         self.w = w
         self.h = h
         self.fps = fps
+        self.pre_roll = PreRollBuffer(pre_roll, fps, pre_roll_bytes) if pre_roll > 0 else None
+        self.pre_roll_seconds = pre_roll
+        self.pre_roll_source = pre_roll_source
+        # The source file and position the last clip stopped at, so a read back pre-roll never repeats its frames
+        self.last_stop = (None, 0.0)
+        self.clip_source = None
+        self.encoder = EncoderThread(encoder_queue, encoder_overflow) if encoder_queue > 0 else None
+        self.clip_index = clip_index
+        self.clip = None
 
         self.video_writer = None
         self.recording = False
 
-    def start_recording(self, filename):
+    def set_source(self, w, h, fps):
+        """
+        Match the clips to the source file about to be processed. cv2.VideoWriter drops frames of any other size
+        without an error. Values the source does not report, 0, keep the current ones.
+
+        Args:
+            w: The width of the source's frames.
+            h: The height of the source's frames.
+            fps: The frames per second of the source.
+        """
+        self.w = w or self.w
+        self.h = h or self.h
+        if fps and fps != self.fps:
+            self.fps = fps
+            # The pre-roll holds the same number of seconds at the new frame rate
+            if self.pre_roll is not None:
+                self.pre_roll = PreRollBuffer(self.pre_roll_seconds, fps, self.pre_roll.max_bytes)
+
+    def start_recording(self, filename, position=None):
         """
         Initialize the video writer to start recording a video.
+
+        Args:
+            filename (str): The path of the source video file.
+            position (float): Seconds into the source file, the pre-roll ends there when it is read back from the
+                source. Otherwise frames are written as they arrive.
         """
         if not self.video_writer:
             self.recording = True
-            date = filename.split("/")[-2]
-            time = "_".join(filename.split("/")[-1].split("_")[1:])
-            filename_dest = f"{self.video_dir}/{date}/{time}"
-            self._create_directory(filename_dest)
-            base_filename = filename_dest
-            counter = 1
-            while os.path.exists(filename_dest):
-                filename_dest = f"{base_filename.split('.')[0]}_{counter}.mp4"
-                counter += 1
+            self.clip_source = filename
+            filename_dest = self._destination(filename)
             self.video_writer = cv2.VideoWriter(
                 filename_dest,
                 cv2.VideoWriter_fourcc(*'mp4v'),
@@ -51,6 +95,117 @@ class VideoWriter:
                 (self.w, self.h),
             )
             print("Created video_writer")
+            pre_roll_frames = len(self.pre_roll.frames) if self.pre_roll is not None else 0
+            offset = None if position is None else position - pre_roll_frames / max(self.fps, 1)
+            if self.pre_roll_source and self.pre_roll_seconds > 0 and position is not None:
+                offset = self._read_pre_roll(filename, position)
+            self.clip = self._clip_record(filename, filename_dest, offset)
+            self._flush_pre_roll()
+
+    def _read_pre_roll(self, filename, position):
+        """
+        Write the frames of the pre-roll to the start of the clip, decoded from the source file.
+
+        Args:
+            filename (str): The path of the source video file.
+            position (float): Seconds into the source file where the clip's first detected frame is.
+
+        Returns:
+            float: Seconds into the source file where the clip starts.
+        """
+        start = position - self.pre_roll_seconds
+        if self.last_stop[0] == filename:
+            start = max(start, self.last_stop[1])
+        cap = cv2.VideoCapture(filename)
+        try:
+            fps = cap.get(cv2.CAP_PROP_FPS) or self.fps
+            first, end = max(0, round(start * fps)), round(position * fps)
+            if first < end:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, first)
+            for _ in range(end - first):
+                success, frame = cap.read()
+                if not success:
+                    break
+                self._write(frame, block=True)
+        finally:
+            cap.release()
+        return first / fps
+
+    def _clip_record(self, filename, filename_dest, offset):
+        """
+        Start the metadata of a clip cut from a source file.
+
+        Args:
+            filename (str): The path of the source video file, in a <camera>/<date> folder.
+            filename_dest (str): The path of the clip.
+            offset (float): Seconds into the source file where the clip starts, None if unknown.
+        """
+        parts = filename.split("/")
+        camera = parts[-3] if len(parts) >= 3 else ""
+        start = segment_start(filename)
+        offset = None if offset is None else max(0.0, offset)
+        start_time = start + offset if start is not None and offset is not None else None
+        return ClipRecord(filename_dest, camera, filename, start_time, offset)
+
+    def _finish_clip(self, position):
+        """
+        Close the metadata of the current clip.
+
+        Args:
+            position (float): Seconds into the source file where the clip ends, None if unknown.
+
+        Returns:
+            ClipRecord: The clip's metadata, None if there is no clip or clip index.
+        """
+        clip, self.clip = self.clip, None
+        if clip is None or self.clip_index is None:
+            return None
+        start = segment_start(clip.source)
+        if start is not None and position is not None:
+            clip.end_time = start + position
+        return clip
+
+    def _index(self, clip):
+        """
+        Add a closed clip to the clip index. A failure is logged, it never stops the recording.
+        """
+        try:
+            self.clip_index.add(clip)
+        except Exception as e:
+            print(f"Failed to index {clip.path}: {e}")
+
+    def annotate(self, classes, track_ids, displacements):
+        """
+        Add the detections of a frame to the metadata of the clip being recorded.
+
+        Args:
+            classes: The class names detected in the frame.
+            track_ids: The ids of the tracks in the frame.
+            displacements: How far each track moved since its previous point, in pixels.
+        """
+        if self.clip is not None:
+            self.clip.observe(classes, track_ids, displacements)
+
+    def _destination(self, filename):
+        """
+        Build a free clip path in the date folder of the source file, and create its directory.
+        """
+        date = filename.split("/")[-2]
+        time = "_".join(filename.split("/")[-1].split("_")[1:])
+        filename_dest = f"{self.video_dir}/{date}/{time}"
+        self._create_directory(filename_dest)
+        base_filename = filename_dest
+        counter = 1
+        while os.path.exists(filename_dest):
+            filename_dest = f"{base_filename.split('.')[0]}_{counter}.mp4"
+            counter += 1
+        return filename_dest
+
+    def wants_frames(self):
+        """
+        Returns True if frames that are not analyzed still need to be decoded and passed to the writer.
+        """
+        return self.recording or (self.pre_roll is not None and not self.pre_roll_source)
 
     def _generate_filename(self):
         """
@@ -68,6 +223,25 @@ class VideoWriter:
         directory = os.path.dirname(filename)
         os.makedirs(directory, exist_ok=True)
 
+    def _flush_pre_roll(self):
+        """
+        Write the buffered pre-roll frames to the start of the clip. They wait for room in the encoder queue
+        whatever its overflow policy, a burst of pre-roll frames would otherwise be dropped at every clip start.
+        """
+        if self.pre_roll is not None:
+            for frame in self.pre_roll.drain():
+                self._write(frame, block=True)
+
+    def buffer_frame(self, frame):
+        """
+        Keep a frame that was not recorded in the pre-roll buffer, if pre-roll is enabled.
+
+        Args:
+            frame (np.array): A frame that was not written to a clip.
+        """
+        if self.pre_roll is not None and not self.pre_roll_source:
+            self.pre_roll.append(frame)
+
     def write_frame(self, frame):
         """
         Write a frame to the video.
@@ -75,21 +249,250 @@ class VideoWriter:
         Args:
             frame (np.array): A frame to write to the video.
         """
-        self.video_writer.write(frame)
+        self._write(frame)
 
-    def stop_recording(self):
+    def _write(self, frame, block=False):
         """
-        Stop recording a video.
+        Write a frame to the current clip, through the encoder thread if there is one. With block, the frame waits
+        for room in the encoder queue instead of following its overflow policy.
         """
-        if self.video_writer is not None:
+        if self.encoder is not None:
+            self.encoder.submit(self.video_writer, frame, block)
+        else:
+            self.video_writer.write(frame)
+
+    def _release(self, position=None):
+        """
+        Close the current clip once all of its frames are written, then add it to the clip index.
+        """
+        clip = self._finish_clip(position)
+        done = functools.partial(self._index, clip) if clip is not None else None
+        if self.encoder is not None:
+            self.encoder.release(self.video_writer, done)
+        else:
             self.video_writer.release()
+            if done is not None:
+                done()
         self.video_writer = None
+
+    def stop_recording(self, position=None):
+        """
+        Stop recording a video.
+
+        Args:
+            position (float): Seconds into the source file where the clip ends, for its index row.
+        """
+        if self.video_writer is not None:
+            self._release(position)
+            if position is not None and self.clip_source is not None:
+                self.last_stop = (self.clip_source, position)
         self.recording = False
         print("Stopped recording")
 
     def cleanup(self):
         """
-        Cleanup the video writer.
+        Cleanup the video writer, waiting for queued frames to be encoded.
         """
         if self.video_writer is not None:
-            self.video_writer.release()
+            self._release()
+        self.recording = False
+        if self.encoder is not None:
+            self.encoder.flush()
+
+
+def segment_start(filename):
+    """
+    Returns the Unix time a source segment starts at, from its <date>/<camera>_HH_MM_SS file name, or None if
+    the name does not have that format.
+    """
+    parts = filename.split("/")
+    match = re.search(r"(\d{2})_(\d{2})_(\d{2})\.\w+$", parts[-1])
+    if match is None or len(parts) < 2:
+        return None
+    try:
+        start = datetime.datetime.strptime(f"{parts[-2]} {':'.join(match.groups())}", "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return None
+    return start.replace(tzinfo=zoneinfo.ZoneInfo("America/Vancouver")).timestamp()
+
+
+class PreRollBuffer:
+    """
+    A bounded buffer of the most recent frames, flushed into a clip when recording starts.
+
+    Holds references to the frames rather than copies, and drops the oldest frames once either the
+    frame count or the byte size exceeds its limit.
+
+    Args:
+        seconds: The length of the pre-roll in seconds.
+        fps: The frames per second of the video.
+        max_bytes: The maximum total size of the buffered frames in bytes.
+    """
+
+    def __init__(self, seconds, fps, max_bytes):
+        self.max_frames = int(seconds * fps)
+        self.max_bytes = max_bytes
+        self.frames = deque()
+        self.nbytes = 0
+
+    def append(self, frame):
+        """
+        Add a frame, dropping the oldest frames if the buffer is over its limits.
+
+        Args:
+            frame (np.array): The frame to buffer.
+        """
+        self.frames.append(frame)
+        self.nbytes += frame.nbytes
+        while self.frames and (len(self.frames) > self.max_frames or self.nbytes > self.max_bytes):
+            self.nbytes -= self.frames.popleft().nbytes
+
+    def drain(self):
+        """
+        Remove and return the buffered frames, oldest first.
+        """
+        frames = list(self.frames)
+        self.clear()
+        return frames
+
+    def clear(self):
+        """
+        Drop all buffered frames.
+        """
+        self.frames.clear()
+        self.nbytes = 0
+
+
+class EncoderThread(threading.Thread):
+    """
+    A background thread that encodes frames so writing a clip does not block the caller.
+
+    Initializes and starts the EncoderThread with a bounded queue. Frames are queued together with the
+    cv2.VideoWriter they belong to, so a clip can keep draining after the next one has started. Releasing
+    a writer is queued behind its frames, followed by its callback if it has one.
+
+    Args:
+        max_frames: The maximum number of frames waiting to be encoded.
+        overflow: What to do when the queue is full. "block" waits for room, "drop-oldest" discards the
+            oldest waiting frame and "drop-newest" discards the new frame.
+    """
+
+    OVERFLOW_POLICIES = ("block", "drop-oldest", "drop-newest")
+
+    def __init__(self, max_frames=30, overflow="block"):
+        super().__init__(daemon=True)
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown encoder overflow policy {overflow}, expected one of {self.OVERFLOW_POLICIES}")
+        self.max_frames = max_frames
+        self.overflow = overflow
+
+        self.items = deque()
+        self.condition = threading.Condition()
+        self.busy = False
+
+        self.frames_waiting = 0
+        self.frames_encoded = 0
+        self.frames_dropped = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+        self.start()
+
+    def submit(self, writer, frame, block=False):
+        """
+        Queue a frame to be written.
+
+        Args:
+            writer (cv2.VideoWriter): The writer of the clip the frame belongs to.
+            frame (np.array): The frame to write.
+            block: Wait for room when the queue is full, whatever the overflow policy. drop-oldest never drops
+                such a frame either, e.g. the pre-roll of a clip.
+
+        Returns:
+            bool: False if the frame was dropped.
+        """
+        with self.condition:
+            if self.frames_waiting >= self.max_frames:
+                if block or self.overflow == "block" or (self.overflow == "drop-oldest" and not self._drop_oldest()):
+                    self.condition.wait_for(lambda: self.frames_waiting < self.max_frames)
+                elif self.overflow == "drop-newest":
+                    self.frames_dropped += 1
+                    return False
+            self.items.append((writer, frame, time.monotonic(), block, None))
+            self.frames_waiting += 1
+            self.condition.notify_all()
+        return True
+
+    def release(self, writer, done=None):
+        """
+        Queue the release of a writer after the frames already queued for it.
+
+        Args:
+            writer (cv2.VideoWriter): The writer to release.
+            done: Function called on the encoder thread once the writer is released.
+        """
+        with self.condition:
+            self.items.append((writer, None, time.monotonic(), True, done))
+            self.condition.notify_all()
+
+    def _drop_oldest(self):
+        """
+        Drop the oldest waiting frame that was not queued with block.
+
+        Returns:
+            bool: False if every waiting frame was queued with block.
+        """
+        for i, (_, frame, _, keep, _) in enumerate(self.items):
+            if frame is not None and not keep:
+                del self.items[i]
+                self.frames_waiting -= 1
+                self.frames_dropped += 1
+                return True
+        return False
+
+    def run(self):
+        """
+        Write queued frames and release queued writers, in order.
+        """
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.items)
+                writer, frame, queued, _, done = self.items.popleft()
+                self.busy = True
+
+            if frame is None:
+                writer.release()
+                if done is not None:
+                    done()
+            else:
+                writer.write(frame)
+
+            with self.condition:
+                if frame is not None:
+                    self.frames_waiting -= 1
+                    self.frames_encoded += 1
+                    self.last_lag = time.monotonic() - queued
+                    self.max_lag = max(self.max_lag, self.last_lag)
+                self.busy = False
+                self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Wait until every queued frame is written and every queued writer released.
+
+        Args:
+            timeout: Seconds to wait. Waits forever if None.
+
+        Returns:
+            bool: False if the queue did not drain in time.
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.items and not self.busy, timeout)
+
+    def stats(self):
+        """
+        Returns the queue depth, frame counters and the lag between queuing and writing a frame in seconds.
+        """
+        with self.condition:
+            return {"queued": self.frames_waiting, "encoded": self.frames_encoded, "dropped": self.frames_dropped,
+                    "lag": self.last_lag, "max_lag": self.max_lag}
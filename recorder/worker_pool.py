@@ -0,0 +1,171 @@
+import multiprocessing
+import os
+import queue
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from video_writer import VideoWriter
+from clip_extractor import ClipExtractor
+from clip_index import ClipIndex
+from motiondetector import MotionDetector
+from motion_gate import MotionGate
+from filemanager import CheckpointWriter
+from config_utils import get_available_cores
+from model_backend import default_device, export_onnx, load_model
+import config
+
+# Each worker process builds its own detector, and with it its own model and tracker state,
+# and its own connection for saving checkpoints
+motion_detector = None
+checkpoint_writer = None
+
+
+def build_motion_detector(threads=0):
+    """
+    Build a MotionDetector, with its model, VideoWriter and motion gate, from the config.
+
+    Args:
+        threads (int): ONNX Runtime threads for the model, if INFERENCE_THREADS does not set them.
+            0 uses every available core.
+
+    Returns:
+        MotionDetector: The detector used to process video files.
+    """
+    # Every worker has its own connection to the clip index
+    clip_index = ClipIndex(config.CLIP_INDEX_DB) if config.CLIP_INDEX_DB else None
+    if config.CLIP_MODE == "copy":
+        video_writer = ClipExtractor(config.CLIP_DEST, config.PRE_ROLL_SECONDS, config.CLIP_EXACT_START,
+                                     clip_index)
+    else:
+        # The size and frame rate are only defaults, each file sets its own when it is processed
+        video_writer = VideoWriter(config.CLIP_DEST, 1920, 1080, 20, config.PRE_ROLL_SECONDS,
+                                   config.PRE_ROLL_MAX_MB * 1024 * 1024, config.ENCODER_QUEUE_SIZE,
+                                   config.ENCODER_OVERFLOW, clip_index,
+                                   pre_roll_source=config.DETECTION_STRIDE > 1)
+
+    motion_gate = None
+    if config.MOTION_GATE:
+        motion_gate = MotionGate(config.MASK_COORDS, config.MOTION_MIN_AREA, config.MOTION_COOLDOWN,
+                                 mask_resolution=config.MASK_RESOLUTION)
+
+    model = load_model(config.MODEL_NAME, default_device(), config.MODEL_BACKEND, config.MODEL_INT8,
+                       config.MODEL_CACHE_DIR, config.INFERENCE_THREADS or threads)
+
+    return MotionDetector(config.MODEL_NAME, config.MOVEMENT_THRESHOLD, config.DELAY_TIME, video_writer,
+                          config.MASK_COORDS, config.DETECTION_STRIDE, motion_gate, config.CHECKPOINT_INTERVAL,
+                          config.MASK_RESOLUTION, model=model, threshold_width=config.MOVEMENT_THRESHOLD_WIDTH)
+
+
+def init_worker(torch_threads, db_file):
+    """
+    Initialize a worker process with its own detector.
+
+    Args:
+        torch_threads (int): The number of threads torch, or ONNX Runtime, may use in this worker.
+        db_file (str): The path of the FileManager's database, to save checkpoints to.
+    """
+    global motion_detector, checkpoint_writer
+    import torch
+    torch.set_num_threads(torch_threads)
+    motion_detector = build_motion_detector(torch_threads)
+    checkpoint_writer = CheckpointWriter(db_file)
+
+
+def process_file(video_file, max_attempts):
+    """
+    Process a video file in a worker process, from its last checkpoint.
+
+    The attempt is counted when the worker starts the file rather than when it is queued to the pool, so the
+    files waiting in the pool when a worker dies do not use up their attempts.
+
+    Args:
+        video_file (str): The path of the video file.
+        max_attempts (int): The number of attempts after which the file is given up on.
+
+    Returns:
+        bool: True if the file was processed, False if it was given up on.
+    """
+    start_frame, attempts = checkpoint_writer.start_file(video_file)
+    if attempts > max_attempts:
+        # The file took a worker down every time it was processed
+        print(f"[{os.getpid()}] Giving up on {video_file} after {attempts - 1} attempts")
+        return False
+    if start_frame:
+        print(f"[{os.getpid()}] Resuming {video_file} from frame {start_frame}")
+    print(f"[{os.getpid()}] Processing file:", video_file)
+    motion_detector.run(video_file, start_frame, checkpoint_writer)
+    return True
+
+
+def run_parallel(file_manager, workers):
+    """
+    Process new video files with a pool of worker processes, forever.
+
+    Files are marked as in progress when a worker starts them, and as processed or failed once the worker has
+    finished them. A worker that dies, e.g. killed for running out of memory, breaks the whole pool: the pool
+    is rebuilt and every file that was in flight is queued again, to be resumed from its checkpoint.
+
+    Args:
+        file_manager (FileManager): The file manager providing new files.
+        workers (int): The number of worker processes.
+    """
+    torch_threads = max(1, get_available_cores() // workers)
+    if config.MODEL_BACKEND == "onnx":
+        # Export once up front, so the workers load the cached model instead of all exporting it at once
+        export_onnx(config.MODEL_NAME, config.MODEL_CACHE_DIR, int8=config.MODEL_INT8)
+    context = multiprocessing.get_context("spawn")
+
+    def start_pool():
+        return ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker,
+                                   initargs=(torch_threads, file_manager.db_file))
+
+    executor = start_pool()
+    pending = {}
+    file_queue = file_manager.get_file_queue()
+    try:
+        while True:
+            broken = []
+            # Keep a few files queued per worker so none of them sits idle, and block for new
+            # files only when nothing is in flight
+            try:
+                while len(pending) < workers * 2:
+                    video_file = file_queue.get(block=not pending)
+                    try:
+                        future = executor.submit(process_file, video_file, file_manager.max_attempts)
+                    except BrokenProcessPool:
+                        broken.append(video_file)
+                        break
+                    file_manager.hand_over(video_file)
+                    pending[future] = video_file
+            except queue.Empty:
+                pass
+
+            if not broken:
+                done, _ = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    video_file = pending.pop(future)
+                    try:
+                        processed = future.result()
+                    except BrokenProcessPool:
+                        broken.append(video_file)
+                        continue
+                    except Exception as e:
+                        print(f"Failed to process file {video_file}: {e}")
+                        file_manager.mark_file_as_failed(video_file)
+                        continue
+                    if processed:
+                        file_manager.mark_file_as_processed(video_file)
+                    else:
+                        file_manager.mark_file_as_failed(video_file)
+
+            if broken:
+                # The files in flight are not to blame, only those a worker had started have an attempt counted
+                broken.extend(pending.values())
+                pending.clear()
+                print(f"A worker died, restarting the pool and retrying {len(broken)} file(s)")
+                executor.shutdown(wait=False, cancel_futures=True)
+                file_manager.requeue(broken)
+                executor = start_pool()
+    finally:
+        # On shutdown, files that were not started yet are left queued for the next run
+        executor.shutdown(wait=False, cancel_futures=True)